@@ -16,6 +16,23 @@ def create_app(config_name='default'):
     migrate.init_app(app, db)
     jwt.init_app(app)
     
+    # Structured, queue-backed logging with request ids
+    from modules.core.structured_logging import init_app as init_logging, get_logger
+    init_logging(app)
+    log = get_logger('main')
+    
+    # Shared state visible to every worker and replica
+    from modules.core import shared_state
+    shared_state.init_app(app)
+    
+    # Jinja bytecode cache, `flask templates-compile` and template warm-up
+    from modules.core import template_cache
+    template_cache.init_app(app)
+    
+    # Brotli/gzip compression, ETags and long-lived caching of fingerprinted static files
+    from modules.core import compression
+    compression.init_app(app)
+    
     # Set up before request handler to prepare greeting data
     @app.before_request
     def before_request():
@@ -69,7 +86,7 @@ def create_app(config_name='default'):
                 ).order_by(Notification.created_at.desc()).limit(10).all()
                 context['notifications'] = notifications
             except Exception as e:
-                print(f"Error loading notifications: {str(e)}")
+                log.warning("Error loading notifications: %s", e)
                 context['notifications'] = []
         else:
             context['notifications'] = []
@@ -126,13 +143,31 @@ def create_app(config_name='default'):
     from modules.inventory.shop_manager import shop_manager_bp
     from modules.inventory.warehouse import warehouse_bp
     from modules.inventory.scrap import scrap_bp
+    from modules.inventory.scrap_pipeline import scrap_pipeline_bp, register_scrap_listeners
+    from modules.inventory.stock_count import stock_count_bp
+    from modules.inventory.valuation import valuation_bp, register_valuation_listeners
+    from modules.inventory.receipt_posting import receipt_posting_bp
+    from modules.inventory.reorder import reorder_bp, register_reorder_listeners
+    from modules.inventory.forecast import forecast_bp
+    from modules.inventory.transfer_batches import transfer_batches_bp
     from modules.sales.routes import sales
+    from modules.sales.aging import receivables_bp, register_aging_listeners
     from modules.pos.routes import pos
     from modules.pos.api import pos_api
+    from modules.pos.pricing import pricing_bp, register_pricing_listeners
+    from modules.pos.payment_gateway import payments_bp
     from modules.employees.routes import employees_bp
     from modules.employees.clock import clock_bp
+    from modules.employees.attendance_rollup import attendance_rollup_bp, register_attendance_listeners
     from modules.employees.locations import locations_bp
     from modules.reports.routes import reports_bp
+    from modules.reports.sales_cube import sales_cube_bp, register_sales_cube_listeners
+    from modules.core.pdf_rendering import pdf_bp
+    from modules.core.pdf_signing import signing_bp
+    from modules.core.event_calendar import calendar_bp
+    from modules.core.archival import archive_bp
+    from modules.core.backup import backup_bp
+    from modules.core.db_copy import db_copy_bp
     from modules.warehouse_reports.routes import warehouse_reports_bp
     from modules.purchase.routes import purchase
     from modules.admin.routes import admin
@@ -148,21 +183,73 @@ def create_app(config_name='default'):
     login_manager.login_view = 'auth.login'
     login_manager.user_loader(load_user)
     
+    # Keep the scrap summary table in sync with scrap item changes
+    register_scrap_listeners()
+    
+    # Create and consume stock valuation cost layers as stock is posted
+    register_valuation_listeners()
+    
+    # Keep per-location and per-warehouse stock levels and low-stock flags current
+    register_reorder_listeners()
+    
+    # Keep invoice residuals up to date for aging and customer statements
+    register_aging_listeners()
+    
+    # Keep attendance daily rollups in sync with clock events and edits
+    register_attendance_listeners()
+    
+    # Keep the POS sales cube in sync with orders, returns and their lines
+    register_sales_cube_listeners()
+    
+    # Drop cached POS pricing rules when prices or POS settings change
+    register_pricing_listeners()
+    
+    # Limit branch users' POS, location and product queries to their own branch
+    from modules.core import branch_scope
+    branch_scope.init_app(app)
+    
+    # Attach yearly SQLite archive files and their <table>_all history views
+    from modules.core import archival
+    archival.init_app(app)
+    
+    # Write activity feed entries in batches from a background thread
+    from modules.core import audit_log
+    from modules.core.audit_log import record_activity
+    audit_log.init_app(app)
+    
     # Register blueprints
     app.register_blueprint(auth)
     app.register_blueprint(notifications, url_prefix='/notifications')
     app.register_blueprint(inventory, url_prefix='/inventory')
+    app.register_blueprint(stock_count_bp, url_prefix='/inventory')
+    app.register_blueprint(valuation_bp, url_prefix='/inventory')
+    app.register_blueprint(receipt_posting_bp, url_prefix='/inventory')
+    app.register_blueprint(reorder_bp, url_prefix='/inventory')
+    app.register_blueprint(forecast_bp, url_prefix='/inventory')
+    app.register_blueprint(transfer_batches_bp, url_prefix='/inventory')
     app.register_blueprint(inventory_manager_bp)
     app.register_blueprint(shop_manager_bp)
     app.register_blueprint(warehouse_bp)
     app.register_blueprint(scrap_bp, url_prefix='/scrap')
+    app.register_blueprint(scrap_pipeline_bp, url_prefix='/scrap')
     app.register_blueprint(sales, url_prefix='/sales')
+    app.register_blueprint(receivables_bp, url_prefix='/sales')
     app.register_blueprint(pos, url_prefix='/pos')
     app.register_blueprint(pos_api)
+    app.register_blueprint(pricing_bp)
+    app.register_blueprint(payments_bp)
     app.register_blueprint(employees_bp, url_prefix='/employees')
     app.register_blueprint(clock_bp, url_prefix='/clock')
+    app.register_blueprint(attendance_rollup_bp, url_prefix='/clock')
     app.register_blueprint(locations_bp, url_prefix='/employees/locations')
     app.register_blueprint(reports_bp, url_prefix='/reports')
+    app.register_blueprint(sales_cube_bp, url_prefix='/reports')
+    app.register_blueprint(pdf_bp, url_prefix='/reports')
+    app.register_blueprint(signing_bp, url_prefix='/reports')
+    app.register_blueprint(calendar_bp)
+    app.register_blueprint(archive_bp)
+    app.register_blueprint(backup_bp)
+    app.register_blueprint(db_copy_bp)
     app.register_blueprint(warehouse_reports_bp)
     app.register_blueprint(purchase)
     app.register_blueprint(admin, url_prefix='/admin')
@@ -205,6 +292,24 @@ def create_app(config_name='default'):
     def health_check():
         return jsonify({"status": "healthy", "timestamp": datetime.utcnow().isoformat()}), 200
     
+    # Liveness probe: the process is up and answering, nothing else is touched
+    @app.route('/health/live')
+    def liveness_check():
+        return jsonify({"status": "alive", "timestamp": datetime.utcnow().isoformat()}), 200
+    
+    # Readiness probe: only route traffic here when the database, schema,
+    # connection pool and background queues can take it (cached briefly)
+    @app.route('/health/ready')
+    def readiness_check():
+        from modules.core.health import readiness
+        
+        ready, checks = readiness()
+        return jsonify({
+            "status": "ready" if ready else "unavailable",
+            "checks": checks,
+            "timestamp": datetime.utcnow().isoformat()
+        }), 200 if ready else 503
+    
     # Dashboard route
     @app.route('/dashboard')
     @login_required
@@ -217,7 +322,6 @@ def create_app(config_name='default'):
             from modules.pos.models import POSOrder, POSReturn
             from sqlalchemy import func, and_, text
             from datetime import timedelta
-            import traceback
             
             # Get current user's role
             is_admin = current_user.has_role('Admin')
@@ -247,28 +351,28 @@ def create_app(config_name='default'):
                     from modules.auth.models import User
                     context['employee_count'] = Employee.query.count()
                 except Exception as e:
-                    print(f"Error getting employee count: {str(e)}")
+                    log.warning("Error getting employee count: %s", e)
                     db.session.rollback()
                 
                 # Product count
                 try:
                     context['product_count'] = Product.query.count()
                 except Exception as e:
-                    print(f"Error getting product count: {str(e)}")
+                    log.warning("Error getting product count: %s", e)
                     db.session.rollback()
                 
                 # POS order counts
                 try:
                     context['pos_order_count'] = POSOrder.query.count()
                 except Exception as e:
-                    print(f"Error getting POS order count: {str(e)}")
+                    log.warning("Error getting POS order count: %s", e)
                     db.session.rollback()
                 
                 # Return counts
                 try:
                     context['return_count'] = POSReturn.query.count()
                 except Exception as e:
-                    print(f"Error getting return count: {str(e)}")
+                    log.warning("Error getting return count: %s", e)
                     db.session.rollback()
                 
                 # Today's sales - using database-agnostic approach
@@ -286,7 +390,7 @@ def create_app(config_name='default'):
                     today_sales = today_sales_query.scalar()
                     context['pos_sales_today'] = today_sales if today_sales is not None else 0
                 except Exception as e:
-                    print(f"Error getting today's sales: {str(e)}")
+                    log.warning("Error getting today's sales: %s", e)
                     db.session.rollback()
                 
                 # Week's sales
@@ -300,32 +404,22 @@ def create_app(config_name='default'):
                     week_sales = week_sales_query.scalar()
                     context['pos_sales_week'] = week_sales if week_sales is not None else 0
                 except Exception as e:
-                    print(f"Error getting week's sales: {str(e)}")
+                    log.warning("Error getting week's sales: %s", e)
                     db.session.rollback()
                 
-                # Low stock products
+                # Low stock products, from the precomputed stock levels
                 try:
-                    # Get active products
-                    active_products = Product.query.filter(Product.is_active == True).all()
-                    
-                    # Filter products with low stock (less than 5 units)
-                    low_stock_products = []
-                    for product in active_products:
-                        try:
-                            qty = product.available_quantity
-                            if isinstance(qty, (int, float)) and qty < 5:
-                                low_stock_products.append(product)
-                        except Exception as e:
-                            print(f"Error checking product {product.name}: {str(e)}")
-                    
-                    # Sort by available quantity (ascending)
-                    low_stock_products.sort(key=lambda p: p.available_quantity if isinstance(p.available_quantity, (int, float)) else float('inf'))
-                    
-                    # Limit to 5 products for display
-                    context['low_stock_products'] = low_stock_products[:5]
+                    low_ids = [row.product_id for row in db.session.execute(db.text("""
+                        SELECT s.product_id FROM stock_levels s JOIN products p ON p.id = s.product_id
+                        WHERE s.is_low AND p.is_active = :active
+                        GROUP BY s.product_id
+                        ORDER BY MIN(s.quantity)
+                        LIMIT 5
+                    """), {'active': True})]
+                    products = {p.id: p for p in Product.query.filter(Product.id.in_(low_ids)).all()} if low_ids else {}
+                    context['low_stock_products'] = [products[i] for i in low_ids if i in products]
                 except Exception as e:
-                    print(f"Error fetching low stock products: {str(e)}")
-                    print(traceback.format_exc())
+                    log.exception("Error fetching low stock products: %s", e)
                     db.session.rollback()
                 
                 # Recent POS transactions
@@ -334,7 +428,7 @@ def create_app(config_name='default'):
                         POSOrder.order_date.desc()
                     ).limit(5).all()
                 except Exception as e:
-                    print(f"Error getting recent orders: {str(e)}")
+                    log.warning("Error getting recent orders: %s", e)
                     db.session.rollback()
                 
                 # Recent returns
@@ -343,16 +437,17 @@ def create_app(config_name='default'):
                         POSReturn.return_date.desc()
                     ).limit(5).all()
                 except Exception as e:
-                    print(f"Error getting recent returns: {str(e)}")
+                    log.warning("Error getting recent returns: %s", e)
                     db.session.rollback()
                 
                 # Recent activities
                 try:
+                    audit_log.flush()
                     context['activities'] = Activity.query.order_by(
                         Activity.timestamp.desc()
                     ).limit(10).all()
                 except Exception as e:
-                    print(f"Error fetching activities: {str(e)}")
+                    log.warning("Error fetching activities: %s", e)
                     db.session.rollback()
                 
                 # Add a motivational quote for the greeting message
@@ -378,22 +473,18 @@ def create_app(config_name='default'):
                 context['quote'] = random.choice(quotes)
 
             except Exception as e:
-                print(f"Error in dashboard data gathering: {str(e)}")
-                print(traceback.format_exc())
+                log.exception("Error in dashboard data gathering: %s", e)
                 db.session.rollback()
             
             return render_template('dashboard.html', **context)
             
         except Exception as e:
-            print(f"Critical error in dashboard route: {str(e)}")
-            print(traceback.format_exc())
+            log.exception("Critical error in dashboard route: %s", e)
             db.session.rollback()
             return render_template('error.html', error="An error occurred while loading the dashboard. Please try again later.")
             
         except Exception as e:
-            print(f"Critical error in dashboard: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            log.exception("Critical error in dashboard: %s", e)
             flash('Error loading dashboard data', 'error')
             return render_template('dashboard.html', **context)
     
@@ -482,7 +573,8 @@ def create_app(config_name='default'):
                     conn.commit()
                     flash("Sample activities added.", "success")
             
-            # Now query the activities
+            # Now query the activities, including this worker's queued ones
+            audit_log.flush()
             activities = Activity.query.order_by(Activity.timestamp.desc()).all()
             return render_template('activities.html', activities=activities)
         
@@ -497,7 +589,8 @@ def create_app(config_name='default'):
         try:
             from modules.core.models import Activity
             
-            # Delete all activities
+            # Delete all activities, queued ones included
+            audit_log.flush()
             Activity.query.delete()
             db.session.commit()
             
@@ -518,97 +611,6 @@ def create_app(config_name='default'):
         try:
             from modules.core.models import Event
             
-            # First, check if the events table exists
-            with db.engine.connect() as conn:
-                # Check if table exists
-                result = conn.execute(db.text("""
-                    SELECT name FROM sqlite_master 
-                    WHERE type='table' AND name='events'
-                """))
-                table_exists = result.fetchone() is not None
-                
-                if not table_exists:
-                    # Create the table if it doesn't exist
-                    conn.execute(db.text('''
-                    CREATE TABLE IF NOT EXISTS events (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        title VARCHAR(128) NOT NULL,
-                        description TEXT,
-                        date TIMESTAMP NOT NULL,
-                        end_date TIMESTAMP,
-                        location VARCHAR(128),
-                        event_type VARCHAR(32),
-                        created_by VARCHAR(64),
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                    '''))
-                    conn.commit()
-                    flash("Events table created successfully.", "success")
-                    
-                    # Add sample events
-                    from datetime import datetime, timedelta
-                    now = datetime.utcnow()
-                    
-                    # Sample events
-                    sample_events = [
-                        (
-                            "Inventory Stocktaking", 
-                            "Complete physical inventory count for Q2", 
-                            (now + timedelta(days=2)).strftime('%Y-%m-%d %H:%M:%S'),
-                            (now + timedelta(days=2, hours=4)).strftime('%Y-%m-%d %H:%M:%S'),
-                            "Main Warehouse",
-                            "inventory",
-                            "Warehouse Manager"
-                        ),
-                        (
-                            "Staff Training - POS System", 
-                            "Training session on new POS features", 
-                            (now + timedelta(days=5)).strftime('%Y-%m-%d %H:%M:%S'),
-                            (now + timedelta(days=5, hours=3)).strftime('%Y-%m-%d %H:%M:%S'),
-                            "Training Room",
-                            "training",
-                            "IT Manager"
-                        ),
-                        (
-                            "Monthly Sales Review", 
-                            "Review of sales performance and targets", 
-                            (now + timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S'),
-                            (now + timedelta(days=7, hours=2)).strftime('%Y-%m-%d %H:%M:%S'),
-                            "Conference Room",
-                            "meeting",
-                            "Sales Director"
-                        ),
-                        (
-                            "Supplier Meeting - Accra Goods Ltd", 
-                            "Negotiation of new supply terms", 
-                            (now + timedelta(days=10)).strftime('%Y-%m-%d %H:%M:%S'),
-                            (now + timedelta(days=10, hours=1, minutes=30)).strftime('%Y-%m-%d %H:%M:%S'),
-                            "Executive Boardroom",
-                            "meeting",
-                            "Procurement Manager"
-                        ),
-                        (
-                            "Product Launch - Premium Line", 
-                            "Launch event for new premium product line", 
-                            (now + timedelta(days=14)).strftime('%Y-%m-%d %H:%M:%S'),
-                            (now + timedelta(days=14, hours=5)).strftime('%Y-%m-%d %H:%M:%S'),
-                            "Kempinski Hotel, Accra",
-                            "marketing",
-                            "Marketing Director"
-                        )
-                    ]
-                    
-                    # Insert sample events
-                    for event in sample_events:
-                        conn.execute(db.text("""
-                            INSERT INTO events 
-                            (title, description, date, end_date, location, event_type, created_by) 
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        """), event)
-                    
-                    conn.commit()
-                    flash("Sample events added.", "success")
-            
             # Get filter parameter
             filter_type = request.args.get('filter', None)
             
@@ -631,12 +633,15 @@ def create_app(config_name='default'):
             # Order by date
             if filter_type == 'past':
                 # Past events in descending order (most recent first)
-                events = query.order_by(Event.date.desc()).all()
+                query = query.order_by(Event.date.desc())
             else:
                 # Upcoming events in ascending order (soonest first)
-                events = query.order_by(Event.date.asc()).all()
+                query = query.order_by(Event.date.asc())
+            
+            # One page at a time; the calendar view reads /events/range instead
+            pagination = query.paginate(page=request.args.get('page', 1, type=int), per_page=50, error_out=False)
             
-            return render_template('events.html', events=events, filter=filter_type)
+            return render_template('events.html', events=pagination.items, pagination=pagination, filter=filter_type)
         
         except Exception as e:
             flash(f"Error loading events: {str(e)}", "error")
@@ -648,9 +653,8 @@ def create_app(config_name='default'):
     def add_event():
         try:
             # Import necessary modules
-            from modules.core.models import Event, Activity
+            from modules.core.models import Event
             from datetime import datetime
-            import traceback
             
             if request.method == 'POST':
                 # Get form data
@@ -662,7 +666,8 @@ def create_app(config_name='default'):
                 event_type = request.form.get('event_type', '')
                 created_by = request.form.get('created_by') or session.get('username', 'Admin')
                 
-                print(f"Form data received: title={title}, date={date_str}, end_date={end_date_str}, created_by={created_by}")
+                log.debug("Event form received: title=%s, date=%s, end_date=%s, created_by=%s",
+                          title, date_str, end_date_str, created_by)
                 
                 # Validate required fields
                 if not title or not date_str:
@@ -672,14 +677,12 @@ def create_app(config_name='default'):
                 # Convert date strings to datetime objects
                 try:
                     date = datetime.strptime(date_str, '%Y-%m-%dT%H:%M')
-                    print(f"Parsed date: {date}")
                     
                     end_date = None
                     if end_date_str and end_date_str.strip():
                         end_date = datetime.strptime(end_date_str, '%Y-%m-%dT%H:%M')
-                        print(f"Parsed end_date: {end_date}")
                 except Exception as e:
-                    print(f"Error parsing dates: {str(e)}")
+                    log.warning("Error parsing dates: %s", e)
                     flash(f"Error with date format: {str(e)}", "error")
                     return render_template('event_form.html', event=None)
                 
@@ -696,33 +699,33 @@ def create_app(config_name='default'):
                         created_by=created_by
                     )
                     
-                    # Add to database and commit
+                    # Add to database, with its repeat rule if one was chosen, and commit
                     db.session.add(new_event)
+                    repeat = request.form.get('repeat')
+                    if repeat and repeat != 'none':
+                        from modules.core.event_calendar import build_rule, set_recurrence
+                        repeat_until = request.form.get('repeat_until')
+                        until = datetime.strptime(repeat_until, '%Y-%m-%d').date() if repeat_until else None
+                        db.session.flush()
+                        set_recurrence(new_event.id, new_event.date, build_rule(repeat, until))
                     db.session.commit()
                     
-                    print(f"Event created successfully with ID: {new_event.id}")
+                    log.info("Event created", extra={'event_id': new_event.id})
                     
-                    # Log activity
-                    try:
-                        activity = Activity(
-                            description=f"Event scheduled: {title}",
-                            details=f"New event scheduled for {date.strftime('%d/%m/%Y %H:%M')}",
-                            user=created_by,
-                            activity_type="event"
-                        )
-                        db.session.add(activity)
-                        db.session.commit()
-                    except Exception as e:
-                        print(f"Error logging activity: {str(e)}")
-                        # Continue even if activity logging fails
+                    # Log activity (written in the background, failures only logged)
+                    record_activity(
+                        description=f"Event scheduled: {title}",
+                        details=f"New event scheduled for {date.strftime('%d/%m/%Y %H:%M')}",
+                        user=created_by,
+                        activity_type="event"
+                    )
                     
                     flash(f"Event '{title}' has been scheduled successfully.", "success")
                     return redirect(url_for('all_events'))
                     
                 except Exception as e:
                     db.session.rollback()
-                    print(f"Error creating event: {str(e)}")
-                    print(traceback.format_exc())
+                    log.exception("Error creating event: %s", e)
                     flash(f"Error creating event: {str(e)}", "error")
                     return render_template('event_form.html', event=None)
             
@@ -730,8 +733,7 @@ def create_app(config_name='default'):
             return render_template('event_form.html', event=None)
         
         except Exception as e:
-            print(f"Unexpected error in add_event: {str(e)}")
-            print(traceback.format_exc())
+            log.exception("Unexpected error in add_event: %s", e)
             flash(f"Error adding event: {str(e)}", "error")
             return redirect(url_for('all_events'))
     
@@ -762,12 +764,20 @@ def create_app(config_name='default'):
                 event.event_type = request.form.get('event_type')
                 event.created_by = request.form.get('created_by')
                 
+                # Update the repeat rule when the form has repeat options
+                if 'repeat' in request.form:
+                    from modules.core.event_calendar import build_rule, set_recurrence
+                    repeat = request.form.get('repeat')
+                    repeat_until = request.form.get('repeat_until')
+                    until = datetime.strptime(repeat_until, '%Y-%m-%d').date() if repeat_until else None
+                    rule = build_rule(repeat, until) if repeat and repeat != 'none' else None
+                    set_recurrence(event.id, event.date, rule)
+                
                 # Save changes
                 db.session.commit()
                 
                 # Log activity
-                from modules.core.models import Activity
-                Activity.log(
+                record_activity(
                     description=f"Event updated: {event.title}",
                     details=f"Event details updated for {event.date.strftime('%d/%m/%Y %H:%M')}",
                     user=current_user.username,
@@ -797,13 +807,14 @@ def create_app(config_name='default'):
             # Store title for flash message
             title = event.title
             
-            # Delete the event
+            # Delete the event and its repeat rule
+            from modules.core.event_calendar import set_recurrence
+            set_recurrence(event.id, event.date, None)
             db.session.delete(event)
             db.session.commit()
             
             # Log activity
-            from modules.core.models import Activity
-            Activity.log(
+            record_activity(
                 description=f"Event deleted: {title}",
                 details=f"Event was removed from the calendar",
                 user=current_user.username,
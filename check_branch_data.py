@@ -21,17 +21,15 @@ else:
 
 # Check stock locations
 print("\n=== STOCK LOCATIONS ===")
-cursor.execute("SELECT * FROM stock_locations")
+cursor.execute("""
+    SELECT l.*, b.name AS branch_name
+    FROM stock_locations l
+    LEFT JOIN branches b ON b.id = l.branch_id
+""")
 locations = cursor.fetchall()
 if locations:
     for loc in locations:
-        branch_name = "No Branch"
-        if loc['branch_id']:
-            cursor.execute("SELECT name FROM branches WHERE id = ?", (loc['branch_id'],))
-            branch = cursor.fetchone()
-            if branch:
-                branch_name = branch['name']
-        
+        branch_name = loc['branch_name'] or "No Branch"
         print(f"ID: {loc['id']}, Name: {loc['name']}, Type: {loc['location_type']}, Branch ID: {loc['branch_id']}, Branch: {branch_name}")
 else:
     print("No stock locations found in the database.")
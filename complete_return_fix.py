@@ -141,22 +141,22 @@ def patch_routes():
         
         # Define the patched function
         def patched_partial_return():
-            print("COMPLETE FIX: Using patched partial_return function")
+            import logging
             from flask import request, redirect, url_for, flash, render_template
             from flask_login import current_user
             from modules.pos.models import POSOrder, POSReturn, POSReturnLine, Product
+            from modules.core.structured_logging import get_logger
             from extensions import db
             
+            log = get_logger('pos')
+            
             if request.method == 'POST':
                 try:
-                    # Log all form data for debugging
-                    print("==== COMPLETE FIX - FORM DATA ====")
-                    for key, value in request.form.items():
-                        if '[]' in key:
-                            values = request.form.getlist(key)
-                            print(f"{key}: {values}")
-                        else:
-                            print(f"{key}: {value}")
+                    # Log all form data for debugging (skipped entirely unless pos=DEBUG)
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug("Partial return form data", extra={
+                            'form': {key: request.form.getlist(key) for key in request.form.keys()}
+                        })
                     
                     # Get form data
                     original_order_id = request.form.get('original_order_id')
@@ -184,9 +184,8 @@ def patch_routes():
                     original_line_ids = request.form.getlist('original_line_id[]')
                     
                     # Debug information
-                    print(f"COMPLETE FIX - Product IDs: {product_ids}")
-                    print(f"COMPLETE FIX - Quantities: {quantities}")
-                    print(f"COMPLETE FIX - Prices: {prices}")
+                    log.debug("Partial return lines: product_ids=%s quantities=%s prices=%s",
+                              product_ids, quantities, prices)
                     
                     # Calculate total amount and validate quantities
                     total_amount = 0
@@ -212,7 +211,8 @@ def patch_routes():
                             subtotal = round(quantity * price, 2)
                             total_amount += subtotal
                             
-                            print(f"COMPLETE FIX - Line {i}: product={product_id}, quantity={quantity}, price={price}, subtotal={subtotal}")
+                            log.debug("Partial return line %s: product=%s quantity=%s price=%s subtotal=%s",
+                                      i, product_id, quantity, price, subtotal)
                             
                             # Add to return lines data
                             return_lines_data.append({
@@ -225,7 +225,7 @@ def patch_routes():
                                 'original_line_id': original_line_id
                             })
                         except Exception as e:
-                            print(f"Error processing line {i}: {str(e)}")
+                            log.warning("Error processing partial return line %s: %s", i, e)
                     
                     if not return_lines_data:
                         flash("Please add at least one product to return", "error")
@@ -319,8 +319,7 @@ def patch_routes():
                 except Exception as e:
                     db.session.rollback()
                     flash(f"Error creating partial return: {str(e)}", "error")
-                    import traceback
-                    traceback.print_exc()
+                    log.exception("Error creating partial return")
                     return redirect(url_for('pos.partial_return'))
             
             # GET request - show the form
@@ -19,6 +19,139 @@ class Config:
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload
     
+    # Attendance rules used by the daily attendance rollups
+    ATTENDANCE_SHIFT_START = os.environ.get('ATTENDANCE_SHIFT_START') or '08:00'
+    ATTENDANCE_STANDARD_MINUTES = int(os.environ.get('ATTENDANCE_STANDARD_MINUTES') or 480)
+    
+    # Stock valuation: 'fifo' or 'average' costing of outgoing stock
+    INVENTORY_COSTING_METHOD = os.environ.get('INVENTORY_COSTING_METHOD') or 'fifo'
+    
+    # Limit non-admin users' POS, stock location and product queries to their branch
+    BRANCH_SCOPING = (os.environ.get('BRANCH_SCOPING') or 'true').lower() in ('1', 'true', 'yes')
+    
+    # Shared state (modules/core/shared_state.py) visible to every worker and replica
+    SHARED_STATE_BACKEND = os.environ.get('SHARED_STATE_BACKEND') or 'filesystem'
+    SHARED_STATE_DIR = os.environ.get('SHARED_STATE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'shared_state')
+    
+    # Scale-out: number of pods/instances and gunicorn workers per instance
+    REPLICAS = int(os.environ.get('REPLICAS') or 1)
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY') or 1)
+    
+    # Readiness probe budget
+    HEALTH_DB_TIMEOUT = float(os.environ.get('HEALTH_DB_TIMEOUT') or 1.0)
+    HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS') or 2)
+    HEALTH_POOL_SATURATION_LIMIT = float(os.environ.get('HEALTH_POOL_SATURATION_LIMIT') or 0.9)
+    
+    # Jinja bytecode cache (filled at build time by `flask templates-compile`) and
+    # warm-up of the templates in each worker before it reports ready
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '.template_cache')
+    TEMPLATE_WARMUP = (os.environ.get('TEMPLATE_WARMUP') or 'false').lower() in ('1', 'true', 'yes')
+    TEMPLATE_WARMUP_TEMPLATES = ['base.html', 'auth/login.html', 'dashboard.html', 'pos/index.html', 'reports/index.html']
+    
+    # Response compression (Brotli/gzip above this many bytes) and the cache
+    # lifetime of fingerprinted static assets
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)
+    STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE') or 365 * 24 * 3600)
+    
+    # PDF rendering: WeasyPrint worker processes per web process, documents in
+    # flight during batch renders, stylesheets (under static/) applied to every PDF
+    PDF_WORKERS = int(os.environ.get('PDF_WORKERS') or 2)
+    PDF_MAX_PENDING = int(os.environ.get('PDF_MAX_PENDING') or 0)
+    PDF_STYLESHEETS = ['css/pdf.css']
+    PDF_INVOICE_TEMPLATE = os.environ.get('PDF_INVOICE_TEMPLATE') or 'sales/invoice_pdf.html'
+    
+    # PDF signing: a PKCS#12 bundle, or PEM key and certificate, plus chain files.
+    # The signer must chain up to SIGNING_TRUST_ROOTS (list a self-signed company
+    # certificate there); CRLs are cached by `flask signing refresh-revinfo`
+    SIGNING_PKCS12 = os.environ.get('SIGNING_PKCS12')
+    SIGNING_KEY = os.environ.get('SIGNING_KEY')
+    SIGNING_CERT = os.environ.get('SIGNING_CERT')
+    SIGNING_PASSPHRASE = os.environ.get('SIGNING_PASSPHRASE')
+    SIGNING_CA_CHAIN = [path for path in (os.environ.get('SIGNING_CA_CHAIN') or '').split(',') if path]
+    SIGNING_TRUST_ROOTS = [path for path in (os.environ.get('SIGNING_TRUST_ROOTS') or '').split(',') if path]
+    SIGNING_REVINFO_DIR = os.environ.get('SIGNING_REVINFO_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'revinfo')
+    SIGNING_FETCH_REVINFO = (os.environ.get('SIGNING_FETCH_REVINFO') or 'false').lower() in ('1', 'true', 'yes')
+    SIGNING_EMBED_VALIDATION_INFO = (os.environ.get('SIGNING_EMBED_VALIDATION_INFO') or 'false').lower() in ('1', 'true', 'yes')
+    SIGNING_REASON = os.environ.get('SIGNING_REASON') or f'Issued by {COMPANY_NAME}'
+    SIGNING_LOCATION = os.environ.get('SIGNING_LOCATION')
+    SIGNING_WORKERS = int(os.environ.get('SIGNING_WORKERS') or 2)
+    SIGNING_MAX_PENDING = int(os.environ.get('SIGNING_MAX_PENDING') or 0)
+    
+    # POS pricing: seconds other workers keep cached prices and POS settings, and
+    # the tax rate of lines without their own tax_percent (when tax is enabled)
+    PRICING_CACHE_TTL = int(os.environ.get('PRICING_CACHE_TTL') or 30)
+    POS_DEFAULT_TAX_PERCENT = float(os.environ.get('POS_DEFAULT_TAX_PERCENT') or 0)
+    
+    # Mobile Money/card payments: "paystack", or "mock" for a local provider
+    # without network access (development and tests only). Without a provider
+    # (no PAYSTACK_SECRET_KEY) provider payments are turned off and the rest
+    # of the ERP runs as before. `flask payments poll` checks pending payments
+    # with at most PAYMENT_POLL_CONCURRENCY provider requests in flight
+    PAYSTACK_SECRET_KEY = os.environ.get('PAYSTACK_SECRET_KEY')
+    PAYMENT_PROVIDER = os.environ.get('PAYMENT_PROVIDER') or ('paystack' if PAYSTACK_SECRET_KEY else None)
+    PAYMENT_CURRENCY = os.environ.get('PAYMENT_CURRENCY') or 'GHS'
+    PAYMENT_DEFAULT_EMAIL = os.environ.get('PAYMENT_DEFAULT_EMAIL')
+    PAYMENT_TIMEOUT = int(os.environ.get('PAYMENT_TIMEOUT') or 10)
+    PAYMENT_POLL_INTERVAL = int(os.environ.get('PAYMENT_POLL_INTERVAL') or 5)
+    PAYMENT_POLL_CONCURRENCY = int(os.environ.get('PAYMENT_POLL_CONCURRENCY') or 10)
+    PAYMENT_INTENT_TTL = int(os.environ.get('PAYMENT_INTENT_TTL') or 30)
+    PAYMENT_MOCK_OUTCOME = os.environ.get('PAYMENT_MOCK_OUTCOME') or 'success'
+    PAYMENT_MOCK_DELAY = int(os.environ.get('PAYMENT_MOCK_DELAY') or 0)
+    PAYMENT_MOCK_SECRET = os.environ.get('PAYMENT_MOCK_SECRET')
+    
+    # Archival: POS orders and stock moves older than ARCHIVE_RETENTION_DAYS are
+    # moved to archive tables (yearly files in ARCHIVE_DIR on SQLite) in batches
+    ARCHIVE_RETENTION_DAYS = int(os.environ.get('ARCHIVE_RETENTION_DAYS') or 365)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 500)
+    ARCHIVE_BATCH_PAUSE = float(os.environ.get('ARCHIVE_BATCH_PAUSE') or 0.2)
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'archive')
+    
+    # Backups: online snapshots in BACKUP_DIR, copied BACKUP_PAGES_PER_STEP pages at a
+    # time; a full backup after every BACKUP_FULL_EVERY incremental ones
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'backups')
+    BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP') or 256)
+    BACKUP_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE') or 0.05)
+    BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS') or 3)
+    BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY') or 6)
+    BACKUP_KEEP_CHAINS = int(os.environ.get('BACKUP_KEEP_CHAINS') or 4)
+    BACKUP_PG_DUMP = os.environ.get('BACKUP_PG_DUMP') or 'pg_dump'
+    BACKUP_PG_RESTORE = os.environ.get('BACKUP_PG_RESTORE') or 'pg_restore'
+    
+    # SQLite -> PostgreSQL copy (`flask db-copy run`): tables copied in parallel and
+    # SQLite rows fetched per chunk
+    DB_COPY_JOBS = int(os.environ.get('DB_COPY_JOBS') or 4)
+    DB_COPY_CHUNK_SIZE = int(os.environ.get('DB_COPY_CHUNK_SIZE') or 5000)
+    
+    # Activity feed: entries are written in batches every AUDIT_FLUSH_INTERVAL_MS or
+    # once AUDIT_FLUSH_SIZE are queued
+    AUDIT_BATCHING = (os.environ.get('AUDIT_BATCHING') or 'true').lower() in ('1', 'true', 'yes')
+    AUDIT_FLUSH_INTERVAL_MS = int(os.environ.get('AUDIT_FLUSH_INTERVAL_MS') or 250)
+    AUDIT_FLUSH_SIZE = int(os.environ.get('AUDIT_FLUSH_SIZE') or 100)
+    AUDIT_MAX_BUFFER = int(os.environ.get('AUDIT_MAX_BUFFER') or 10000)
+    
+    # Reorder points: the larger of min_stock (REORDER_DEFAULT_MIN_STOCK when unset) and the
+    # sales over REORDER_LEAD_DAYS at the REORDER_WINDOW_DAYS average; suggestions add
+    # REORDER_COVER_DAYS of sales
+    REORDER_WINDOW_DAYS = int(os.environ.get('REORDER_WINDOW_DAYS') or 28)
+    REORDER_LEAD_DAYS = float(os.environ.get('REORDER_LEAD_DAYS') or 7)
+    REORDER_COVER_DAYS = float(os.environ.get('REORDER_COVER_DAYS') or 14)
+    REORDER_DEFAULT_MIN_STOCK = float(os.environ.get('REORDER_DEFAULT_MIN_STOCK') or 5)
+    
+    # Demand forecast (`flask forecast run`, nightly): FORECAST_HISTORY_DAYS of daily sales,
+    # short/long moving averages, FORECAST_HORIZON_DAYS ahead, safety stock at FORECAST_SERVICE_LEVEL;
+    # FORECAST_CHUNK_SERIES product/branch series are computed per matrix
+    FORECAST_HISTORY_DAYS = int(os.environ.get('FORECAST_HISTORY_DAYS') or 182)
+    FORECAST_SHORT_DAYS = int(os.environ.get('FORECAST_SHORT_DAYS') or 7)
+    FORECAST_LONG_DAYS = int(os.environ.get('FORECAST_LONG_DAYS') or 28)
+    FORECAST_HORIZON_DAYS = int(os.environ.get('FORECAST_HORIZON_DAYS') or 14)
+    FORECAST_SERVICE_LEVEL = float(os.environ.get('FORECAST_SERVICE_LEVEL') or 0.95)
+    FORECAST_CHUNK_SERIES = int(os.environ.get('FORECAST_CHUNK_SERIES') or 20000)
+    
+    # Logging: LOG_LEVELS overrides single blueprints, e.g. "pos=DEBUG,inventory=WARNING"
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    LOG_LEVELS = os.environ.get('LOG_LEVELS') or ''
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'text'
+    
     # Email configuration
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
@@ -35,11 +168,14 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    PAYMENT_PROVIDER = Config.PAYMENT_PROVIDER or 'mock'
 
 
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test_erp_system.db'
+    AUDIT_BATCHING = False
+    PAYMENT_PROVIDER = Config.PAYMENT_PROVIDER or 'mock'
 
 
 class ProductionConfig(Config):
@@ -54,15 +190,64 @@ class ProductionConfig(Config):
         # Use file-based SQLite or other database specified by environment variable
         SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///instance/erp_system.db'
     
+    # One JSON object per line for Cloud Logging
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'json'
+    
+    # Warm templates up after a cold start before taking traffic
+    TEMPLATE_WARMUP = (os.environ.get('TEMPLATE_WARMUP') or 'true').lower() in ('1', 'true', 'yes')
+    
     @staticmethod
     def init_app(app):
         Config.init_app(app)
-        # Log to stderr
-        import logging
-        from logging import StreamHandler
-        file_handler = StreamHandler()
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+        check_scale_out(app)
+        check_payment_provider(app)
+
+
+def check_scale_out(app):
+    """Refuse database and shared-state setups that break with more than one process.
+    
+    An in-memory SQLite database is private to each process, and a SQLite file
+    lives on one pod's disk, so with several workers or replicas every process
+    would see different data.
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    replicas = app.config.get('REPLICAS', 1)
+    workers = app.config.get('WEB_CONCURRENCY', 1)
+    is_sqlite = uri.startswith('sqlite')
+    in_memory = is_sqlite and 'memory' in uri
+    
+    if in_memory and (replicas > 1 or workers > 1):
+        raise RuntimeError(
+            f"In-memory SQLite cannot be shared by {replicas} replica(s) x {workers} worker(s). "
+            "Set DATABASE_URL to a PostgreSQL database, or run a single replica with one worker."
+        )
+    
+    if replicas > 1:
+        if is_sqlite:
+            raise RuntimeError(
+                f"SQLite ({uri}) is local to one instance and cannot serve {replicas} replicas. "
+                "Set DATABASE_URL to a PostgreSQL database."
+            )
+        if app.config.get('SHARED_STATE_BACKEND') == 'filesystem' and not os.environ.get('SHARED_STATE_DIR'):
+            raise RuntimeError(
+                "Multiple replicas need shared state: set SHARED_STATE_BACKEND=database, "
+                "or point SHARED_STATE_DIR at a volume mounted by every replica."
+            )
+
+
+def check_payment_provider(app):
+    """Warn about a payment provider production cannot use.
+    
+    The mock provider confirms every payment without asking anyone, so it is
+    only available with DEBUG or TESTING, and Paystack needs its secret key.
+    Either mistake turns provider payments off (the till is told payments are
+    not configured) instead of stopping the whole ERP from starting.
+    """
+    provider = app.config.get('PAYMENT_PROVIDER')
+    if provider == 'mock' and not (app.config.get('DEBUG') or app.config.get('TESTING')):
+        app.logger.warning("PAYMENT_PROVIDER is 'mock' in production; provider payments are disabled")
+    elif provider == 'paystack' and not app.config.get('PAYSTACK_SECRET_KEY'):
+        app.logger.warning("PAYSTACK_SECRET_KEY is not set; provider payments are disabled")
 
 
 config = {
@@ -0,0 +1,109 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import re
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+
+# Tables filtered by branch (modules/core/branch_scope.py), plus users for the branch they belong to
+BRANCH_TABLES = ['users', 'pos_cash_registers', 'pos_sessions', 'pos_orders', 'stock_locations', 'products']
+
+# Sessions take the branch of their cash register (see backfill_registers),
+# orders the branch of their session
+BACKFILLS = [
+    """UPDATE pos_sessions SET branch_id = (
+           SELECT r.branch_id FROM pos_cash_registers r WHERE r.id = pos_sessions.cash_register_id
+       ) WHERE branch_id IS NULL AND cash_register_id IS NOT NULL""",
+    """UPDATE pos_orders SET branch_id = (
+           SELECT s.branch_id FROM pos_sessions s WHERE s.id = pos_orders.session_id
+       ) WHERE branch_id IS NULL""",
+]
+
+# Every scoped query leads with branch_id, followed by what branch pages filter or sort on
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_pos_orders_branch_date ON pos_orders (branch_id, order_date)",
+    "CREATE INDEX IF NOT EXISTS ix_pos_orders_branch_state ON pos_orders (branch_id, state)",
+    "CREATE INDEX IF NOT EXISTS ix_pos_sessions_branch_state ON pos_sessions (branch_id, state)",
+    "CREATE INDEX IF NOT EXISTS ix_pos_cash_registers_branch ON pos_cash_registers (branch_id)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_locations_branch_type ON stock_locations (branch_id, location_type)",
+    "CREATE INDEX IF NOT EXISTS ix_products_branch_active ON products (branch_id, is_active)",
+]
+
+# Older accounts carry their branch in the username: "branch2", "manager2".
+# Only this backfill reads it; access is decided by users.branch_id alone
+USERNAME_BRANCH = re.compile(r'^(?:branch|manager)\s*(\d+)$')
+
+def backfill_users(branch_ids):
+    """Store the branch of accounts named after one ("branch2", "manager2")"""
+    updates = []
+    for user in db.session.execute(text("SELECT id, username FROM users WHERE branch_id IS NULL")):
+        match = USERNAME_BRANCH.match((user.username or '').strip().lower())
+        branch_id = int(match.group(1)) if match else None
+        if branch_id in branch_ids:
+            updates.append({'id': user.id, 'branch_id': branch_id})
+    if updates:
+        db.session.execute(text("UPDATE users SET branch_id = :branch_id WHERE id = :id"), updates)
+    return len(updates)
+
+def backfill_registers():
+    """Give registers without a branch the branch of the users who open most sessions on them"""
+    sessions = db.session.execute(text("""
+        SELECT s.cash_register_id, u.branch_id, COUNT(*) AS sessions
+        FROM pos_sessions s
+        JOIN pos_cash_registers r ON r.id = s.cash_register_id
+        JOIN users u ON u.id = s.user_id
+        WHERE r.branch_id IS NULL AND u.branch_id IS NOT NULL
+        GROUP BY s.cash_register_id, u.branch_id
+        ORDER BY s.cash_register_id, sessions DESC
+    """)).all()
+
+    branches = {}
+    for register_id, branch_id, _ in sessions:
+        branches.setdefault(register_id, branch_id)
+    if branches:
+        db.session.execute(text("UPDATE pos_cash_registers SET branch_id = :branch_id WHERE id = :id"),
+                           [{'id': register_id, 'branch_id': branch_id} for register_id, branch_id in branches.items()])
+    return len(branches)
+
+def add_branch_scope():
+    """Add branch_id where it is missing, backfill POS rows and create the branch indexes"""
+    print("Adding branch scope columns and indexes...")
+
+    # Creates the branches table if this database predates it
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    try:
+        for table in BRANCH_TABLES:
+            columns = [column['name'] for column in inspector.get_columns(table)]
+            if 'branch_id' not in columns:
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN branch_id INTEGER REFERENCES branches(id)"))
+                print(f"Added branch_id column to {table}")
+
+        branch_ids = {row[0] for row in db.session.execute(text("SELECT id FROM branches"))}
+        print(f"Assigned a branch to {backfill_users(branch_ids)} users")
+        print(f"Assigned a branch to {backfill_registers()} cash registers")
+        for statement in BACKFILLS:
+            db.session.execute(text(statement))
+        for statement in INDEXES:
+            db.session.execute(text(statement))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error adding branch scope: {e}")
+        return False
+
+    print("Branch scope columns and indexes added")
+    print("Restart every app worker so the models pick up their branch_id columns")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        add_branch_scope()
@@ -0,0 +1,37 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+
+# Indexes used by the bulk physical inventory count (modules/inventory/stock_count.py)
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_inventory_lines_inventory_product ON inventory_lines (inventory_id, product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_moves_source_state ON stock_moves (source_location_id, state, product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_stock_moves_destination_state ON stock_moves (destination_location_id, state, product_id)",
+]
+
+def add_indexes():
+    """Create the indexes the count snapshot and variance queries rely on"""
+    print("Adding inventory count indexes...")
+    try:
+        for statement in INDEXES:
+            db.session.execute(text(statement))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error adding indexes: {e}")
+        return False
+
+    print("Inventory count indexes added")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        add_indexes()
@@ -0,0 +1,46 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datetime import datetime
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+
+# Extra pending intents of one order (from two tills racing) are abandoned;
+# a late success webhook still recovers them or flags them for reconciliation
+ABANDON_DUPLICATES = """
+    UPDATE payment_intents SET status = 'abandoned', error = 'Duplicate pending payment', resolved_at = :now
+    WHERE status = 'pending' AND id NOT IN (
+        SELECT MIN(id) FROM payment_intents WHERE status = 'pending' GROUP BY order_id
+    )
+"""
+
+INDEX = ("CREATE UNIQUE INDEX IF NOT EXISTS uq_payment_intents_order_pending "
+         "ON payment_intents (order_id) WHERE status = 'pending'")
+
+def add_pending_index():
+    """Allow at most one pending payment intent per POS order"""
+    print("Adding pending payment intent index...")
+    try:
+        abandoned = db.session.execute(text(ABANDON_DUPLICATES), {'now': datetime.utcnow()}).rowcount
+        if abandoned:
+            print(f"Abandoned {abandoned} duplicate pending payment intents")
+        db.session.execute(text(INDEX))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error adding pending payment intent index: {e}")
+        return False
+
+    print("Pending payment intent index added")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        add_pending_index()
@@ -0,0 +1,55 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+
+# Duplicate rows of one product in one warehouse are folded into the oldest
+MERGE_DUPLICATES = [
+    """UPDATE warehouse_products SET quantity = (
+           SELECT SUM(d.quantity) FROM warehouse_products d
+           WHERE d.warehouse_id = warehouse_products.warehouse_id AND d.product_id = warehouse_products.product_id
+       )
+       WHERE id IN (
+           SELECT MIN(id) FROM warehouse_products GROUP BY warehouse_id, product_id HAVING COUNT(*) > 1
+       )""",
+    """DELETE FROM warehouse_products
+       WHERE id NOT IN (SELECT MIN(id) FROM warehouse_products GROUP BY warehouse_id, product_id)""",
+]
+
+# Lets stock postings add quantities with INSERT ... ON CONFLICT (warehouse_id, product_id)
+INDEX = ("CREATE UNIQUE INDEX IF NOT EXISTS uq_warehouse_products_warehouse_product "
+         "ON warehouse_products (warehouse_id, product_id)")
+
+def add_unique_index():
+    """Merge duplicate warehouse product rows and make (warehouse_id, product_id) unique"""
+    print("Adding unique warehouse product index...")
+    try:
+        duplicates = db.session.execute(text("""
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM warehouse_products GROUP BY warehouse_id, product_id HAVING COUNT(*) > 1
+            ) d
+        """)).scalar()
+        if duplicates:
+            for statement in MERGE_DUPLICATES:
+                db.session.execute(text(statement))
+            print(f"Merged duplicate rows for {duplicates} warehouse products")
+        db.session.execute(text(INDEX))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error adding unique index: {e}")
+        return False
+
+    print("Unique warehouse product index added")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        add_unique_index()
@@ -0,0 +1,30 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.employees.models_attendance_rollup import AttendanceDailyRollup
+from modules.employees.attendance_rollup import rebuild_rollups
+
+def create_tables():
+    """Create the attendance_daily_rollups table and backfill it from attendances"""
+    print("Creating attendance rollup table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'attendance_daily_rollups' not in inspector.get_table_names():
+        print("Warning: attendance_daily_rollups table was not created")
+        return False
+
+    count = rebuild_rollups()
+    print(f"Attendance rollup table created and backfilled with {count} employee days")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_tables()
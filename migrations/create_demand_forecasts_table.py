@@ -0,0 +1,36 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.inventory.models_forecast import DemandForecast
+from modules.inventory.forecast import run_forecast
+
+def create_demand_forecasts():
+    """Create the demand_forecasts table and run the first forecast.
+
+    Run after add_branch_scope_indexes.py, which adds pos_orders.branch_id.
+    """
+    print("Creating demand forecasts table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'demand_forecasts' not in inspector.get_table_names():
+        print("Warning: demand_forecasts table was not created")
+        return False
+    if 'branch_id' not in [column['name'] for column in inspector.get_columns('pos_orders')]:
+        print("Warning: pos_orders has no branch_id column, run add_branch_scope_indexes.py first")
+        return False
+
+    count = run_forecast()
+    print(f"Demand forecasts created for {count} product/branch series")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_demand_forecasts()
@@ -0,0 +1,40 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+from modules.core.models_event_recurrence import EventRecurrence
+
+# Calendar window queries (modules/core/event_calendar.py) look events up by start and by end
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_events_date_end ON events (date, end_date)",
+    "CREATE INDEX IF NOT EXISTS ix_events_end_date ON events (end_date)",
+]
+
+def create_tables():
+    """Create the event_recurrences table and the calendar range indexes"""
+    print("Creating event recurrences table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'event_recurrences' not in inspector.get_table_names():
+        print("Warning: event_recurrences table was not created")
+        return False
+
+    for statement in INDEXES:
+        db.session.execute(text(statement))
+    db.session.commit()
+
+    print("Event recurrences table and calendar indexes created")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_tables()
@@ -0,0 +1,37 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+from modules.sales.models_invoice_balance import InvoiceBalance
+from modules.sales.aging import rebuild_balances
+
+def create_tables():
+    """Create the invoice_balances table, index open invoices and backfill residuals"""
+    print("Creating invoice balances table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'invoice_balances' not in inspector.get_table_names():
+        print("Warning: invoice_balances table was not created")
+        return False
+
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_invoices_customer_state_due ON invoices (customer_id, state, due_date)"
+    ))
+    db.session.commit()
+
+    count = rebuild_balances()
+    print(f"Invoice balances table created and backfilled for {count} invoices")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_tables()
@@ -0,0 +1,30 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.pos.models_payment_intent import PaymentIntent, PaymentWebhookEvent
+
+def create_tables():
+    """Create the payment_intents and payment_webhook_events tables"""
+    print("Creating payment intent tables...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    missing = [name for name in ('payment_intents', 'payment_webhook_events')
+               if name not in inspector.get_table_names()]
+    if missing:
+        print(f"Warning: tables were not created: {', '.join(missing)}")
+        return False
+
+    print("Payment intent tables created")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_tables()
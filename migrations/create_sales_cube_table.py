@@ -0,0 +1,36 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.reports.models_sales_cube import SalesCubeCell
+from modules.reports.sales_cube import rebuild_cube
+
+def create_sales_cube():
+    """Create the sales_cube table and fill it from existing orders and returns.
+
+    Run after add_branch_scope_indexes.py, which adds pos_orders.branch_id.
+    """
+    print("Creating sales cube table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'sales_cube' not in inspector.get_table_names():
+        print("Warning: sales_cube table was not created")
+        return False
+    if 'branch_id' not in [column['name'] for column in inspector.get_columns('pos_orders')]:
+        print("Warning: pos_orders has no branch_id column, run add_branch_scope_indexes.py first")
+        return False
+
+    days = rebuild_cube()
+    print(f"Sales cube created and backfilled for {days} days")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_sales_cube()
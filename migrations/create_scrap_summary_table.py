@@ -0,0 +1,30 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.inventory.models_scrap_summary import ScrapSummary
+from modules.inventory.scrap_pipeline import rebuild_scrap_summary
+
+def create_tables():
+    """Create the scrap_summaries table and backfill it from scrap_items"""
+    print("Creating scrap summary table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'scrap_summaries' not in inspector.get_table_names():
+        print("Warning: scrap_summaries table was not created")
+        return False
+
+    count = rebuild_scrap_summary()
+    print(f"Scrap summary table created and backfilled with {count} rows")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_tables()
@@ -0,0 +1,37 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.inventory.models_reorder import StockLevel, ReorderAlert
+from modules.inventory.reorder import rebuild_levels
+
+def create_stock_levels():
+    """Create the stock_levels and reorder_alerts tables and fill stock_levels.
+
+    Run after create_sales_cube_table.py: reorder points use the sales cube.
+    """
+    print("Creating stock level tables...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    for table in ('stock_levels', 'reorder_alerts'):
+        if table not in inspector.get_table_names():
+            print(f"Warning: {table} table was not created")
+            return False
+    if 'sales_cube' not in inspector.get_table_names():
+        print("Warning: sales_cube table is missing, run create_sales_cube_table.py first")
+        return False
+
+    count = rebuild_levels()
+    print(f"Stock levels created for {count} products and sites")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_stock_levels()
@@ -0,0 +1,54 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from extensions import db
+from app import create_app
+from modules.inventory.models_transfer_batch import TransferBatch
+
+# Moves and warehouse movements written for a batch point back to it
+BATCH_COLUMNS = ['stock_moves', 'warehouse_movements']
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_stock_moves_transfer_batch ON stock_moves (transfer_batch_id, state)",
+    "CREATE INDEX IF NOT EXISTS ix_warehouse_movements_transfer_batch ON warehouse_movements (transfer_batch_id)",
+]
+
+def create_transfer_batches():
+    """Create the transfer_batches table and link stock moves and warehouse movements to it"""
+    print("Creating transfer batches table...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    if 'transfer_batches' not in inspector.get_table_names():
+        print("Warning: transfer_batches table was not created")
+        return False
+
+    try:
+        for table in BATCH_COLUMNS:
+            columns = [column['name'] for column in inspector.get_columns(table)]
+            if 'transfer_batch_id' not in columns:
+                db.session.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN transfer_batch_id INTEGER REFERENCES transfer_batches(id)"))
+                print(f"Added transfer_batch_id column to {table}")
+
+        for statement in INDEXES:
+            db.session.execute(text(statement))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error linking transfer batches: {e}")
+        return False
+
+    print("Transfer batches table created")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_transfer_batches()
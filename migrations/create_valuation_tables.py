@@ -0,0 +1,32 @@
+import sys
+import os
+
+# Add the parent directory to the path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extensions import db
+from app import create_app
+from modules.inventory.models_valuation import StockValuationLayer, StockValuationSnapshot
+from modules.inventory.valuation import rebuild_layers
+
+def create_tables():
+    """Create the stock valuation tables and replay existing stock history into cost layers"""
+    print("Creating stock valuation tables...")
+
+    db.create_all()
+
+    inspector = db.inspect(db.engine)
+    missing = [name for name in ('stock_valuation_layers', 'stock_valuation_snapshots')
+               if name not in inspector.get_table_names()]
+    if missing:
+        print(f"Warning: tables were not created: {', '.join(missing)}")
+        return False
+
+    count = rebuild_layers()
+    print(f"Stock valuation tables created, {count} stock events valued")
+    return True
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        create_tables()
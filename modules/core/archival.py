@@ -0,0 +1,428 @@
+"""
+Hot/cold tiering of POS orders and stock moves.
+
+pos_orders, pos_order_lines, stock_moves and warehouse_movements only ever
+grow, and every "recent" query pays for the whole history. `flask archive
+run` moves rows older than ARCHIVE_RETENTION_DAYS into archive tables,
+ARCHIVE_BATCH_SIZE parents per transaction with ARCHIVE_BATCH_PAUSE seconds
+between batches, so the live tables stay small without long write locks:
+
+- POS orders of closed sessions, with their lines and payment intents.
+  Orders with returns stay live, since returns point at them.
+- Done and cancelled stock moves, and warehouse movements.
+
+On PostgreSQL the archive is archive_<table>, partitioned by year on
+archive_date (the order or move date). On SQLite each year is a separate
+database file in ARCHIVE_DIR, attached to every connection as
+archive_<year>, so an old year can be copied off or dropped as one file.
+
+Every archived table gets a <table>_all view that unions the live and the
+archived rows. On SQLite these are temporary views, created per connection.
+Code that needs the full history, such as stock counts, cost rebuilds and the
+sales cube rebuild, reads history_table(name) instead of the table. That
+name falls back to the live table until anything has been archived.
+"""
+import os
+import re
+import sqlite3
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask import Blueprint, current_app
+from sqlalchemy import bindparam, event, text
+
+from extensions import db
+from modules.core.structured_logging import get_logger
+
+archive_bp = Blueprint('archive', __name__, cli_group='archive')
+
+log = get_logger('archive')
+
+# table: the parent table (alias t); date: the row's archive date;
+# eligible: which parents may go; children: (table, column referencing the parent)
+ArchiveSet = namedtuple('ArchiveSet', ['table', 'date', 'eligible', 'children'])
+
+ARCHIVE_SETS = (
+    ArchiveSet(
+        table='pos_orders',
+        date='t.order_date',
+        eligible="""t.order_date < :cutoff
+            AND t.session_id IN (SELECT id FROM pos_sessions WHERE state = 'closed')
+            AND NOT EXISTS (SELECT 1 FROM pos_returns r WHERE r.original_order_id = t.id)""",
+        children=(('pos_order_lines', 'order_id'), ('payment_intents', 'order_id')),
+    ),
+    ArchiveSet(
+        table='stock_moves',
+        date='COALESCE(t.effective_date, t.created_at)',
+        eligible="t.state IN ('done', 'cancelled') AND COALESCE(t.effective_date, t.created_at) < :cutoff",
+        children=(),
+    ),
+    ArchiveSet(
+        table='warehouse_movements',
+        date='t.created_at',
+        eligible="t.created_at < :cutoff",
+        children=(),
+    ),
+)
+
+ARCHIVED_TABLES = tuple(table for archive_set in ARCHIVE_SETS
+                        for table in (archive_set.table, *(child for child, _ in archive_set.children)))
+
+_ARCHIVE_FILE = re.compile(r'^archive_(\d{4})\.db$')
+
+_archive_files_cache = {}
+_pg_views_checked = {'at': 0.0, 'ready': False}
+
+
+def _is_sqlite(engine=None):
+    return (engine or db.engine).dialect.name == 'sqlite'
+
+
+def _archive_dir(app=None):
+    return (app or current_app).config['ARCHIVE_DIR']
+
+
+def archive_files(directory):
+    """{year: path} of the SQLite archive files, re-listed when the directory changes"""
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return {}
+    cached = _archive_files_cache.get(directory)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    files = {}
+    for name in os.listdir(directory):
+        match = _ARCHIVE_FILE.match(name)
+        if match:
+            files[int(match.group(1))] = os.path.join(directory, name)
+    _archive_files_cache[directory] = (mtime, files)
+    return files
+
+
+def history_table(table):
+    """Table or view to read a table's full history (live and archived) from"""
+    if table not in ARCHIVED_TABLES:
+        return table
+
+    if _is_sqlite():
+        return f'{table}_all' if archive_files(_archive_dir()) else table
+
+    # Views are created by `flask archive setup`; look once a minute until then
+    if not _pg_views_checked['ready'] and time.monotonic() - _pg_views_checked['at'] > 60:
+        _pg_views_checked['at'] = time.monotonic()
+        _pg_views_checked['ready'] = db.session.execute(
+            text("SELECT to_regclass(:name) IS NOT NULL"), {'name': f'{ARCHIVED_TABLES[0]}_all'}).scalar()
+    return f'{table}_all' if _pg_views_checked['ready'] else table
+
+
+# --- SQLite: one attached file per year ---------------------------------------
+
+def _sqlite_columns(cursor, schema, table):
+    return [(row[1], row[2]) for row in cursor.execute(f'PRAGMA {schema}.table_info("{table}")')]
+
+
+def _sync_sqlite_archive(cursor, schema, table, live):
+    # Creates the archive copy of a table (live columns plus archive_date, no
+    # constraints) or adds columns the live table gained since
+    archived = {name for name, _ in _sqlite_columns(cursor, schema, table)}
+    if not archived:
+        column_sql = ', '.join(f'"{name}" {type_ or ""}' for name, type_ in live)
+        cursor.execute(f'CREATE TABLE {schema}."{table}" ({column_sql}, archive_date DATE)')
+        cursor.execute(f'CREATE INDEX {schema}."ix_{table}_id" ON "{table}" (id)')
+        return True
+
+    missing = [(name, type_) for name, type_ in live if name not in archived]
+    for name, type_ in missing:
+        cursor.execute(f'ALTER TABLE {schema}."{table}" ADD COLUMN "{name}" {type_ or ""}')
+    return bool(missing)
+
+
+def _attach_archives(dbapi_connection, connection_record, connection_proxy=None):
+    # SQLite attaches at most 10 databases by default, so keep ten years or
+    # fewer in ARCHIVE_DIR and move older files elsewhere
+    directory = connection_record.info.get('archive_dir')
+    files = archive_files(directory) if directory else {}
+    if connection_record.info.get('archive_files') == files:
+        return
+
+    cursor = dbapi_connection.cursor()
+    try:
+        attached = {row[1] for row in cursor.execute('PRAGMA database_list')}
+        for year, path in sorted(files.items()):
+            if f'archive_{year}' not in attached:
+                cursor.execute(f"ATTACH DATABASE ? AS archive_{year}", (path,))
+
+        for table in ARCHIVED_TABLES:
+            live = [name for name, _ in _sqlite_columns(cursor, 'main', table)]
+            cursor.execute(f'DROP VIEW IF EXISTS temp."{table}_all"')
+            if not live or not files:
+                continue
+            selects = [f'SELECT {", ".join(live)} FROM main."{table}"']
+            for year in sorted(files):
+                archived = {name for name, _ in _sqlite_columns(cursor, f'archive_{year}', table)}
+                if archived:
+                    columns = ', '.join(name if name in archived else f'NULL AS {name}' for name in live)
+                    selects.append(f'SELECT {columns} FROM archive_{year}."{table}"')
+            cursor.execute(f'CREATE TEMP VIEW "{table}_all" AS ' + ' UNION ALL '.join(selects))
+    finally:
+        cursor.close()
+    connection_record.info['archive_files'] = files
+
+
+def _ensure_sqlite_years(years):
+    directory = _archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    files = archive_files(directory)
+    missing = [year for year in years if year not in files]
+    for year in missing:
+        sqlite3.connect(os.path.join(directory, f'archive_{year}.db')).close()
+        log.info("Archive file created", extra={'year': year})
+    if missing:
+        # The next checkout attaches the new files
+        db.session.commit()
+
+    proxied = db.session.connection().connection
+    cursor = proxied.dbapi_connection.cursor()
+    try:
+        changed = False
+        for table in ARCHIVED_TABLES:
+            live = _sqlite_columns(cursor, 'main', table)
+            if live:
+                for year in years:
+                    changed |= _sync_sqlite_archive(cursor, f'archive_{year}', table, live)
+    finally:
+        cursor.close()
+    if changed:
+        # Rebuild this connection's views over the new tables and columns
+        proxied.info['archive_files'] = None
+
+
+# --- PostgreSQL: partitioned archive tables ----------------------------------
+
+def _pg_columns(connection, table):
+    return [row.column_name for row in connection.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table
+        ORDER BY ordinal_position
+    """), {'table': table})]
+
+
+def _ensure_pg_archive(connection, table):
+    connection.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS archive_{table} (LIKE {table} INCLUDING DEFAULTS, archive_date DATE NOT NULL)
+        PARTITION BY RANGE (archive_date)
+    """))
+    connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_archive_{table}_id ON archive_{table} (id)"))
+    for column in _pg_columns(connection, table):
+        connection.execute(text(f"ALTER TABLE archive_{table} ADD COLUMN IF NOT EXISTS {column} "
+                                f"{_pg_type(connection, table, column)}"))
+
+
+def _pg_type(connection, table, column):
+    return connection.execute(text("""
+        SELECT format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+        WHERE a.attrelid = CAST(:table AS regclass) AND a.attname = :column
+    """), {'table': table, 'column': column}).scalar()
+
+
+def _ensure_pg_years(years):
+    connection = db.session.connection()
+    for table in _existing_tables():
+        for year in years:
+            connection.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS archive_{table}_y{year} PARTITION OF archive_{table}
+                FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')
+            """))
+
+
+def _create_pg_views(connection):
+    for table in _existing_tables():
+        columns = ', '.join(_pg_columns(connection, table))
+        connection.execute(text(f"DROP VIEW IF EXISTS {table}_all"))
+        connection.execute(text(f"""
+            CREATE VIEW {table}_all AS
+            SELECT {columns} FROM {table}
+            UNION ALL
+            SELECT {columns} FROM archive_{table}
+        """))
+
+
+# --- The archiving job --------------------------------------------------------
+
+def _existing_tables():
+    existing = set(db.inspect(db.engine).get_table_names())
+    return [table for table in ARCHIVED_TABLES if table in existing]
+
+
+def setup_archive():
+    """Create the archive tables and the <table>_all views (PostgreSQL)"""
+    if _is_sqlite():
+        return
+    try:
+        connection = db.session.connection()
+        for table in _existing_tables():
+            _ensure_pg_archive(connection, table)
+        _create_pg_views(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _date_sql(expression):
+    return f'date({expression})' if _is_sqlite() else f'CAST({expression} AS DATE)'
+
+
+def _target(table, year):
+    return f'archive_{year}."{table}"' if _is_sqlite() else f'archive_{table}'
+
+
+def _columns(table):
+    return [column['name'] for column in db.inspect(db.engine).get_columns(table)]
+
+
+def _move_batch(archive_set, tables, rows):
+    by_year = defaultdict(list)
+    for row in rows:
+        by_year[row.archive_date.year].append(row.id)
+
+    if _is_sqlite():
+        _ensure_sqlite_years(by_year)
+    else:
+        _ensure_pg_years(by_year)
+
+    connection = db.session.connection()
+    children = [(child, column) for child, column in archive_set.children if child in tables]
+    for year, ids in by_year.items():
+        params = {'ids': ids}
+        for child, column in children:
+            columns = ', '.join(f'c.{name}' for name in tables[child])
+            connection.execute(text(f"""
+                INSERT INTO {_target(child, year)} ({', '.join(tables[child])}, archive_date)
+                SELECT {columns}, {_date_sql(archive_set.date)}
+                FROM {child} c JOIN {archive_set.table} t ON t.id = c.{column}
+                WHERE c.{column} IN :ids
+            """).bindparams(bindparam('ids', expanding=True)), params)
+
+        columns = ', '.join(f't.{name}' for name in tables[archive_set.table])
+        connection.execute(text(f"""
+            INSERT INTO {_target(archive_set.table, year)} ({', '.join(tables[archive_set.table])}, archive_date)
+            SELECT {columns}, {_date_sql(archive_set.date)}
+            FROM {archive_set.table} t
+            WHERE t.id IN :ids
+        """).bindparams(bindparam('ids', expanding=True)), params)
+
+        for child, column in children:
+            connection.execute(text(f"DELETE FROM {child} WHERE {column} IN :ids")
+                               .bindparams(bindparam('ids', expanding=True)), params)
+        connection.execute(text(f"DELETE FROM {archive_set.table} WHERE id IN :ids")
+                           .bindparams(bindparam('ids', expanding=True)), params)
+
+
+def _eligible(archive_set, limit=None):
+    return text(f"""
+        SELECT t.id, {archive_set.date} AS archive_date
+        FROM {archive_set.table} t
+        WHERE {archive_set.eligible}
+        ORDER BY t.id
+        {'LIMIT :limit' if limit else ''}
+    """).columns(archive_date=db.DateTime)
+
+
+def archive_candidates(cutoff):
+    """Rows per archive set that a run with this cutoff would move"""
+    existing = set(_existing_tables())
+    return {archive_set.table: db.session.execute(
+                text(f"SELECT COUNT(*) FROM {archive_set.table} t WHERE {archive_set.eligible}"),
+                {'cutoff': cutoff}).scalar()
+            for archive_set in ARCHIVE_SETS if archive_set.table in existing}
+
+
+def run_archive(retention_days=None, batch_size=None, pause=None, max_batches=None):
+    """Move rows older than the retention window into the archive; returns rows moved per table"""
+    config = current_app.config
+    retention_days = retention_days or config.get('ARCHIVE_RETENTION_DAYS', 365)
+    batch_size = batch_size or config.get('ARCHIVE_BATCH_SIZE', 500)
+    pause = config.get('ARCHIVE_BATCH_PAUSE', 0.2) if pause is None else pause
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+
+    setup_archive()
+    existing = set(_existing_tables())
+    tables = {table: _columns(table) for table in existing}
+    moved = {}
+
+    for archive_set in ARCHIVE_SETS:
+        if archive_set.table not in existing:
+            continue
+        moved[archive_set.table] = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            started = time.perf_counter()
+            try:
+                rows = db.session.execute(_eligible(archive_set, batch_size),
+                                          {'cutoff': cutoff, 'limit': batch_size}).all()
+                if not rows:
+                    db.session.rollback()
+                    break
+                _move_batch(archive_set, tables, rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            batches += 1
+            moved[archive_set.table] += len(rows)
+            log.info("Archive batch moved", extra={
+                'table': archive_set.table, 'rows': len(rows),
+                'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+            if len(rows) < batch_size:
+                break
+            # Let the tills' writes through between batches
+            time.sleep(pause)
+
+    return moved
+
+
+def init_app(app):
+    """Attach the SQLite archive files and their union views to every connection"""
+    with app.app_context():
+        engine = db.engine
+    if not _is_sqlite(engine):
+        return
+
+    directory = app.config['ARCHIVE_DIR']
+
+    def remember_directory(dbapi_connection, connection_record):
+        connection_record.info['archive_dir'] = directory
+        _attach_archives(dbapi_connection, connection_record)
+
+    event.listen(engine, 'connect', remember_directory)
+    event.listen(engine, 'checkout', _attach_archives)
+
+
+@archive_bp.cli.command('run')
+@click.option('--retention-days', type=int, help='Keep this many days live (default ARCHIVE_RETENTION_DAYS)')
+@click.option('--batch-size', type=int, help='Parent rows moved per transaction')
+@click.option('--max-batches', type=int, help='Stop after this many batches per table')
+@click.option('--dry-run', is_flag=True, help='Only count what would be archived')
+def run_command(retention_days, batch_size, max_batches, dry_run):
+    """Move old POS orders and stock moves into the archive."""
+    if dry_run:
+        days = retention_days or current_app.config.get('ARCHIVE_RETENTION_DAYS', 365)
+        for table, count in archive_candidates(datetime.utcnow() - timedelta(days=days)).items():
+            print(f"{table}: {count} rows would be archived")
+        return
+
+    for table, count in run_archive(retention_days, batch_size, max_batches=max_batches).items():
+        print(f"{table}: {count} rows archived")
+
+
+@archive_bp.cli.command('setup')
+def setup_command():
+    """Create the archive tables and union views (PostgreSQL)."""
+    setup_archive()
+    print("Archive tables and views are in place")
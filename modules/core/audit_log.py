@@ -0,0 +1,203 @@
+"""
+Batched writes of the activity feed.
+
+Event, return and transfer actions added an Activity row and committed it
+on the request thread, one more INSERT and commit on top of the action the
+cashier or storekeeper is waiting for. record_activity() queues the entry
+instead. A background thread in each worker process writes the queue as one
+multi-row INSERT every AUDIT_FLUSH_INTERVAL_MS milliseconds, or as soon as
+AUDIT_FLUSH_SIZE entries are waiting, so the /activities feed trails by well
+under a second:
+
+- record_activity(..., critical=True) writes the entry on its own
+  connection before returning, for entries that must not be lost if the
+  process dies.
+- A batch the database cannot take (connection lost, database busy) is
+  retried on the next flush. A batch it rejects (a bad row) is written
+  entry by entry and only the rejected entries are logged and dropped. At
+  most AUDIT_MAX_BUFFER entries are held; beyond that the oldest are
+  dropped (and logged).
+- The queue is flushed when the process exits, and flush() writes it
+  immediately, which the feed pages do before reading.
+
+With AUDIT_BATCHING off (as in tests) every entry is written synchronously.
+"""
+import atexit
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import column, table
+from sqlalchemy.exc import DataError, IntegrityError
+
+from extensions import db
+from modules.core.structured_logging import get_logger
+
+log = get_logger('audit')
+
+activities = table(
+    'activities',
+    column('description'),
+    column('details'),
+    column('user'),
+    column('timestamp', db.DateTime),
+    column('activity_type'),
+)
+
+
+class AuditWriter:
+    """Queue of activity entries written by a background thread"""
+
+    def __init__(self, engine, interval_ms=250, batch_size=100, max_buffer=10000):
+        self.engine = engine
+        self.interval = interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.pid = None
+        self.thread = None
+
+    def _ensure_thread(self):
+        # Started on first use in each process: a gunicorn worker forked
+        # from the master gets its own thread and an empty queue
+        if self.pid == os.getpid() and self.thread is not None:
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pending = []
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self.thread.start()
+
+    def add(self, entry):
+        self._ensure_thread()
+        with self.lock:
+            self.pending.append(entry)
+            dropped = len(self.pending) - self.max_buffer
+            if dropped > 0:
+                del self.pending[:dropped]
+            waiting = len(self.pending)
+        if dropped > 0:
+            log.warning("Activity entries dropped", extra={'dropped': dropped})
+        if waiting >= self.batch_size:
+            self.wake.set()
+
+    def flush(self):
+        """Write everything queued so far; returns the number of entries written"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(activities.insert(), batch)
+            return len(batch)
+        except (IntegrityError, DataError) as e:
+            log.warning("Activity batch rejected, retrying entry by entry",
+                        extra={'entries': len(batch), 'error': str(e)})
+        except Exception as e:
+            # The database is unreachable or busy: keep the batch for the next flush
+            self._requeue(batch)
+            log.warning("Activity entries not written, will retry", extra={'entries': len(batch), 'error': str(e)})
+            return 0
+
+        # Only the rows the database rejects are dropped, one at a time
+        written = 0
+        for position, entry in enumerate(batch):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(activities.insert(), entry)
+                written += 1
+            except (IntegrityError, DataError) as e:
+                log.error("Activity entry dropped", extra={
+                    'activity_type': entry.get('activity_type'), 'error': str(e)})
+            except Exception as e:
+                self._requeue(batch[position:])
+                log.warning("Activity entries not written, will retry",
+                            extra={'entries': len(batch) - position, 'error': str(e)})
+                break
+        return written
+
+    def _requeue(self, entries):
+        # Ahead of newer entries, still holding at most max_buffer
+        with self.lock:
+            self.pending[:0] = entries
+            dropped = len(self.pending) - self.max_buffer
+            if dropped > 0:
+                del self.pending[:dropped]
+        if dropped > 0:
+            log.warning("Activity entries dropped", extra={'dropped': dropped})
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(timeout=5)
+        self.flush()
+
+
+_writer = None
+
+
+def _entry(description, details, user, activity_type):
+    return {
+        'description': description[:128],
+        'details': details,
+        'user': user,
+        'timestamp': datetime.utcnow(),
+        'activity_type': activity_type,
+    }
+
+
+def record_activity(description, details=None, user=None, activity_type=None, critical=False):
+    """Add an entry to the activity feed, batched unless critical"""
+    entry = _entry(description, details, user, activity_type)
+    if _writer is None or critical:
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(activities.insert(), [entry])
+        except Exception as e:
+            if critical:
+                raise
+            log.warning("Error logging activity: %s", e)
+        return
+    _writer.add(entry)
+
+
+def flush():
+    """Write the queued entries now, so a feed read right after sees them"""
+    return _writer.flush() if _writer is not None else 0
+
+
+def shutdown():
+    """Stop the writer thread and write what is left"""
+    if _writer is not None:
+        _writer.close()
+
+
+atexit.register(shutdown)
+
+
+def init_app(app):
+    """Start batching activity writes for this app"""
+    global _writer
+
+    if not app.config.get('AUDIT_BATCHING', True):
+        return
+    with app.app_context():
+        engine = db.engine
+    _writer = AuditWriter(
+        engine,
+        interval_ms=app.config.get('AUDIT_FLUSH_INTERVAL_MS', 250),
+        batch_size=app.config.get('AUDIT_FLUSH_SIZE', 100),
+        max_buffer=app.config.get('AUDIT_MAX_BUFFER', 10000),
+    )
@@ -0,0 +1,582 @@
+"""
+Online database backups and verified restores.
+
+The only copies so far were hand-made: `backups/` holds .bak files of source
+code, and the database could only be copied by stopping the app. `flask
+backup create` takes a consistent snapshot while the tills keep selling:
+
+- SQLite is copied with the online backup API, BACKUP_PAGES_PER_STEP pages
+  at a time with BACKUP_STEP_PAUSE seconds between steps, so writers are
+  never locked out for long. A write by another connection restarts the
+  copy; after BACKUP_MAX_RESTARTS restarts the rest is copied in one step.
+  Every BACKUP_FULL_EVERY + 1 backups is a full, gzipped copy of the
+  database. The ones in between are incremental: only the pages that
+  changed since the previous backup of the chain. The yearly archive files
+  of modules.core.archival are copied as well, when they changed.
+- PostgreSQL is dumped with BACKUP_PG_DUMP (pg_dump, or any stand-in with
+  the same arguments) in its compressed custom format, which reads one
+  snapshot without blocking writers. Every dump is full; point-in-time
+  recovery from WAL segments is left to the server's own archiving.
+
+Each backup is described by a <name>.json manifest with the SHA-256 of its
+files and of the database it restores to. `flask backup verify` rebuilds a
+backup (the full copy plus its increments) in a scratch file and checks
+both checksums and SQLite's integrity check, or lists a dump with
+pg_restore. `flask backup restore` verifies the same way before it
+replaces anything, and on SQLite copies the restored database into the live
+one with the backup API, so open connections see the change atomically.
+Only the newest BACKUP_KEEP_CHAINS full backups and their increments are
+kept.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import subprocess
+import time
+from datetime import datetime
+
+import click
+from flask import Blueprint, current_app
+from sqlalchemy.engine import URL, make_url
+
+from extensions import db
+from modules.core.archival import archive_files
+from modules.core.structured_logging import get_logger
+
+backup_bp = Blueprint('backup', __name__, cli_group='backup')
+
+log = get_logger('backup')
+
+_PAGE_RECORD = struct.Struct('>I')
+_DIGEST_SIZE = 16
+_CHUNK = 1024 * 1024
+
+
+class BackupError(Exception):
+    """Raised when a backup cannot be taken, found or verified"""
+
+
+def _backup_dir():
+    directory = current_app.config['BACKUP_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _sqlite_path():
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite':
+        return None
+    if not url.database or url.database == ':memory:' or 'memory' in url.database:
+        raise BackupError("An in-memory SQLite database cannot be backed up")
+    return os.path.abspath(url.database)
+
+
+def _pg_target(url=None):
+    """Connection URL and environment for pg_dump / pg_restore.
+
+    The password travels in PGPASSWORD: on the command line it would be
+    visible to every local user through ps and /proc.
+    """
+    url = make_url(url or db.engine.url)
+    env = dict(os.environ)
+    if url.password is not None:
+        env['PGPASSWORD'] = str(url.password)
+    url = URL.create('postgresql', username=url.username, host=url.host, port=url.port,
+                     database=url.database, query=url.query)
+    return url.render_as_string(hide_password=False), env
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# --- Manifests ---------------------------------------------------------------
+
+def _manifest_path(directory, name):
+    return os.path.join(directory, f'{name}.json')
+
+
+def _write_manifest(directory, manifest):
+    # Written last, through a temporary name: a backup without a manifest
+    # was never finished and is ignored
+    path = _manifest_path(directory, manifest['name'])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def list_backups(directory=None):
+    """Manifests of the finished backups, oldest first"""
+    directory = directory or _backup_dir()
+    manifests = []
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(directory, file_name)) as f:
+                manifests.append(json.load(f))
+    return sorted(manifests, key=lambda manifest: manifest['created_at'])
+
+
+def _load(directory, name):
+    try:
+        with open(_manifest_path(directory, name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise BackupError(f"No backup named {name}")
+
+
+def _chain(directory, manifest):
+    # The full backup, then each increment up to this one
+    chain = [manifest]
+    while chain[0].get('base'):
+        chain.insert(0, _load(directory, chain[0]['base']))
+    return chain
+
+
+class _Lock:
+    """Keeps two backups or restores from running into each other"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, '.lock')
+
+    def __enter__(self):
+        try:
+            os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            raise BackupError(f"Another backup or restore is running (remove {self.path} if it is not)")
+        return self
+
+    def __exit__(self, *exc):
+        os.remove(self.path)
+
+
+# --- SQLite snapshots ----------------------------------------------------------
+
+def _online_copy(source_path, target_path, config):
+    """Consistent copy of a live SQLite database, a few pages per step"""
+    pages = config.get('BACKUP_PAGES_PER_STEP', 256)
+    pause = config.get('BACKUP_STEP_PAUSE', 0.05)
+    max_restarts = config.get('BACKUP_MAX_RESTARTS', 3)
+    state = {'remaining': None, 'restarts': 0}
+
+    class _Restarted(Exception):
+        pass
+
+    def progress(status, remaining, total):
+        # A step that copied pages without getting closer to the end means a
+        # write elsewhere restarted the copy
+        if status == sqlite3.SQLITE_OK and state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise _Restarted()
+        state['remaining'] = remaining
+        if remaining:
+            time.sleep(pause)
+
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except _Restarted:
+                # Too busy to copy in steps: copy the rest under one read lock
+                source.backup(target, pages=-1)
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return state['restarts']
+
+
+def _page_size(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute('PRAGMA page_size').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def _pages(path, page_size):
+    with open(path, 'rb') as f:
+        for page_no, page in enumerate(iter(lambda: f.read(page_size), b'')):
+            yield page_no, page
+
+
+def _read_hashes(path):
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+    return [data[i:i + _DIGEST_SIZE] for i in range(0, len(data), _DIGEST_SIZE)]
+
+
+def _write_snapshot(snapshot, directory, name, base_hashes):
+    # Full copy when there is nothing to compare with, else the changed pages
+    page_size = _page_size(snapshot)
+    db_digest = hashlib.sha256()
+    hashes = []
+    changed = 0
+    data_file = f'{name}.db.gz' if base_hashes is None else f'{name}.pages.gz'
+
+    with gzip.open(os.path.join(directory, data_file), 'wb', compresslevel=6) as out:
+        for page_no, page in _pages(snapshot, page_size):
+            db_digest.update(page)
+            page_hash = hashlib.blake2b(page, digest_size=_DIGEST_SIZE).digest()
+            hashes.append(page_hash)
+            if base_hashes is None:
+                out.write(page)
+            elif page_no >= len(base_hashes) or base_hashes[page_no] != page_hash:
+                out.write(_PAGE_RECORD.pack(page_no))
+                out.write(page)
+                changed += 1
+
+    with gzip.open(os.path.join(directory, f'{name}.hashes.gz'), 'wb') as f:
+        f.write(b''.join(hashes))
+
+    return {
+        'file': data_file,
+        'file_sha256': _file_sha256(os.path.join(directory, data_file)),
+        'file_bytes': os.path.getsize(os.path.join(directory, data_file)),
+        'page_size': page_size,
+        'page_count': len(hashes),
+        'pages_written': len(hashes) if base_hashes is None else changed,
+        'db_sha256': db_digest.hexdigest(),
+    }
+
+
+def _archive_snapshots(directory, name, previous, config):
+    # Yearly archive files only change when `flask archive run` moves rows,
+    # so unchanged ones point at the copy an earlier backup made
+    copies = {}
+    earlier = (previous or {}).get('archives', {})
+    for year, path in archive_files(config['ARCHIVE_DIR']).items():
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = earlier.get(str(year))
+        if known and known['signature'] == signature:
+            copies[str(year)] = known
+            continue
+
+        scratch = os.path.join(directory, f'.{name}.archive_{year}.db')
+        file_name = f'{name}.archive_{year}.db.gz'
+        try:
+            _online_copy(path, scratch, config)
+            with open(scratch, 'rb') as f, gzip.open(os.path.join(directory, file_name), 'wb', compresslevel=6) as out:
+                shutil.copyfileobj(f, out, _CHUNK)
+            copies[str(year)] = {'file': file_name, 'signature': signature,
+                                 'db_sha256': _file_sha256(scratch),
+                                 'file_sha256': _file_sha256(os.path.join(directory, file_name))}
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+    return copies
+
+
+def _create_sqlite(directory, name, full, config):
+    previous = next((manifest for manifest in reversed(list_backups(directory))
+                     if manifest['kind'] in ('full', 'incremental')), None)
+    if previous and not full:
+        since_full = len(_chain(directory, previous)) - 1
+        full = since_full >= config.get('BACKUP_FULL_EVERY', 6)
+    base_hashes = None
+    if previous and not full:
+        base_hashes = _read_hashes(os.path.join(directory, f"{previous['name']}.hashes.gz"))
+
+    scratch = os.path.join(directory, f'.{name}.db')
+    try:
+        restarts = _online_copy(_sqlite_path(), scratch, config)
+        if base_hashes is not None and _page_size(scratch) != previous['page_size']:
+            # Pages no longer line up (VACUUM with a new page_size)
+            base_hashes = None
+        manifest = _write_snapshot(scratch, directory, name, base_hashes)
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+
+    manifest.update({
+        'kind': 'full' if base_hashes is None else 'incremental',
+        'base': None if base_hashes is None else previous['name'],
+        'restarts': restarts,
+        'archives': _archive_snapshots(directory, name, previous, config),
+    })
+    return manifest
+
+
+# --- PostgreSQL dumps ------------------------------------------------------------
+
+def _run(command, what, env=None):
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, env=env)
+    except FileNotFoundError:
+        raise BackupError(f"{command[0]} was not found; set BACKUP_PG_DUMP / BACKUP_PG_RESTORE")
+    if result.returncode != 0:
+        raise BackupError(f"{what} failed: {result.stderr.strip()[-500:]}")
+    return result.stdout
+
+
+def _create_pg(directory, name, config):
+    data_file = f'{name}.dump'
+    path = os.path.join(directory, data_file)
+    url, env = _pg_target()
+    _run([config.get('BACKUP_PG_DUMP', 'pg_dump'), '--format=custom', '--compress=6',
+          '--file', path, '--dbname', url], 'pg_dump', env)
+    return {
+        'kind': 'pg_dump',
+        'base': None,
+        'file': data_file,
+        'file_sha256': _file_sha256(path),
+        'file_bytes': os.path.getsize(path),
+    }
+
+
+# --- Backup, verify, restore -------------------------------------------------
+
+def create_backup(full=False):
+    """Take a backup of the live database; returns its manifest"""
+    config = current_app.config
+    directory = _backup_dir()
+    kind = 'sqlite' if _sqlite_path() else 'postgresql'
+    started = time.perf_counter()
+
+    with _Lock(directory):
+        name = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        if os.path.exists(_manifest_path(directory, name)):
+            raise BackupError(f"A backup named {name} already exists")
+
+        if kind == 'sqlite':
+            manifest = _create_sqlite(directory, name, full, config)
+        else:
+            manifest = _create_pg(directory, name, config)
+        manifest.update({'name': name, 'database': kind, 'created_at': datetime.utcnow().isoformat()})
+        _write_manifest(directory, manifest)
+        prune_backups(directory, config.get('BACKUP_KEEP_CHAINS', 4))
+
+    log.info("Backup created", extra={
+        'backup': name, 'kind': manifest['kind'], 'bytes': manifest['file_bytes'],
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+    return manifest
+
+
+def _check_file(directory, file_name, expected):
+    path = os.path.join(directory, file_name)
+    if not os.path.exists(path):
+        raise BackupError(f"{file_name} is missing")
+    if _file_sha256(path) != expected:
+        raise BackupError(f"{file_name} does not match its checksum")
+    return path
+
+
+def _rebuild(directory, chain, target_path):
+    # Lay the full copy down, then each increment's pages over it
+    last = chain[-1]
+    with gzip.open(_check_file(directory, chain[0]['file'], chain[0]['file_sha256']), 'rb') as f, \
+            open(target_path, 'wb') as out:
+        shutil.copyfileobj(f, out, _CHUNK)
+
+    with open(target_path, 'r+b') as out:
+        for manifest in chain[1:]:
+            page_size = manifest['page_size']
+            path = _check_file(directory, manifest['file'], manifest['file_sha256'])
+            with gzip.open(path, 'rb') as f:
+                for header in iter(lambda: f.read(_PAGE_RECORD.size), b''):
+                    page_no, = _PAGE_RECORD.unpack(header)
+                    out.seek(page_no * page_size)
+                    out.write(f.read(page_size))
+            out.truncate(manifest['page_count'] * page_size)
+
+    if _file_sha256(target_path) != last['db_sha256']:
+        raise BackupError(f"Backup {last['name']} does not restore to the database it was taken from")
+    _integrity_check(target_path, last['name'])
+
+
+def _integrity_check(path, name):
+    connection = sqlite3.connect(path)
+    try:
+        result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        connection.close()
+    if result != 'ok':
+        raise BackupError(f"Backup {name} fails the integrity check: {result}")
+
+
+def _rebuild_archive(directory, copy, target_path, name):
+    with gzip.open(_check_file(directory, copy['file'], copy['file_sha256']), 'rb') as f, \
+            open(target_path, 'wb') as out:
+        shutil.copyfileobj(f, out, _CHUNK)
+    if _file_sha256(target_path) != copy['db_sha256']:
+        raise BackupError(f"{copy['file']} does not restore to the archive it was taken from")
+    _integrity_check(target_path, name)
+
+
+def _resolve(directory, name):
+    if name:
+        return _load(directory, name)
+    backups = list_backups(directory)
+    if not backups:
+        raise BackupError("There are no backups")
+    return backups[-1]
+
+
+def verify_backup(name=None):
+    """Check a backup's checksums and that it restores to a sound database"""
+    directory = _backup_dir()
+    manifest = _resolve(directory, name)
+
+    if manifest['kind'] == 'pg_dump':
+        path = _check_file(directory, manifest['file'], manifest['file_sha256'])
+        _run([current_app.config.get('BACKUP_PG_RESTORE', 'pg_restore'), '--list', path], 'pg_restore --list')
+        return manifest
+
+    scratch = os.path.join(directory, f".verify-{manifest['name']}.db")
+    try:
+        _rebuild(directory, _chain(directory, manifest), scratch)
+        for year, copy in manifest.get('archives', {}).items():
+            _rebuild_archive(directory, copy, scratch, f"{manifest['name']} archive {year}")
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+    return manifest
+
+
+def restore_backup(name, target=None):
+    """Restore a backup over the live database, or into TARGET (a path or URL)"""
+    config = current_app.config
+    directory = _backup_dir()
+    manifest = _load(directory, name)
+
+    with _Lock(directory):
+        if manifest['kind'] == 'pg_dump':
+            verify_backup(name)
+            url, env = _pg_target(target)
+            _run([config.get('BACKUP_PG_RESTORE', 'pg_restore'), '--clean', '--if-exists', '--no-owner',
+                  '--dbname', url, os.path.join(directory, manifest['file'])], 'pg_restore', env)
+            log.info("Backup restored", extra={'backup': name, 'target': 'database'})
+            return manifest
+
+        scratch = os.path.join(directory, f'.restore-{name}.db')
+        try:
+            _rebuild(directory, _chain(directory, manifest), scratch)
+            if target:
+                shutil.copyfile(scratch, target)
+            else:
+                _copy_into(scratch, _sqlite_path())
+            _restore_archives(directory, manifest, config, scratch, into_live=not target)
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+    if not target:
+        # Pooled connections may hold schema and archive views of the old database
+        db.engine.dispose()
+    log.info("Backup restored", extra={'backup': name, 'target': target or 'database'})
+    return manifest
+
+
+def _copy_into(source_path, target_path):
+    # The backup API replaces the target under its own lock, so connections
+    # that stay open see either the old or the restored database
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path, timeout=30)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def _restore_archives(directory, manifest, config, scratch, into_live):
+    archives = manifest.get('archives', {})
+    if not archives or not into_live:
+        return
+    archive_dir = config['ARCHIVE_DIR']
+    os.makedirs(archive_dir, exist_ok=True)
+    for year, copy in archives.items():
+        _rebuild_archive(directory, copy, scratch, f"{manifest['name']} archive {year}")
+        _copy_into(scratch, os.path.join(archive_dir, f'archive_{year}.db'))
+
+
+def prune_backups(directory=None, keep_chains=4):
+    """Delete all but the newest KEEP_CHAINS full backups and their increments"""
+    directory = directory or _backup_dir()
+    backups = list_backups(directory)
+    fulls = [manifest['name'] for manifest in backups if manifest['kind'] in ('full', 'pg_dump')]
+    kept_fulls = set(fulls[-keep_chains:]) if keep_chains > 0 else set()
+
+    kept, dropped = [], []
+    for manifest in backups:
+        root = _chain(directory, manifest)[0]['name'] if manifest['kind'] == 'incremental' else manifest['name']
+        (kept if root in kept_fulls else dropped).append(manifest)
+
+    for manifest in reversed(dropped):
+        for file_name in (manifest['file'], f"{manifest['name']}.hashes.gz"):
+            path = os.path.join(directory, file_name)
+            if os.path.exists(path):
+                os.remove(path)
+        # The manifest goes last, so an interrupted prune is retried
+        os.remove(_manifest_path(directory, manifest['name']))
+
+    # Archive copies live on as long as a kept backup points at them
+    referenced = {copy['file'] for manifest in kept for copy in manifest.get('archives', {}).values()}
+    for file_name in os.listdir(directory):
+        if '.archive_' in file_name and file_name.endswith('.db.gz') and file_name not in referenced:
+            os.remove(os.path.join(directory, file_name))
+    return len(dropped)
+
+
+@backup_bp.cli.command('create')
+@click.option('--full', is_flag=True, help='Take a full backup even if an incremental one is due')
+def create_command(full):
+    """Back up the database while the app keeps running."""
+    try:
+        manifest = create_backup(full=full)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    print(f"{manifest['name']}: {manifest['kind']} backup, {manifest['file_bytes']} bytes")
+
+
+@backup_bp.cli.command('list')
+def list_command():
+    """List the backups, oldest first."""
+    for manifest in list_backups():
+        base = f" on {manifest['base']}" if manifest.get('base') else ''
+        print(f"{manifest['name']}  {manifest['kind']}{base}  {manifest['file_bytes']} bytes")
+
+
+@backup_bp.cli.command('verify')
+@click.argument('name', required=False)
+def verify_command(name):
+    """Check that backup NAME (default: the newest) restores cleanly."""
+    try:
+        manifest = verify_backup(name)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    print(f"{manifest['name']}: OK")
+
+
+@backup_bp.cli.command('restore')
+@click.argument('name')
+@click.option('--target', help='Restore into this file (SQLite) or database URL instead of the live database')
+@click.confirmation_option(prompt='Replace the database with this backup?')
+def restore_command(name, target):
+    """Verify backup NAME and restore it."""
+    try:
+        restore_backup(name, target)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    print(f"Restored {name} into {target or 'the database'}")
+
+
+@backup_bp.cli.command('prune')
+def prune_command():
+    """Delete backups beyond BACKUP_KEEP_CHAINS full backups."""
+    dropped = prune_backups(keep_chains=current_app.config.get('BACKUP_KEEP_CHAINS', 4))
+    print(f"Deleted {dropped} backups")
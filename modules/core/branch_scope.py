@@ -0,0 +1,205 @@
+"""
+Branch scoping for ORM queries.
+
+Branch managers and sales workers should only ever see their own branch's
+POS orders, sessions, cash registers, stock locations and products. Rather
+than every view remembering to filter (or loading all branches and
+filtering in Python), a do_orm_execute hook adds a
+with_loader_criteria(Model, branch_id == <user's branch>) option to every
+ORM SELECT issued during a request by a non-admin user with a branch. The
+criteria also apply to relationship and joined loads of those models.
+
+Code that legitimately needs every branch (admin reports, CLI commands,
+background jobs) runs outside a request or opts out per query:
+
+    POSOrder.query.execution_options(all_branches=True).all()
+
+Stock locations and products without a branch are shared by all branches
+and stay visible everywhere. A non-admin user without a branch is scoped to
+NO_BRANCH and sees only those shared rows.
+
+The model classes predate branch scoping, so init_app declares branch_id on
+any of them that lacks it once migrations/add_branch_scope_indexes.py has
+added the column to its table. That happens at startup only: restart every
+worker after running the migration. New POS sessions take the branch of
+their cash register and new orders the branch of their session. Raw SQL that
+reads branch_id goes through branch_column(), which gives NULL instead of
+failing while the migration has not run and notices the new column within
+BRANCH_COLUMN_RECHECK seconds.
+"""
+import importlib
+import time
+
+from flask import g, has_request_context
+from flask_login import current_user
+from sqlalchemy import event, inspect, or_, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import with_loader_criteria
+
+from extensions import db
+from modules.core.structured_logging import get_logger
+
+log = get_logger('auth')
+
+# (module, model, rows without a branch are shared)
+SCOPED_MODELS = (
+    ('modules.pos.models', 'POSOrder', False),
+    ('modules.pos.models', 'POSSession', False),
+    ('modules.pos.models', 'POSCashRegister', False),
+    ('modules.inventory.models', 'StockLocation', True),
+    ('modules.inventory.models', 'Product', True),
+)
+
+# Models that carry a branch without being scoped by it
+BRANCH_MODELS = SCOPED_MODELS + (
+    ('modules.auth.models', 'User', False),
+)
+
+# (module, model, column holding the parent, parent table): new rows
+# without a branch take their parent's
+INHERITED_BRANCHES = (
+    ('modules.pos.models', 'POSSession', 'cash_register_id', 'pos_cash_registers'),
+    ('modules.pos.models', 'POSOrder', 'session_id', 'pos_sessions'),
+)
+
+# Users with any of these roles see every branch
+UNSCOPED_ROLES = ('Admin',)
+
+# Execution option that switches scoping off for one query
+ALL_BRANCHES = 'all_branches'
+
+# Scope of a branch user without a branch: no branch has this id, so they
+# only see rows shared by every branch
+NO_BRANCH = -1
+
+# Seconds before a table found without branch_id is inspected again
+BRANCH_COLUMN_RECHECK = 60
+
+_scoped = []
+
+# table -> (whether it has a branch_id column, when that was checked), per process
+_branch_columns = {}
+
+# model -> (parent column, parent table) for INHERITED_BRANCHES
+_inherited = {}
+
+
+def branch_id_for(user):
+    """Branch a user belongs to, or None when they are not tied to a branch"""
+    return getattr(user, 'branch_id', None) or None
+
+
+def current_branch_id():
+    """Branch the current request is scoped to, or None for unscoped requests.
+
+    Non-admin users without a branch get NO_BRANCH rather than every branch.
+    """
+    if not has_request_context():
+        return None
+
+    if '_branch_scope' not in g:
+        # Loading the user and their roles runs ORM queries of its own, which
+        # come back through the hook; they see the placeholder and run unscoped
+        g._branch_scope = None
+        if current_user and current_user.is_authenticated and \
+                not any(current_user.has_role(role) for role in UNSCOPED_ROLES):
+            g._branch_scope = branch_id_for(current_user) or NO_BRANCH
+    return g._branch_scope
+
+
+def _criteria(branch_id, shared):
+    # branch_id is a closure variable, so the cached statement takes it as a
+    # bound parameter instead of baking in the first branch it saw
+    if shared:
+        return lambda cls: or_(cls.branch_id == branch_id, cls.branch_id.is_(None))
+    return lambda cls: cls.branch_id == branch_id
+
+
+def _scope_query(orm_execute_state):
+    if (not orm_execute_state.is_select
+            or orm_execute_state.is_column_load
+            or orm_execute_state.is_relationship_load
+            or orm_execute_state.execution_options.get(ALL_BRANCHES)):
+        return
+
+    branch_id = current_branch_id() if _scoped else None
+    if branch_id is None:
+        return
+
+    orm_execute_state.statement = orm_execute_state.statement.options(*[
+        with_loader_criteria(model, _criteria(branch_id, shared), include_aliases=True)
+        for model, shared in _scoped
+    ])
+
+
+def has_branch_column(connection, table):
+    """Whether table has a branch_id column yet.
+
+    A column once found is remembered for the process; a missing one is
+    looked for again after BRANCH_COLUMN_RECHECK seconds.
+    """
+    found, checked_at = _branch_columns.get(table, (False, None))
+    if not found and (checked_at is None or time.monotonic() - checked_at > BRANCH_COLUMN_RECHECK):
+        found = 'branch_id' in {column['name'] for column in inspect(connection).get_columns(table)}
+        _branch_columns[table] = (found, time.monotonic())
+    return found
+
+
+def branch_column(connection, table, alias):
+    """SQL for alias.branch_id, or NULL while table has no branch_id column"""
+    return f'{alias}.branch_id' if has_branch_column(connection, table) else 'NULL'
+
+
+def _declare_branch_columns(connection):
+    # Once the migration has added the column, models without it get one
+    for module_name, model_name, shared in BRANCH_MODELS:
+        model = getattr(importlib.import_module(module_name), model_name)
+        if 'branch_id' not in model.__table__.c and has_branch_column(connection, model.__table__.name):
+            model.branch_id = db.Column(db.Integer)
+
+
+def _set_inherited_branch(mapper, connection, target):
+    column, parent_table = _inherited[mapper.class_]
+    parent_id = getattr(target, column)
+    if target.branch_id is None and parent_id is not None:
+        target.branch_id = connection.execute(
+            text(f"SELECT branch_id FROM {parent_table} WHERE id = :id"), {'id': parent_id}).scalar()
+
+
+def _register_branch_inheritance():
+    for module_name, model_name, column, parent_table in INHERITED_BRANCHES:
+        model = getattr(importlib.import_module(module_name), model_name)
+        if 'branch_id' not in model.__table__.c:
+            continue
+        _inherited[model] = (column, parent_table)
+        if not event.contains(model, 'before_insert', _set_inherited_branch):
+            event.listen(model, 'before_insert', _set_inherited_branch)
+
+
+def _load_scoped_models():
+    models = []
+    for module_name, model_name, shared in SCOPED_MODELS:
+        model = getattr(importlib.import_module(module_name), model_name)
+        if 'branch_id' not in model.__table__.c:
+            log.warning("Branch scoping skipped: model has no branch_id column",
+                        extra={'model': model_name})
+            continue
+        models.append((model, shared))
+    return models
+
+
+def init_app(app):
+    """Declare branch columns and scope ORM queries to the current user's branch"""
+    try:
+        with app.app_context(), db.engine.connect() as connection:
+            _declare_branch_columns(connection)
+    except SQLAlchemyError as e:
+        log.warning("Branch columns not checked: database unavailable", extra={'error': str(e)})
+    _register_branch_inheritance()
+
+    if not app.config.get('BRANCH_SCOPING', True):
+        return
+
+    _scoped[:] = _load_scoped_models()
+    if not event.contains(db.session, 'do_orm_execute', _scope_query):
+        event.listen(db.session, 'do_orm_execute', _scope_query)
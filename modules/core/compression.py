@@ -0,0 +1,187 @@
+"""
+Response compression, ETags and cache headers.
+
+Branches on slow mobile links used to download the full POS page, the
+dashboard HTML and every static JS/CSS file on each visit. An after_request
+hook now does three things:
+
+- GET responses from pages and JSON APIs get a weak ETag computed from the
+  body. A matching If-None-Match is answered with an empty 304. Pages are
+  marked ``private, no-cache``, so browsers keep them but revalidate first.
+- url_for('static', ...) adds a content fingerprint (?v=<hash>) to asset
+  URLs. A request carrying the current fingerprint is cached for a year as
+  immutable. Changing the file changes the URL.
+- Text responses above COMPRESS_MIN_SIZE are Brotli or gzip compressed,
+  depending on the client's Accept-Encoding. Static assets are compressed
+  once at the highest level and kept in memory.
+
+Streamed responses (CSV exports, NDJSON) are passed through untouched.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pinned in requirements.txt; without it only gzip is offered
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+)
+
+# Dynamic responses favour speed, static assets are compressed once and cached
+DYNAMIC_LEVELS = {'br': 5, 'gzip': 6}
+STATIC_LEVELS = {'br': 11, 'gzip': 9}
+
+# Compressed static assets kept in memory, most recently used last
+STATIC_CACHE_ENTRIES = 256
+
+_fingerprints = {}
+_static_cache = OrderedDict()
+_static_lock = threading.Lock()
+
+
+def init_app(app):
+    """Compress, ETag and cache-header every response of the app"""
+    app.url_defaults(_add_static_fingerprint)
+    app.after_request(_finalize_response)
+
+
+def _is_static(endpoint):
+    return endpoint is not None and (endpoint == 'static' or endpoint.endswith('.static'))
+
+
+def _static_folder(app, endpoint):
+    if endpoint == 'static':
+        return app.static_folder
+    blueprint = app.blueprints.get(endpoint.rsplit('.', 1)[0])
+    return blueprint.static_folder if blueprint else None
+
+
+def static_fingerprint(folder, filename):
+    """Short hash of a static file's content, recomputed when the file changes"""
+    path = os.path.join(folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    cached = _fingerprints.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()[:12]
+    _fingerprints[path] = (mtime, digest)
+    return digest
+
+
+def _add_static_fingerprint(endpoint, values):
+    if not _is_static(endpoint) or 'v' in values or not values.get('filename'):
+        return
+    folder = _static_folder(current_app, endpoint)
+    fingerprint = static_fingerprint(folder, values['filename']) if folder else None
+    if fingerprint:
+        values['v'] = fingerprint
+
+
+def _accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compressed_static(response, encoding):
+    key = (request.path, response.get_etag()[0], encoding)
+    with _static_lock:
+        if key in _static_cache:
+            _static_cache.move_to_end(key)
+            return _static_cache[key]
+
+    body = _compress(response.get_data(), encoding, STATIC_LEVELS[encoding])
+    with _static_lock:
+        _static_cache[key] = body
+        while len(_static_cache) > STATIC_CACHE_ENTRIES:
+            _static_cache.popitem(last=False)
+    return body
+
+
+def _set_cache_headers(response, static):
+    if static:
+        folder = _static_folder(current_app, request.endpoint)
+        fingerprint = request.args.get('v')
+        if fingerprint and folder and fingerprint == static_fingerprint(folder, request.view_args['filename']):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = current_app.config.get('STATIC_MAX_AGE', 31536000)
+            response.cache_control.immutable = True
+            response.expires = None
+        return
+
+    if 'Cache-Control' not in response.headers:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+
+def _finalize_response(response):
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+        return response
+
+    static = _is_static(request.endpoint)
+    _set_cache_headers(response, static)
+
+    # Static files already carry a strong ETag and are conditional
+    if not static:
+        if response.is_streamed:
+            return response
+        response.add_etag(weak=True)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if 'Content-Encoding' in response.headers or not response.mimetype.startswith(COMPRESSIBLE_TYPES):
+        return response
+    if response.content_length is not None and response.content_length < current_app.config.get('COMPRESS_MIN_SIZE', 1024):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+
+    if static:
+        # Static files are sent as a file wrapper; read them so they can be encoded
+        response.direct_passthrough = False
+        close = getattr(response.response, 'close', None)
+        if close is not None:
+            response.call_on_close(close)
+        body = _compressed_static(response, encoding)
+    else:
+        body = _compress(response.get_data(), encoding, DYNAMIC_LEVELS[encoding])
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if static:
+        # The same validator now covers the plain and encoded bodies
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,545 @@
+"""
+Bulk copy of a SQLite branch database into PostgreSQL.
+
+Branches were moved to Cloud SQL by scripts (cloud_db_fix.py,
+fix_cloud_db_direct.py, update_cloud_roles.py) that recreated rows through
+the ORM, one INSERT at a time, which took hours for a large branch. `flask
+db-copy run SOURCE` copies the data in minutes:
+
+- The target schema comes from the models: --create-schema runs
+  db.create_all() against the target first (the app ships no Alembic
+  environment, so `flask db upgrade` has nothing to apply). Tables that only
+  the scripts in migrations/ create must be added by running those scripts
+  with DATABASE_URL pointing at the target. The target's foreign keys order
+  the tables into levels. A table is only copied after
+  the tables it references, and the tables of one level are copied in
+  parallel by DB_COPY_JOBS worker processes. Foreign keys that form a
+  cycle are dropped for the copy and added back afterwards.
+- Each table is read from SQLite DB_COPY_CHUNK_SIZE rows at a time and
+  streamed into one COPY ... FROM STDIN, converting values to the target
+  column types (0/1 to booleans, ISO strings to timestamps, ...).
+- Sequences are then set past the highest copied id.
+- Every table is verified: the row count and an order-independent checksum
+  of the converted rows must match on both sides.
+
+Columns that only exist in SQLite, and tables the target does not have, are
+reported and skipped. The target tables must be empty, unless --truncate is
+given. `flask db-copy verify SOURCE` repeats the verification on its own.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time as dt_time, timezone
+from decimal import Decimal, InvalidOperation
+
+import click
+from flask import Blueprint, current_app
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from modules.core.pdf_rendering import process_pool_context
+from modules.core.structured_logging import get_logger
+
+db_copy_bp = Blueprint('db_copy', __name__, cli_group='db-copy')
+
+log = get_logger('db_copy')
+
+# Alembic's revision stamp, if either side was ever stamped by hand: it
+# describes that database's schema, not data to carry across
+SKIPPED_TABLES = ('alembic_version',)
+
+_INTEGER_TYPES = ('smallint', 'integer', 'bigint')
+_FLOAT_TYPES = ('real', 'double precision')
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_CHECKSUM_MOD = 2 ** 64
+
+
+class CopyError(Exception):
+    """Raised when the data cannot be copied or does not verify"""
+
+
+def _pg_dsn(url):
+    return make_url(url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+def _connect_target(dsn):
+    import psycopg2
+
+    return psycopg2.connect(dsn)
+
+
+def _connect_source(path):
+    if not os.path.exists(path):
+        raise CopyError(f"SQLite database {path} does not exist")
+    return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# --- Values -----------------------------------------------------------------
+
+def _parse(value, data_type):
+    """A SQLite value as the Python value of the target column type"""
+    if value is None:
+        return None
+    if data_type == 'boolean':
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 't', 'true', 'y', 'yes')
+        return bool(value)
+    if data_type in _INTEGER_TYPES:
+        return value if isinstance(value, int) else int(Decimal(str(value)))
+    if data_type in _FLOAT_TYPES:
+        return float(value)
+    if data_type == 'numeric':
+        return Decimal(str(value))
+    if data_type.startswith('timestamp'):
+        return datetime.fromisoformat(value) if isinstance(value, str) else value
+    if data_type == 'date':
+        return date.fromisoformat(value[:10]) if isinstance(value, str) else value
+    if data_type.startswith('time'):
+        return dt_time.fromisoformat(value) if isinstance(value, str) else value
+    if data_type == 'bytea':
+        return value.encode() if isinstance(value, str) else bytes(value)
+    if data_type in ('json', 'jsonb'):
+        return json.loads(value) if isinstance(value, str) else value
+    return value if isinstance(value, str) else str(value)
+
+
+def _text(value, data_type):
+    # Canonical text of a typed value, the same whichever side it came from
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        # real keeps about 6 significant digits
+        return format(value, '.6g') if data_type == 'real' else repr(value)
+    if isinstance(value, Decimal):
+        return format(value.normalize(), 'f')
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(' ')
+    if isinstance(value, (date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return str(value)
+
+
+def _row_hash(texts):
+    digest = hashlib.blake2b('\x1f'.join(texts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class _CopyStream:
+    """File-like COPY text of a SQLite cursor, fetched a chunk at a time"""
+
+    def __init__(self, cursor, table, columns, chunk_size):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.done = False
+        self.rows = 0
+        self.checksum = 0
+
+    def _fill(self):
+        rows = self.cursor.fetchmany(self.chunk_size)
+        if not rows:
+            self.done = True
+            return
+        lines = []
+        for row in rows:
+            texts = []
+            for (name, data_type), value in zip(self.columns, row):
+                try:
+                    texts.append(_text(_parse(value, data_type), data_type))
+                except (ValueError, TypeError, InvalidOperation):
+                    raise CopyError(f"{self.table}.{name}: cannot convert {value!r} to {data_type}")
+            self.checksum = (self.checksum + _row_hash(texts)) % _CHECKSUM_MOD
+            lines.append('\t'.join('\\N' if value is None else text.translate(_COPY_ESCAPES)
+                                   for value, text in zip(row, texts)))
+        self.rows += len(rows)
+        self.buffer += '\n'.join(lines) + '\n'
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+# --- Schema -------------------------------------------------------------------
+
+def _target_columns(target):
+    columns = {}
+    with target.cursor() as cursor:
+        cursor.execute("""
+            SELECT table_name, column_name, data_type FROM information_schema.columns
+            WHERE table_schema = current_schema()
+            ORDER BY table_name, ordinal_position
+        """)
+        for table, column, data_type in cursor.fetchall():
+            columns.setdefault(table, []).append((column, data_type))
+    return columns
+
+
+def _foreign_keys(target):
+    # (constraint, child table, parent table, definition)
+    with target.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.conname, child.relname, parent.relname, pg_get_constraintdef(c.oid)
+            FROM pg_constraint c
+            JOIN pg_class child ON child.oid = c.conrelid
+            JOIN pg_class parent ON parent.oid = c.confrelid
+            JOIN pg_namespace n ON n.oid = child.relnamespace
+            WHERE c.contype = 'f' AND n.nspname = current_schema()
+        """)
+        return cursor.fetchall()
+
+
+def _reaches(edges, start, goal):
+    seen, stack = {start}, [start]
+    while stack:
+        table = stack.pop()
+        if table == goal:
+            return True
+        for parent in edges.get(table, ()):
+            if parent not in seen:
+                seen.add(parent)
+                stack.append(parent)
+    return False
+
+
+def copy_levels(tables, foreign_keys):
+    """Tables grouped so that each level only references earlier levels.
+
+    Foreign keys that close a cycle (departments.manager_id and
+    employees.department_id, say) cannot be satisfied by any order. They are
+    returned separately, to be dropped for the copy and added back after.
+    """
+    edges = {}
+    for _, child, parent, _ in foreign_keys:
+        if child in tables and parent in tables and child != parent:
+            edges.setdefault(child, set()).add(parent)
+    cyclic = [key for key in foreign_keys
+              if key[1] in tables and key[2] in tables and key[1] != key[2] and _reaches(edges, key[2], key[1])]
+
+    deferred = {(child, parent) for _, child, parent, _ in cyclic}
+    parents = {table: edges.get(table, set()) - {parent for child, parent in deferred if child == table}
+               for table in tables}
+
+    levels, placed, remaining = [], set(), set(tables)
+    while remaining:
+        level = sorted(table for table in remaining if parents[table] <= placed)
+        levels.append(level)
+        placed.update(level)
+        remaining.difference_update(level)
+    return levels, cyclic
+
+
+def create_schema(dsn):
+    """Create the model tables missing from the target, as db.create_all() does"""
+    from extensions import db
+
+    engine = create_engine(dsn)
+    try:
+        before = set(db.inspect(engine).get_table_names())
+        db.metadata.create_all(engine)
+        return sorted(set(db.inspect(engine).get_table_names()) - before)
+    finally:
+        engine.dispose()
+
+
+def _source_tables(source):
+    return [row[0] for row in source.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+
+def _source_columns(source, table):
+    return [row[1] for row in source.execute(f'PRAGMA table_info({_quote(table)})')]
+
+
+def plan_copy(source_path, dsn, tables=None):
+    """What to copy: {table: [(column, type)]} of the shared columns, levels, cyclic keys and skips"""
+    source = _connect_source(source_path)
+    target = _connect_target(dsn)
+    try:
+        target_columns = _target_columns(target)
+        foreign_keys = _foreign_keys(target)
+        plan, skipped = {}, []
+        for table in tables or _source_tables(source):
+            if table in SKIPPED_TABLES:
+                continue
+            if table not in target_columns:
+                skipped.append(f"table {table}")
+                continue
+            source_columns = set(_source_columns(source, table))
+            shared = [(name, data_type) for name, data_type in target_columns[table] if name in source_columns]
+            if not shared:
+                skipped.append(f"table {table} (no shared columns)")
+                continue
+            plan[table] = shared
+            target_names = {name for name, _ in target_columns[table]}
+            skipped.extend(f"column {table}.{name}" for name in sorted(source_columns - target_names))
+    finally:
+        source.close()
+        target.close()
+    levels, cyclic = copy_levels(plan, foreign_keys)
+    return plan, levels, cyclic, skipped
+
+
+# --- Copy and verify ----------------------------------------------------------
+
+def _copy_table(source_path, dsn, table, columns, chunk_size):
+    # Runs in a worker process, with its own connections
+    started = time.perf_counter()
+    source = _connect_source(source_path)
+    target = _connect_target(dsn)
+    try:
+        column_sql = ', '.join(_quote(name) for name, _ in columns)
+        stream = _CopyStream(source.execute(f'SELECT {column_sql} FROM {_quote(table)}'),
+                             table, columns, chunk_size)
+        with target.cursor() as cursor:
+            cursor.copy_expert(f'COPY {_quote(table)} ({column_sql}) FROM STDIN', stream)
+        target.commit()
+    except CopyError:
+        target.rollback()
+        raise
+    except Exception as e:
+        target.rollback()
+        # Driver errors do not always survive the trip back from the worker
+        raise CopyError(f"{table}: {e}")
+    finally:
+        source.close()
+        target.close()
+    return table, stream.rows, stream.checksum, time.perf_counter() - started
+
+
+def _target_checksum(dsn, table, columns, chunk_size):
+    target = _connect_target(dsn)
+    try:
+        column_sql = ', '.join(_quote(name) for name, _ in columns)
+        rows, checksum = 0, 0
+        # A named cursor streams the table instead of loading it whole
+        with target.cursor(name=f'verify_{table}') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(f'SELECT {column_sql} FROM {_quote(table)}')
+            for row in cursor:
+                texts = [_text(value, data_type) for (_, data_type), value in zip(columns, row)]
+                checksum = (checksum + _row_hash(texts)) % _CHECKSUM_MOD
+                rows += 1
+        target.rollback()
+    finally:
+        target.close()
+    return table, rows, checksum
+
+
+def _source_checksum(source_path, table, columns, chunk_size):
+    source = _connect_source(source_path)
+    try:
+        column_sql = ', '.join(_quote(name) for name, _ in columns)
+        stream = _CopyStream(source.execute(f'SELECT {column_sql} FROM {_quote(table)}'),
+                             table, columns, chunk_size)
+        while not stream.done:
+            stream._fill()
+            stream.buffer = ''
+    finally:
+        source.close()
+    return table, stream.rows, stream.checksum
+
+
+def _prepare_target(dsn, tables, truncate):
+    target = _connect_target(dsn)
+    try:
+        with target.cursor() as cursor:
+            if truncate:
+                cursor.execute(f"TRUNCATE {', '.join(_quote(table) for table in tables)} RESTART IDENTITY CASCADE")
+            else:
+                filled = []
+                for table in tables:
+                    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {_quote(table)})')
+                    if cursor.fetchone()[0]:
+                        filled.append(table)
+                if filled:
+                    raise CopyError(f"Target tables are not empty: {', '.join(filled)} (use --truncate)")
+        target.commit()
+    finally:
+        target.close()
+
+
+def _drop_constraints(dsn, constraints):
+    target = _connect_target(dsn)
+    try:
+        with target.cursor() as cursor:
+            for name, child, _, _ in constraints:
+                cursor.execute(f'ALTER TABLE {_quote(child)} DROP CONSTRAINT {_quote(name)}')
+        target.commit()
+    finally:
+        target.close()
+
+
+def _add_constraints(dsn, constraints):
+    # Adding a constraint checks every row at once, as pg_restore does
+    failed = []
+    target = _connect_target(dsn)
+    try:
+        for name, child, _, definition in constraints:
+            try:
+                with target.cursor() as cursor:
+                    cursor.execute(f'ALTER TABLE {_quote(child)} ADD CONSTRAINT {_quote(name)} {definition}')
+                target.commit()
+            except Exception as e:
+                target.rollback()
+                failed.append(f"{child}.{name}: {str(e).splitlines()[0]}")
+    finally:
+        target.close()
+    if failed:
+        raise CopyError("Data copied, but these foreign keys could not be restored: " + '; '.join(failed))
+
+
+def _reset_sequences(dsn, tables):
+    target = _connect_target(dsn)
+    try:
+        with target.cursor() as cursor:
+            cursor.execute("""
+                SELECT table_name, column_name, pg_get_serial_sequence(quote_ident(table_name), column_name)
+                FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                  AND (column_default LIKE 'nextval(%' OR is_identity = 'YES')
+            """)
+            for table, column, sequence in cursor.fetchall():
+                if table in tables and sequence:
+                    cursor.execute(f"SELECT setval(%s, COALESCE((SELECT MAX({_quote(column)}) FROM {_quote(table)}), 0) + 1, false)",
+                                   (sequence,))
+        target.commit()
+    finally:
+        target.close()
+
+
+def _mismatches(expected, actual):
+    return [f"{table}: {expected[table][0]} rows in SQLite, {actual[table][0]} in PostgreSQL"
+            if expected[table][0] != actual[table][0] else f"{table}: checksums differ"
+            for table in sorted(expected) if expected[table] != actual.get(table)]
+
+
+def run_copy(source_path, dsn, tables=None, jobs=None, chunk_size=None, truncate=False):
+    """Copy SOURCE_PATH into the PostgreSQL database DSN; returns {table: rows}"""
+    config = current_app.config
+    jobs = jobs or config.get('DB_COPY_JOBS', 4)
+    chunk_size = chunk_size or config.get('DB_COPY_CHUNK_SIZE', 5000)
+    started = time.perf_counter()
+
+    plan, levels, cyclic, skipped = plan_copy(source_path, dsn, tables)
+    for item in skipped:
+        log.warning("Not in the target schema, skipped", extra={'item': item})
+    _prepare_target(dsn, list(plan), truncate)
+    _drop_constraints(dsn, cyclic)
+
+    copied, expected = {}, {}
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=process_pool_context()) as executor:
+        try:
+            for number, level in enumerate(levels, 1):
+                futures = [executor.submit(_copy_table, source_path, dsn, table, plan[table], chunk_size)
+                           for table in level]
+                for future in futures:
+                    table, rows, checksum, seconds = future.result()
+                    copied[table] = rows
+                    expected[table] = (rows, checksum)
+                    log.info("Table copied", extra={
+                        'table': table, 'level': number, 'rows': rows,
+                        'rows_per_second': round(rows / seconds) if seconds else rows})
+        except Exception:
+            # Leave the schema as it was, even when the copy is incomplete
+            try:
+                _add_constraints(dsn, cyclic)
+            except CopyError as e:
+                log.error("Foreign keys not restored", extra={'error': str(e)})
+            raise
+        _add_constraints(dsn, cyclic)
+        _reset_sequences(dsn, set(plan))
+
+        futures = [executor.submit(_target_checksum, dsn, table, plan[table], chunk_size) for table in plan]
+        actual = {table: (rows, checksum) for table, rows, checksum in (future.result() for future in futures)}
+
+    problems = _mismatches(expected, actual)
+    if problems:
+        raise CopyError("Copy does not verify: " + '; '.join(problems))
+    log.info("Database copied", extra={
+        'tables': len(copied), 'rows': sum(copied.values()),
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+    return copied
+
+
+def verify_copy(source_path, dsn, tables=None, jobs=None, chunk_size=None):
+    """Compare row counts and checksums of SOURCE_PATH and DSN; returns the mismatches"""
+    config = current_app.config
+    jobs = jobs or config.get('DB_COPY_JOBS', 4)
+    chunk_size = chunk_size or config.get('DB_COPY_CHUNK_SIZE', 5000)
+
+    plan = plan_copy(source_path, dsn, tables)[0]
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=process_pool_context()) as executor:
+        source_futures = [executor.submit(_source_checksum, source_path, table, plan[table], chunk_size)
+                          for table in plan]
+        target_futures = [executor.submit(_target_checksum, dsn, table, plan[table], chunk_size)
+                          for table in plan]
+        expected = {table: (rows, checksum) for table, rows, checksum in (f.result() for f in source_futures)}
+        actual = {table: (rows, checksum) for table, rows, checksum in (f.result() for f in target_futures)}
+    return _mismatches(expected, actual)
+
+
+def _target_option(target):
+    url = target or current_app.config['SQLALCHEMY_DATABASE_URI']
+    if make_url(url).get_backend_name() != 'postgresql':
+        raise click.ClickException("The target must be a PostgreSQL database (--target or DATABASE_URL)")
+    return _pg_dsn(url)
+
+
+@db_copy_bp.cli.command('run')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.option('--target', help='PostgreSQL URL (default: the app database)')
+@click.option('--tables', help='Comma-separated tables to copy (default: all)')
+@click.option('--jobs', type=int, help='Tables copied in parallel (default DB_COPY_JOBS)')
+@click.option('--chunk-size', type=int, help='SQLite rows read per fetch (default DB_COPY_CHUNK_SIZE)')
+@click.option('--truncate', is_flag=True, help='Empty the target tables first')
+@click.option('--create-schema', 'create_tables', is_flag=True, help='Create the missing model tables in the target first')
+def run_command(source, target, tables, jobs, chunk_size, truncate, create_tables):
+    """Copy the SQLite database SOURCE into PostgreSQL and verify it."""
+    dsn = _target_option(target)
+    try:
+        if create_tables:
+            created = create_schema(dsn)
+            print(f"Created {len(created)} tables in the target")
+        copied = run_copy(source, dsn, tables.split(',') if tables else None, jobs, chunk_size, truncate)
+    except CopyError as e:
+        raise click.ClickException(str(e))
+    print(f"Copied and verified {sum(copied.values())} rows in {len(copied)} tables")
+
+
+@db_copy_bp.cli.command('verify')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.option('--target', help='PostgreSQL URL (default: the app database)')
+@click.option('--tables', help='Comma-separated tables to check (default: all)')
+def verify_command(source, target, tables):
+    """Compare the SQLite database SOURCE with its PostgreSQL copy."""
+    dsn = _target_option(target)
+    try:
+        problems = verify_copy(source, dsn, tables.split(',') if tables else None)
+    except CopyError as e:
+        raise click.ClickException(str(e))
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise click.ClickException(f"{len(problems)} tables differ")
+    print("All tables match")
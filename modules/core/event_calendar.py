@@ -0,0 +1,307 @@
+"""
+Branch calendar: date-range queries, recurring events and iCal export.
+
+The events page used to load every event. The calendar now asks for one
+window at a time (a month or a week). One-off events in the window are
+found through the indexes on events.date and events.end_date. Recurring
+events keep their first occurrence in events and an RRULE in
+event_recurrences. Only the rules still active in the window are read, and
+they are expanded into occurrences for that window alone.
+
+The iCal feed streams events in batches and publishes recurring events
+with their RRULE, leaving expansion to the calendar client.
+"""
+import calendar
+from datetime import date, datetime, time, timedelta
+
+from dateutil.rrule import rrulestr
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from flask_login import login_required
+from sqlalchemy import text
+
+from extensions import db
+from modules.core.structured_logging import get_logger
+
+calendar_bp = Blueprint('event_calendar', __name__, cli_group='events')
+
+log = get_logger('main')
+
+# Longest window a single range request may expand
+MAX_RANGE_DAYS = 400
+
+# Events streamed per database round trip in the iCal export
+ICAL_BATCH_SIZE = 500
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+
+_EVENT_COLUMNS = """
+    e.id, e.title, e.description, e.date, e.end_date, e.location, e.event_type, e.created_by
+"""
+
+
+class RecurrenceError(ValueError):
+    """Raised for repeat rules that cannot be parsed"""
+
+
+def _parse_rule(rule, start):
+    try:
+        return rrulestr(rule, dtstart=start)
+    except (ValueError, TypeError) as e:
+        raise RecurrenceError(f'Invalid repeat rule {rule!r}: {e}')
+
+
+def build_rule(frequency, until=None, interval=1):
+    """RRULE for the event form's repeat options (frequency name and end date)"""
+    frequency = (frequency or '').upper()
+    if frequency not in FREQUENCIES:
+        raise RecurrenceError(f'Unknown repeat frequency {frequency!r}')
+    rule = f'FREQ={frequency}'
+    if interval and int(interval) > 1:
+        rule += f';INTERVAL={int(interval)}'
+    if until:
+        rule += ';UNTIL=' + datetime.combine(until, time(23, 59, 59)).strftime('%Y%m%dT%H%M%S')
+    return rule
+
+
+def set_recurrence(event_id, event_start, rule):
+    """Create, replace or (rule=None) remove an event's repeat rule; does not commit"""
+    if not rule:
+        db.session.execute(text("DELETE FROM event_recurrences WHERE event_id = :id"), {'id': event_id})
+        return
+
+    parsed = _parse_rule(rule, event_start)
+    # dateutil keeps UNTIL/COUNT on the rule; open-ended rules have no last occurrence
+    until = parsed._until
+    if until is None and parsed._count:
+        until = list(parsed)[-1]
+
+    db.session.execute(text("""
+        INSERT INTO event_recurrences (event_id, rule, until, created_at)
+        VALUES (:event_id, :rule, :until, :now)
+        ON CONFLICT (event_id) DO UPDATE SET rule = excluded.rule, until = excluded.until
+    """), {'event_id': event_id, 'rule': rule, 'until': until, 'now': datetime.utcnow()})
+
+
+def _occurrence(row, start, end, recurring=False, rule=None):
+    return {
+        'id': row.id,
+        'occurrence_id': f'{row.id}-{start:%Y%m%dT%H%M}' if recurring else str(row.id),
+        'title': row.title,
+        'description': row.description,
+        'start': start.isoformat(),
+        'end': end.isoformat() if end else None,
+        'location': row.location,
+        'event_type': row.event_type,
+        'created_by': row.created_by,
+        'recurring': recurring,
+        'rule': rule,
+    }
+
+
+def events_in_range(start, end):
+    """Every occurrence overlapping [start, end), recurring events expanded, in start order"""
+    if end <= start:
+        return []
+
+    # One-off events: starting in the window, or started earlier and still running
+    singles = db.session.execute(text(f"""
+        SELECT {_EVENT_COLUMNS} FROM events e
+        WHERE e.date >= :start AND e.date < :end
+          AND NOT EXISTS (SELECT 1 FROM event_recurrences r WHERE r.event_id = e.id)
+        UNION ALL
+        SELECT {_EVENT_COLUMNS} FROM events e
+        WHERE e.end_date >= :start AND e.date < :start
+          AND NOT EXISTS (SELECT 1 FROM event_recurrences r WHERE r.event_id = e.id)
+    """).columns(date=db.DateTime, end_date=db.DateTime), {'start': start, 'end': end})
+    occurrences = [_occurrence(row, row.date, row.end_date) for row in singles]
+
+    recurring = db.session.execute(text(f"""
+        SELECT {_EVENT_COLUMNS}, r.rule FROM event_recurrences r
+        JOIN events e ON e.id = r.event_id
+        WHERE e.date < :end AND (r.until IS NULL OR r.until >= :start)
+    """).columns(date=db.DateTime, end_date=db.DateTime), {'start': start, 'end': end})
+    for row in recurring:
+        duration = row.end_date - row.date if row.end_date else timedelta(0)
+        try:
+            rule = _parse_rule(row.rule, row.date)
+        except RecurrenceError as e:
+            log.warning("Skipping event with a bad repeat rule", extra={'event_id': row.id, 'error': str(e)})
+            continue
+        # Occurrences that began before the window but still overlap it count too
+        for occurrence_start in rule.between(start - duration, end, inc=True):
+            occurrence_end = occurrence_start + duration
+            if occurrence_start < end and (occurrence_end > start or occurrence_start >= start):
+                occurrences.append(_occurrence(
+                    row, occurrence_start, occurrence_end if row.end_date else None, True, row.rule))
+
+    occurrences.sort(key=lambda occurrence: (occurrence['start'], occurrence['id']))
+    return occurrences
+
+
+def window(view, anchor):
+    """[start, end) of the month or week (Monday first) containing anchor"""
+    if view == 'week':
+        start = anchor - timedelta(days=anchor.weekday())
+        end = start + timedelta(days=7)
+    elif view == 'month':
+        start = anchor.replace(day=1)
+        end = start + timedelta(days=calendar.monthrange(start.year, start.month)[1])
+    else:
+        raise ValueError(f'Unknown calendar view {view!r}')
+    return datetime.combine(start, time.min), datetime.combine(end, time.min)
+
+
+def _request_window():
+    # Either ?start=&end= (end exclusive) or ?view=month|week&date=
+    if request.args.get('start'):
+        start = datetime.combine(date.fromisoformat(request.args['start']), time.min)
+        end_arg = request.args.get('end')
+        end = datetime.combine(date.fromisoformat(end_arg), time.min) if end_arg else start + timedelta(days=31)
+        return start, end
+
+    anchor = request.args.get('date')
+    anchor = date.fromisoformat(anchor) if anchor else datetime.utcnow().date()
+    return window(request.args.get('view', 'month'), anchor)
+
+
+@calendar_bp.route('/events/range')
+@login_required
+def events_range():
+    """Calendar occurrences for ?view=month|week&date=YYYY-MM-DD or ?start=&end="""
+    try:
+        start, end = _request_window()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid calendar window: {e}'}), 400
+    if (end - start).days > MAX_RANGE_DAYS:
+        return jsonify({'error': f'A calendar window can span at most {MAX_RANGE_DAYS} days'}), 400
+
+    return jsonify({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'events': events_in_range(start, end),
+    })
+
+
+def _ical_text(value):
+    value = (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+    return value.replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _ical_time(value):
+    # Event times are entered as wall-clock times, so they are exported floating
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def _fold(line):
+    # RFC 5545 lines are at most 75 octets; continuation lines start with a space
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts, current = [], b''
+    for char in line:
+        encoded = char.encode('utf-8')
+        if len(current) + len(encoded) > (75 if not parts else 74):
+            parts.append(current.decode('utf-8'))
+            current = b''
+        current += encoded
+    parts.append(current.decode('utf-8'))
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def ical_lines(host, since=None):
+    """Yield the lines of an iCalendar feed, reading events in batches"""
+    yield _fold('BEGIN:VCALENDAR')
+    yield _fold('VERSION:2.0')
+    yield _fold('PRODID:-//Enterprise ERP//Branch Calendar//EN')
+    yield _fold('CALSCALE:GREGORIAN')
+
+    since_filter = "WHERE COALESCE(r.until, e.end_date, e.date) >= :since OR (r.id IS NOT NULL AND r.until IS NULL)" \
+        if since else ""
+    result = db.session.execute(text(f"""
+        SELECT {_EVENT_COLUMNS}, e.created_at, r.rule
+        FROM events e LEFT JOIN event_recurrences r ON r.event_id = e.id
+        {since_filter}
+        ORDER BY e.date, e.id
+    """).columns(date=db.DateTime, end_date=db.DateTime, created_at=db.DateTime)
+        .execution_options(yield_per=ICAL_BATCH_SIZE), {'since': since})
+
+    stamp = _ical_time(datetime.utcnow()) + 'Z'
+    for row in result:
+        yield _fold('BEGIN:VEVENT')
+        yield _fold(f'UID:event-{row.id}@{host}')
+        yield _fold(f'DTSTAMP:{stamp}')
+        yield _fold(f'DTSTART:{_ical_time(row.date)}')
+        if row.end_date:
+            yield _fold(f'DTEND:{_ical_time(row.end_date)}')
+        if row.rule:
+            yield _fold(f'RRULE:{row.rule}')
+        yield _fold(f'SUMMARY:{_ical_text(row.title)}')
+        if row.description:
+            yield _fold(f'DESCRIPTION:{_ical_text(row.description)}')
+        if row.location:
+            yield _fold(f'LOCATION:{_ical_text(row.location)}')
+        if row.event_type:
+            yield _fold(f'CATEGORIES:{_ical_text(row.event_type)}')
+        yield _fold('END:VEVENT')
+    yield _fold('END:VCALENDAR')
+
+
+@calendar_bp.route('/events/calendar.ics')
+@login_required
+def events_ical():
+    """iCal feed of the calendar; ?since=YYYY-MM-DD drops events that ended earlier"""
+    try:
+        since = request.args.get('since')
+        since = datetime.combine(date.fromisoformat(since), time.min) if since else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    return Response(stream_with_context(ical_lines(request.host, since)),
+                    mimetype='text/calendar',
+                    headers={'Content-Disposition': 'attachment; filename="calendar.ics"'})
+
+
+def _sample_events(now):
+    return [
+        ("Inventory Stocktaking", "Complete physical inventory count for Q2",
+         now + timedelta(days=2), now + timedelta(days=2, hours=4), "Main Warehouse", "inventory", "Warehouse Manager"),
+        ("Staff Training - POS System", "Training session on new POS features",
+         now + timedelta(days=5), now + timedelta(days=5, hours=3), "Training Room", "training", "IT Manager"),
+        ("Monthly Sales Review", "Review of sales performance and targets",
+         now + timedelta(days=7), now + timedelta(days=7, hours=2), "Conference Room", "meeting", "Sales Director"),
+        ("Supplier Meeting - Accra Goods Ltd", "Negotiation of new supply terms",
+         now + timedelta(days=10), now + timedelta(days=10, hours=1, minutes=30), "Executive Boardroom", "meeting",
+         "Procurement Manager"),
+        ("Product Launch - Premium Line", "Launch event for new premium product line",
+         now + timedelta(days=14), now + timedelta(days=14, hours=5), "Kempinski Hotel, Accra", "marketing",
+         "Marketing Director"),
+    ]
+
+
+def seed_events():
+    """Create the calendar tables and add sample events to an empty calendar"""
+    from modules.core.models import Event
+    from modules.core.models_event_recurrence import EventRecurrence  # noqa: F401  (table for create_all)
+
+    db.create_all()
+    if db.session.execute(text("SELECT 1 FROM events LIMIT 1")).first():
+        return 0
+
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    events = [Event(title=title, description=description, date=start, end_date=end, location=location,
+                    event_type=event_type, created_by=created_by)
+              for title, description, start, end, location, event_type, created_by in _sample_events(now)]
+    try:
+        db.session.add_all(events)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(events)
+
+
+@calendar_bp.cli.command('seed')
+def seed_command():
+    """Create the events tables and add sample events if there are none."""
+    count = seed_events()
+    print(f"Added {count} sample events" if count else "Events already exist, no sample data added")
@@ -0,0 +1,170 @@
+"""
+Liveness and readiness checks.
+
+Liveness only says the process can answer HTTP. Readiness checks what a
+request actually needs: a pooled database connection within a time budget,
+a migrated schema, free pool capacity and background queues that are
+keeping up. Results are cached for HEALTH_CACHE_SECONDS so frequent probes
+from Cloud Run or Kubernetes don't add load of their own.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from flask import current_app
+from sqlalchemy import text
+
+from extensions import db
+from modules.core.template_cache import check_templates
+
+# Background queues report their depth here (name -> (depth function, limit))
+_queues = {}
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+# One dedicated thread for the database ping so a hung connection can be
+# abandoned after the timeout instead of blocking the probe
+_ping_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='health-ping')
+_ping_future = None
+
+_migrations_ok = False
+
+
+def register_queue(name, depth, limit):
+    """Report a background queue in the readiness probe.
+
+    depth is a callable returning the current number of waiting items; the
+    instance is reported unready while it is at or above limit.
+    """
+    _queues[name] = (depth, limit)
+
+
+def _cached(name, compute):
+    ttl = current_app.config.get('HEALTH_CACHE_SECONDS', 2)
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(name)
+        if hit and now - hit[0] < ttl:
+            return hit[1]
+    result = compute()
+    with _cache_lock:
+        _cache[name] = (time.monotonic(), result)
+    return result
+
+
+def _ping(engine):
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def check_database():
+    """Round-trip SELECT 1 through the connection pool within HEALTH_DB_TIMEOUT seconds"""
+    global _ping_future
+
+    if _ping_future is not None and not _ping_future.done():
+        return {'ok': False, 'error': 'previous database check is still running'}
+
+    timeout = current_app.config.get('HEALTH_DB_TIMEOUT', 1.0)
+    _ping_future = _ping_executor.submit(_ping, db.engine)
+    try:
+        return {'ok': True, 'latency_ms': _ping_future.result(timeout=timeout)}
+    except FutureTimeout:
+        return {'ok': False, 'error': f'no answer within {timeout}s'}
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}
+
+
+def check_migrations():
+    """Compare the database schema with what the code expects.
+
+    Alembic revisions are compared when a Flask-Migrate environment exists;
+    in every case all model tables must be present, since several tables are
+    still created with db.create_all() or the scripts in migrations/. Once the
+    schema is up to date it stays that way for the life of the process.
+    """
+    global _migrations_ok
+
+    if _migrations_ok:
+        return {'ok': True}
+
+    result = {'ok': True}
+    try:
+        existing = set(db.inspect(db.engine).get_table_names())
+        missing = sorted(set(db.metadata.tables) - existing)
+        if missing:
+            result.update(ok=False, missing_tables=missing)
+
+        migrate = current_app.extensions.get('migrate')
+        directory = getattr(migrate, 'directory', 'migrations')
+        if os.path.exists(os.path.join(directory, 'env.py')):
+            from alembic.config import Config as AlembicConfig
+            from alembic.runtime.migration import MigrationContext
+            from alembic.script import ScriptDirectory
+
+            alembic_config = AlembicConfig()
+            alembic_config.set_main_option('script_location', directory)
+            heads = set(ScriptDirectory.from_config(alembic_config).get_heads())
+            with db.engine.connect() as conn:
+                current = set(MigrationContext.configure(conn).get_current_heads())
+            result['revision'] = sorted(current)
+            if heads != current:
+                result.update(ok=False, pending_revisions=sorted(heads - current))
+        else:
+            result['revision'] = 'unmanaged'
+    except Exception as e:
+        result = {'ok': False, 'error': str(e)}
+
+    _migrations_ok = result['ok']
+    return result
+
+
+def check_pool():
+    """How much of the connection pool is checked out"""
+    pool = db.engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return {'ok': True, 'pool': type(pool).__name__}
+
+    capacity = pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+    in_use = pool.checkedout()
+    saturation = in_use / capacity if capacity else 0.0
+    limit = current_app.config.get('HEALTH_POOL_SATURATION_LIMIT', 0.9)
+    return {
+        'ok': saturation < limit,
+        'in_use': in_use,
+        'capacity': capacity,
+        'saturation': round(saturation, 2),
+    }
+
+
+def check_queues():
+    """Depth of every registered background queue"""
+    result = {'ok': True, 'queues': {}}
+    for name, (depth, limit) in _queues.items():
+        try:
+            current = depth()
+        except Exception as e:
+            result['ok'] = False
+            result['queues'][name] = {'ok': False, 'error': str(e)}
+            continue
+        ok = current < limit
+        result['ok'] = result['ok'] and ok
+        result['queues'][name] = {'ok': ok, 'depth': current, 'limit': limit}
+    return result
+
+
+def readiness():
+    """Run (or reuse) every readiness check; returns (ready, checks)"""
+    def compute():
+        checks = {'database': check_database()}
+        if checks['database']['ok']:
+            checks['migrations'] = check_migrations()
+            checks['pool'] = check_pool()
+        checks['queues'] = check_queues()
+        checks['templates'] = check_templates()
+        return all(check['ok'] for check in checks.values()), checks
+
+    return _cached('readiness', compute)
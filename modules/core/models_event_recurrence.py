@@ -0,0 +1,26 @@
+from datetime import datetime
+from extensions import db
+
+
+class EventRecurrence(db.Model):
+    """Repeat rule of a calendar event.
+
+    The event row holds the first occurrence; rule is an RFC 5545 RRULE
+    (e.g. "FREQ=WEEKLY;BYDAY=MO;UNTIL=20261231T235959") expanded per window
+    when the calendar is read. until is the last possible occurrence (None
+    for open-ended rules) so windows after it skip the event without
+    parsing the rule.
+    """
+    __tablename__ = 'event_recurrences'
+    __table_args__ = (
+        db.Index('ix_event_recurrences_until', 'until'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id', ondelete='CASCADE'), nullable=False, unique=True)
+    rule = db.Column(db.String(255), nullable=False)
+    until = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<EventRecurrence event={self.event_id} {self.rule}>'
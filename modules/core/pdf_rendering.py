@@ -0,0 +1,287 @@
+"""
+PDF rendering service.
+
+Reports, receipts and invoices are rendered by one engine, WeasyPrint. It is
+CSS-aware and shapes Arabic and other RTL text itself through
+Pango/HarfBuzz. The Jinja template is rendered to HTML in the web process.
+Layout and PDF writing, which hold the GIL for the whole render, run in a
+pool of PDF_WORKERS worker processes that are started and warmed once per
+web process. Each worker keeps:
+
+- one FontConfiguration, so @font-face fonts are loaded once;
+- the parsed PDF_STYLESHEETS, re-parsed only when a file changes on disk.
+
+Batches such as month-end invoices go through render_batch(), which keeps at
+most PDF_MAX_PENDING documents in flight so a large batch neither queues all
+of its HTML in memory nor starves interactive renders.
+
+Render time and pages per second are tracked per template (GET
+/reports/pdf/stats) and every render is logged.
+"""
+import atexit
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from urllib.parse import unquote, urlsplit
+
+import click
+from flask import Blueprint, Response, current_app, jsonify, render_template
+from flask_login import current_user, login_required
+
+from modules.core.structured_logging import get_logger
+
+pdf_bp = Blueprint('pdf', __name__, cli_group='pdf')
+
+log = get_logger('reports')
+
+STATS_ROLES = ('Admin', 'Manager')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+# --- Worker process side -----------------------------------------------------
+
+_worker = {}
+
+
+def _init_worker(static_folder, static_url_path, stylesheets):
+    from weasyprint.text.fonts import FontConfiguration
+
+    _worker.update(
+        static_folder=static_folder,
+        static_url_path=static_url_path.rstrip('/') + '/',
+        stylesheet_paths=stylesheets,
+        font_config=FontConfiguration(),
+        stylesheets={},
+    )
+
+
+def _url_fetcher(url):
+    # Static assets (url_for('static') links, fingerprinted or not) are read
+    # straight from disk instead of over HTTP from the web process
+    from weasyprint import default_url_fetcher
+
+    parts = urlsplit(url)
+    if parts.scheme == 'file' and parts.path.startswith(_worker['static_url_path']):
+        relative = unquote(parts.path[len(_worker['static_url_path']):])
+        path = os.path.realpath(os.path.join(_worker['static_folder'], relative))
+        if path.startswith(os.path.realpath(_worker['static_folder']) + os.sep):
+            return default_url_fetcher('file://' + path)
+    return default_url_fetcher(url)
+
+
+def _stylesheets():
+    from weasyprint import CSS
+
+    sheets = []
+    for relative in _worker['stylesheet_paths']:
+        path = os.path.join(_worker['static_folder'], relative)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        cached = _worker['stylesheets'].get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, CSS(filename=path, font_config=_worker['font_config'], url_fetcher=_url_fetcher))
+            _worker['stylesheets'][path] = cached
+        sheets.append(cached[1])
+    return sheets
+
+
+def _render_in_worker(html):
+    from weasyprint import HTML
+
+    started = time.perf_counter()
+    document = HTML(string=html, base_url='file:///', url_fetcher=_url_fetcher).render(
+        stylesheets=_stylesheets(), font_config=_worker['font_config'])
+    pdf = document.write_pdf()
+    return pdf, len(document.pages), time.perf_counter() - started
+
+
+def _warm_worker():
+    _render_in_worker('<html><body><p>warm-up</p></body></html>')
+    return os.getpid()
+
+
+# --- Web process side --------------------------------------------------------
+
+def process_pool_context():
+    """Multiprocessing context for worker pools started from a web process"""
+    # forkserver children do not inherit the web process's threads and locks
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def get_executor(app=None):
+    """The process pool of this web process, started and warmed on first use"""
+    global _executor
+
+    if _executor is not None:
+        return _executor
+
+    app = app or current_app._get_current_object()
+    with _executor_lock:
+        if _executor is None:
+            workers = app.config.get('PDF_WORKERS', 2)
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=process_pool_context(),
+                initializer=_init_worker,
+                initargs=(app.static_folder, app.static_url_path, list(app.config.get('PDF_STYLESHEETS', ()))),
+            )
+            started = time.perf_counter()
+            pids = {future.result() for future in [executor.submit(_warm_worker) for _ in range(workers)]}
+            log.info("PDF worker pool started", extra={
+                'workers': len(pids), 'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+            _executor = executor
+    return _executor
+
+
+def shutdown():
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+atexit.register(shutdown)
+
+
+def _record(template_name, pages, seconds):
+    with _stats_lock:
+        stats = _stats.setdefault(template_name, {'renders': 0, 'pages': 0, 'seconds': 0.0})
+        stats['renders'] += 1
+        stats['pages'] += pages
+        stats['seconds'] += seconds
+    log.info("PDF rendered", extra={
+        'template': template_name, 'pages': pages, 'duration_ms': round(seconds * 1000, 1)})
+
+
+def render_stats():
+    """Renders, pages, average render time and pages per second per template"""
+    with _stats_lock:
+        snapshot = {name: dict(stats) for name, stats in _stats.items()}
+    for stats in snapshot.values():
+        seconds = stats.pop('seconds')
+        stats['avg_ms'] = round(seconds * 1000 / stats['renders'], 1) if stats['renders'] else 0
+        stats['pages_per_second'] = round(stats['pages'] / seconds, 2) if seconds else 0
+    return snapshot
+
+
+def render_pdf(template_name, **context):
+    """Render a Jinja template to PDF bytes in the worker pool"""
+    html = render_template(template_name, **context)
+    pdf, pages, seconds = get_executor().submit(_render_in_worker, html).result()
+    _record(template_name, pages, seconds)
+    return pdf
+
+
+def render_batch(template_name, contexts):
+    """Render one PDF per context, in order, with bounded parallelism.
+
+    contexts is any iterable of template context dicts; yields
+    (context, pdf bytes) as documents complete, in input order.
+    """
+    executor = get_executor()
+    max_pending = current_app.config.get('PDF_MAX_PENDING') or 2 * current_app.config.get('PDF_WORKERS', 2)
+    pending = deque()
+
+    def finish():
+        context, future = pending.popleft()
+        pdf, pages, seconds = future.result()
+        _record(template_name, pages, seconds)
+        return context, pdf
+
+    for context in contexts:
+        html = render_template(template_name, **context)
+        pending.append((context, executor.submit(_render_in_worker, html)))
+        if len(pending) >= max_pending:
+            yield finish()
+    while pending:
+        yield finish()
+
+
+def pdf_response(template_name, filename, inline=True, **context):
+    """A PDF download/preview response for a view"""
+    disposition = 'inline' if inline else 'attachment'
+    return Response(render_pdf(template_name, **context), mimetype='application/pdf', headers={
+        'Content-Disposition': f'{disposition}; filename="{filename}"'})
+
+
+@lru_cache(maxsize=4096)
+def shape_rtl(text):
+    """Reshape and reorder Arabic text for engines without their own shaping.
+
+    WeasyPrint shapes text itself, so HTML templates do not need this. It is
+    for text drawn directly on a PDF canvas (ReportLab pages, signature
+    stamps), where headers and labels repeat and are cached here.
+    """
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+
+    return get_display(arabic_reshaper.reshape(text)) if text else text
+
+
+def _can_view_stats():
+    return any(current_user.has_role(role) for role in STATS_ROLES)
+
+
+@pdf_bp.route('/pdf/stats')
+@login_required
+def pdf_stats():
+    if not _can_view_stats():
+        return jsonify({'error': 'You do not have permission to view PDF statistics'}), 403
+    return jsonify(render_stats())
+
+
+@pdf_bp.cli.command('invoices')
+@click.option('--start', 'start', required=True, type=click.DateTime(formats=['%Y-%m-%d']), help='First invoice date')
+@click.option('--end', 'end', required=True, type=click.DateTime(formats=['%Y-%m-%d']), help='Last invoice date')
+@click.option('--out', 'out', required=True, type=click.Path(file_okay=False), help='Output directory')
+@click.option('--sign', is_flag=True, help='Digitally sign the invoices as they are rendered')
+def invoices_command(start, end, out, sign):
+    """Render every invoice dated between START and END to PDF files."""
+    from datetime import timedelta
+
+    from modules.core.pdf_signing import SigningError, sign_batch
+    from modules.sales.models import Invoice
+
+    os.makedirs(out, exist_ok=True)
+    invoices = (Invoice.query
+                .filter(Invoice.invoice_date >= start, Invoice.invoice_date < end + timedelta(days=1))
+                .order_by(Invoice.invoice_date, Invoice.id)
+                .all())
+
+    started = time.perf_counter()
+    template_name = current_app.config['PDF_INVOICE_TEMPLATE']
+    documents = ((context['invoice'], pdf)
+                 for context, pdf in render_batch(template_name, ({'invoice': invoice} for invoice in invoices)))
+    if sign:
+        # Rendering and signing overlap: each signed as soon as it is rendered
+        documents = sign_batch(documents)
+
+    count = 0
+    try:
+        for invoice, pdf in documents:
+            name = re.sub(r'[^\w.-]+', '_', invoice.name or f'invoice-{invoice.id}')
+            with open(os.path.join(out, f'{name}.pdf'), 'wb') as f:
+                f.write(pdf)
+            count += 1
+    except SigningError as e:
+        raise click.ClickException(str(e))
+
+    stats = render_stats().get(template_name, {})
+    verb = 'Rendered and signed' if sign else 'Rendered'
+    print(f"{verb} {count} invoices in {time.perf_counter() - started:.1f}s "
+          f"({stats.get('pages_per_second', 0)} pages/s per worker)")
@@ -0,0 +1,354 @@
+"""
+Batch digital signing of generated PDFs with pyHanko.
+
+Loading the signing key, the certificate chain and the validation context
+costs far more than signing one invoice. Signing is therefore done by a pool
+of SIGNING_WORKERS worker processes. Each loads the signer and validation
+context once, in its initializer, and then signs documents as they come:
+
+- sign_batch() signs (key, pdf bytes) pairs, such as the output of
+  pdf_rendering.render_batch(), with at most SIGNING_MAX_PENDING documents
+  in flight. `flask pdf invoices --sign` renders and signs a month of
+  invoices as one job.
+- `flask signing sign-dir SRC DST` signs every PDF in a directory.
+
+Revocation data is cached on disk in SIGNING_REVINFO_DIR. `flask signing
+refresh-revinfo` downloads the CRLs named in the chain's certificates. The
+workers validate against those files, and only fetch over the network
+themselves when SIGNING_FETCH_REVINFO is on. Offline installations keep
+signing with the last CRLs they downloaded.
+
+Documents signed, bytes and documents per second are tracked (GET
+/reports/signing/stats).
+"""
+import atexit
+import glob
+import hashlib
+import io
+import os
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from flask import Blueprint, current_app, jsonify
+from flask_login import current_user, login_required
+
+from modules.core.pdf_rendering import process_pool_context
+from modules.core.structured_logging import get_logger
+
+signing_bp = Blueprint('signing', __name__, cli_group='signing')
+
+log = get_logger('reports')
+
+STATS_ROLES = ('Admin', 'Manager')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_stats = {'documents': 0, 'bytes': 0, 'seconds': 0.0, 'wall_seconds': 0.0}
+_stats_lock = threading.Lock()
+
+
+class SigningError(Exception):
+    """Raised when documents cannot be signed with the configured key"""
+
+
+def signing_settings(app):
+    """The signing configuration passed to each worker process"""
+    config = app.config
+    if not config.get('SIGNING_PKCS12') and not (config.get('SIGNING_KEY') and config.get('SIGNING_CERT')):
+        raise SigningError('Set SIGNING_PKCS12, or SIGNING_KEY and SIGNING_CERT, to sign documents')
+
+    return {
+        'pkcs12': config.get('SIGNING_PKCS12'),
+        'key': config.get('SIGNING_KEY'),
+        'cert': config.get('SIGNING_CERT'),
+        'passphrase': config.get('SIGNING_PASSPHRASE'),
+        'ca_chain': list(config.get('SIGNING_CA_CHAIN', ())),
+        'trust_roots': list(config.get('SIGNING_TRUST_ROOTS', ())),
+        'revinfo_dir': config.get('SIGNING_REVINFO_DIR'),
+        'fetch_revinfo': config.get('SIGNING_FETCH_REVINFO', False),
+        'embed_validation_info': config.get('SIGNING_EMBED_VALIDATION_INFO', False),
+        'reason': config.get('SIGNING_REASON'),
+        'location': config.get('SIGNING_LOCATION'),
+    }
+
+
+# --- Worker process side -----------------------------------------------------
+
+_worker = {}
+
+
+def _load_certificates(paths):
+    from pyhanko.keys import load_certs_from_pemder
+
+    return list(load_certs_from_pemder(paths)) if paths else []
+
+
+def _load_revinfo(directory):
+    crls = []
+    for path in sorted(glob.glob(os.path.join(directory or '', '*.crl'))):
+        with open(path, 'rb') as f:
+            crls.append(f.read())
+    return crls
+
+
+def _load_signer(settings):
+    from pyhanko.sign import signers
+
+    passphrase = settings['passphrase'].encode() if settings['passphrase'] else None
+    if settings['pkcs12']:
+        signer = signers.SimpleSigner.load_pkcs12(
+            settings['pkcs12'], ca_chain_files=settings['ca_chain'], passphrase=passphrase)
+    else:
+        signer = signers.SimpleSigner.load(
+            settings['key'], settings['cert'], ca_chain_files=settings['ca_chain'], key_passphrase=passphrase)
+    if signer is None:
+        raise SigningError('The signing key or certificate could not be loaded')
+    return signer
+
+
+def _init_worker(settings):
+    from pyhanko.sign import signers
+    from pyhanko_certvalidator import ValidationContext
+
+    signer = _load_signer(settings)
+
+    trust_roots = _load_certificates(settings['trust_roots'])
+    validation_context = ValidationContext(
+        trust_roots=trust_roots or None,
+        other_certs=list(signer.cert_registry),
+        crls=_load_revinfo(settings['revinfo_dir']),
+        allow_fetching=settings['fetch_revinfo'],
+        revocation_mode='soft-fail',
+    )
+
+    _worker.update(
+        signer=signer,
+        metadata=signers.PdfSignatureMetadata(
+            field_name='Signature',
+            md_algorithm='sha256',
+            reason=settings['reason'],
+            location=settings['location'],
+            embed_validation_info=settings['embed_validation_info'],
+            validation_context=validation_context,
+        ),
+    )
+
+
+def _sign_in_worker(pdf):
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+    from pyhanko.sign import signers
+
+    started = time.perf_counter()
+    writer = IncrementalPdfFileWriter(io.BytesIO(pdf))
+    signed = signers.sign_pdf(writer, _worker['metadata'], signer=_worker['signer']).getvalue()
+    return signed, time.perf_counter() - started
+
+
+def _sign_file_in_worker(source, destination):
+    with open(source, 'rb') as f:
+        signed, seconds = _sign_in_worker(f.read())
+    with open(destination, 'wb') as f:
+        f.write(signed)
+    return len(signed), seconds
+
+
+def _warm_worker():
+    return os.getpid()
+
+
+# --- Web process side --------------------------------------------------------
+
+def get_executor(app=None):
+    """The signing pool of this process, started on first use"""
+    global _executor
+
+    if _executor is not None:
+        return _executor
+
+    app = app or current_app._get_current_object()
+    with _executor_lock:
+        if _executor is None:
+            workers = app.config.get('SIGNING_WORKERS', 2)
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=process_pool_context(),
+                initializer=_init_worker,
+                initargs=(signing_settings(app),),
+            )
+            started = time.perf_counter()
+            try:
+                pids = {future.result() for future in [executor.submit(_warm_worker) for _ in range(workers)]}
+            except BrokenProcessPool:
+                executor.shutdown(wait=False)
+                raise SigningError('The signing workers could not load the signing key and certificates')
+            log.info("Signing worker pool started", extra={
+                'workers': len(pids), 'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+            _executor = executor
+    return _executor
+
+
+def shutdown():
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+atexit.register(shutdown)
+
+
+def _record(size, seconds):
+    with _stats_lock:
+        _stats['documents'] += 1
+        _stats['bytes'] += size
+        _stats['seconds'] += seconds
+
+
+def _record_batch(documents, wall_seconds):
+    with _stats_lock:
+        _stats['wall_seconds'] += wall_seconds
+    log.info("Signing batch finished", extra={
+        'documents': documents, 'duration_ms': round(wall_seconds * 1000, 1)})
+
+
+def signing_stats():
+    """Documents and bytes signed, average signing time and batch throughput"""
+    with _stats_lock:
+        stats = dict(_stats)
+    seconds, wall_seconds = stats.pop('seconds'), stats.pop('wall_seconds')
+    stats['avg_ms'] = round(seconds * 1000 / stats['documents'], 1) if stats['documents'] else 0
+    stats['documents_per_second'] = round(stats['documents'] / wall_seconds, 2) if wall_seconds else 0
+    return stats
+
+
+def _bounded(submit, items, max_pending):
+    # Yields (item, result) in input order, keeping at most max_pending in flight
+    pending = deque()
+    for item in items:
+        pending.append((item, submit(item)))
+        if len(pending) >= max_pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+
+def _max_pending():
+    return current_app.config.get('SIGNING_MAX_PENDING') or 2 * current_app.config.get('SIGNING_WORKERS', 2)
+
+
+def sign_pdf(pdf):
+    """Sign one PDF in the worker pool and return the signed bytes"""
+    signed, seconds = get_executor().submit(_sign_in_worker, pdf).result()
+    _record(len(signed), seconds)
+    return signed
+
+
+def sign_batch(documents):
+    """Sign an iterable of (key, pdf bytes); yields (key, signed bytes) in order"""
+    executor = get_executor()
+
+    def submit(document):
+        return executor.submit(_sign_in_worker, document[1])
+
+    started, count = time.perf_counter(), 0
+    for (key, _), (signed, seconds) in _bounded(submit, documents, _max_pending()):
+        _record(len(signed), seconds)
+        count += 1
+        yield key, signed
+    _record_batch(count, time.perf_counter() - started)
+
+
+def sign_directory(source, destination):
+    """Sign every PDF in source into destination; returns the number signed"""
+    executor = get_executor()
+    os.makedirs(destination, exist_ok=True)
+    paths = sorted(glob.glob(os.path.join(source, '*.pdf')))
+
+    def submit(path):
+        return executor.submit(_sign_file_in_worker, path, os.path.join(destination, os.path.basename(path)))
+
+    started, count = time.perf_counter(), 0
+    for _, (size, seconds) in _bounded(submit, paths, _max_pending()):
+        _record(size, seconds)
+        count += 1
+    _record_batch(count, time.perf_counter() - started)
+    return count
+
+
+def refresh_revinfo(app):
+    """Download the CRLs of the signing chain into SIGNING_REVINFO_DIR.
+
+    Returns (saved, failed) URL lists; files that cannot be refreshed are
+    kept, so offline workers still have the last known CRLs.
+    """
+    settings = signing_settings(app)
+    directory = settings['revinfo_dir']
+    os.makedirs(directory, exist_ok=True)
+
+    signer = _load_signer(settings)
+
+    urls = []
+    for cert in [signer.signing_cert, *signer.cert_registry]:
+        for point in cert.crl_distribution_points:
+            if point.url and point.url not in urls:
+                urls.append(point.url)
+
+    saved, failed = [], []
+    for url in urls:
+        try:
+            with urllib.request.urlopen(url, timeout=app.config.get('SIGNING_FETCH_TIMEOUT', 10)) as response:
+                data = response.read()
+        except OSError as e:
+            log.warning("CRL download failed", extra={'url': url, 'error': str(e)})
+            failed.append(url)
+            continue
+        name = hashlib.sha1(url.encode()).hexdigest() + '.crl'
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        saved.append(url)
+    return saved, failed
+
+
+def _can_view_stats():
+    return any(current_user.has_role(role) for role in STATS_ROLES)
+
+
+@signing_bp.route('/signing/stats')
+@login_required
+def signing_stats_route():
+    if not _can_view_stats():
+        return jsonify({'error': 'You do not have permission to view signing statistics'}), 403
+    return jsonify(signing_stats())
+
+
+@signing_bp.cli.command('sign-dir')
+@click.argument('source', type=click.Path(exists=True, file_okay=False))
+@click.argument('destination', type=click.Path(file_okay=False))
+def sign_dir_command(source, destination):
+    """Sign every PDF in SOURCE and write the signed copies to DESTINATION."""
+    try:
+        count = sign_directory(source, destination)
+    except SigningError as e:
+        raise click.ClickException(str(e))
+    stats = signing_stats()
+    print(f"Signed {count} documents ({stats['documents_per_second']} documents/s)")
+
+
+@signing_bp.cli.command('refresh-revinfo')
+def refresh_revinfo_command():
+    """Download the signing chain's CRLs for offline validation."""
+    try:
+        saved, failed = refresh_revinfo(current_app._get_current_object())
+    except SigningError as e:
+        raise click.ClickException(str(e))
+    print(f"Saved {len(saved)} CRLs, {len(failed)} could not be downloaded")
@@ -0,0 +1,158 @@
+"""
+Shared state for running several workers or replicas side by side.
+
+State one request leaves for a later one cannot live in a module-level dict
+or a local temp file: the next request may reach another process behind the
+load balancer. Sessions are already safe, Flask keeps them in signed
+cookies; anything else goes through get_store(). Two backends are available:
+
+- ``database``: rows in the shared_state_entries table of the main database
+  (the default for multi-replica deployments, nothing else to run).
+- ``filesystem``: one file per key under SHARED_STATE_DIR, for single-host
+  setups or a directory on a shared volume.
+"""
+import hashlib
+import json
+import os
+import uuid
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import text
+
+from extensions import db
+
+
+class SharedStateEntry(db.Model):
+    """Key/value row used by the database shared-state backend"""
+    __tablename__ = 'shared_state_entries'
+
+    key = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.LargeBinary, nullable=False)
+    expires_at = db.Column(db.DateTime, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DatabaseStore:
+    """Shared state kept in the application database.
+
+    Every call runs in its own short transaction on the engine, so storing a
+    value never commits or rolls back the request's session.
+    """
+
+    name = 'database'
+
+    def get(self, key):
+        with db.engine.begin() as connection:
+            row = connection.execute(
+                text("SELECT value, expires_at FROM shared_state_entries WHERE key = :key")
+                .columns(value=db.LargeBinary, expires_at=db.DateTime),
+                {'key': key}
+            ).first()
+            if row is None:
+                return None
+            if row.expires_at and row.expires_at < datetime.utcnow():
+                connection.execute(text("DELETE FROM shared_state_entries WHERE key = :key"), {'key': key})
+                return None
+            return row.value
+
+    def set(self, key, value, ttl=None):
+        now = datetime.utcnow()
+        expires_at = now + ttl if ttl else None
+        with db.engine.begin() as connection:
+            connection.execute(text("""
+                INSERT INTO shared_state_entries (key, value, expires_at, updated_at)
+                VALUES (:key, :value, :expires_at, :now)
+                ON CONFLICT (key) DO UPDATE SET
+                    value = excluded.value,
+                    expires_at = excluded.expires_at,
+                    updated_at = excluded.updated_at
+            """), {'key': key, 'value': value, 'expires_at': expires_at, 'now': now})
+
+    def delete(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(text("DELETE FROM shared_state_entries WHERE key = :key"), {'key': key})
+
+    def purge_expired(self):
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                text("DELETE FROM shared_state_entries WHERE expires_at < :now"),
+                {'now': datetime.utcnow()}
+            )
+            return result.rowcount
+
+
+class FileStore:
+    """Shared state kept as files in a (possibly shared) directory"""
+
+    name = 'filesystem'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                value = f.read()
+        except (OSError, ValueError):
+            return None
+        if header.get('expires_at') and datetime.fromisoformat(header['expires_at']) < datetime.utcnow():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        header = {'key': key, 'expires_at': (datetime.utcnow() + ttl).isoformat() if ttl else None}
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(value)
+        # Atomic on POSIX, so readers never see a half-written entry
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def purge_expired(self):
+        removed = 0
+        now = datetime.utcnow()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    header = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            if header.get('expires_at') and datetime.fromisoformat(header['expires_at']) < now:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+def init_app(app):
+    """Attach the configured shared-state backend to the app"""
+    backend = app.config.get('SHARED_STATE_BACKEND', 'filesystem')
+    if backend == 'database':
+        store = DatabaseStore()
+    elif backend == 'filesystem':
+        store = FileStore(app.config['SHARED_STATE_DIR'])
+    else:
+        raise RuntimeError(f"Unknown SHARED_STATE_BACKEND '{backend}' (use 'database' or 'filesystem')")
+    app.extensions['shared_state'] = store
+    return store
+
+
+def get_store():
+    """The app's shared-state backend: get(key), set(key, bytes, ttl=None), delete(key)"""
+    return current_app.extensions['shared_state']
+
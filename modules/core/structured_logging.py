@@ -0,0 +1,175 @@
+"""
+Structured, non-blocking logging for the application.
+
+Request handlers used to print() form fields, line items and tracebacks
+straight to stdout, synchronously, on every request. Everything now goes
+through the standard logging module instead:
+
+- Records are written as one JSON object per line (LOG_FORMAT='json') with
+  the request id, or as plain text for local development.
+- Handlers only put records on a queue; a QueueListener thread does the
+  formatting and the writing, so a slow stdout never holds up a request.
+- Debug records are dropped by level before any formatting work is done,
+  so ``log.debug("...%s", value)`` is free when debug is off. Wrap loops
+  that only exist to produce debug output in ``log.isEnabledFor(DEBUG)``.
+- High-volume events can pass ``extra={'sample_rate': 0.01}`` to keep only
+  a fraction of them.
+- Each blueprint logs to ``erp.<blueprint>`` and LOG_LEVELS can raise or
+  lower individual blueprints, e.g. ``pos=DEBUG,inventory=WARNING``.
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+ROOT_LOGGER = 'erp'
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+_listener = None
+
+
+def get_logger(name=None):
+    """Logger for a blueprint or subsystem, e.g. get_logger('pos') -> erp.pos"""
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}' if name else ROOT_LOGGER)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamp the request id on records while still on the request thread"""
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only sample_rate of the records that ask to be sampled"""
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        return rate is None or random.random() < rate
+
+
+class _RequestQueueHandler(QueueHandler):
+    """QueueHandler that keeps exception text and extra fields for the JSON formatter.
+
+    When the queue is full records are dropped and counted rather than
+    blocking the request.
+    """
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s] [%(request_id)s] %(message)s')
+
+    def format(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = '-'
+        return super().format(record)
+
+
+def _parse_levels(value):
+    levels = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def init_app(app):
+    """Route the app's and blueprints' logs through the queue listener"""
+    global _listener
+
+    level = app.config.get('LOG_LEVEL', 'INFO').upper()
+    formatter = JsonFormatter() if app.config.get('LOG_FORMAT') == 'json' else TextFormatter()
+
+    if _listener is not None:
+        _listener.stop()
+
+    log_queue = queue.Queue(maxsize=app.config.get('LOG_QUEUE_SIZE', 10000))
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+
+    queue_handler = _RequestQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(RequestContextFilter())
+
+    for logger in (get_logger(), app.logger):
+        logger.handlers = [queue_handler]
+        logger.setLevel(level)
+        logger.propagate = False
+
+    for name, blueprint_level in _parse_levels(app.config.get('LOG_LEVELS')).items():
+        get_logger(name).setLevel(blueprint_level)
+
+    @app.before_request
+    def assign_request_id():
+        # Reuse the id from the load balancer when there is one
+        trace = request.headers.get('X-Cloud-Trace-Context', '').split('/')[0]
+        g.request_id = request.headers.get('X-Request-ID') or trace or uuid.uuid4().hex
+
+    @app.after_request
+    def expose_request_id(response):
+        if g.get('request_id'):
+            response.headers.setdefault('X-Request-ID', g.request_id)
+        return response
+
+    return _listener
+
+
+@atexit.register
+def shutdown():
+    """Flush queued records; called at interpreter exit"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
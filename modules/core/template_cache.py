@@ -0,0 +1,138 @@
+"""
+Jinja template bytecode cache, build-time precompilation and warm-up.
+
+Jinja compiles a template to Python code the first time it is used in a
+process, so after a cold start the first hits on the dashboard, POS and
+reports each paid for compiling their templates and every template they
+extend or include. Three pieces take that off the request path:
+
+- a FileSystemBytecodeCache under TEMPLATE_CACHE_DIR, shared by every worker
+  on the instance. Entries are keyed by template path and checked against a
+  hash of the source, so an edited template is simply recompiled;
+- ``flask templates-compile``, run while building the container image, which
+  compiles every app and blueprint template into that cache;
+- a warm-up thread (TEMPLATE_WARMUP) that loads every template from the cache
+  and renders the critical ones. The readiness probe reports the instance
+  unavailable until it has finished.
+"""
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+
+from modules.core.structured_logging import get_logger
+
+log = get_logger('main')
+
+# Files under the template folders that are Jinja templates
+TEMPLATE_EXTENSIONS = ('html', 'htm', 'txt', 'xml', 'j2')
+
+_warmup = {'state': 'idle', 'error': None}
+_warmup_lock = threading.Lock()
+
+
+def init_app(app):
+    """Give the app's Jinja environment a filesystem bytecode cache"""
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    app.cli.add_command(templates_compile_command)
+
+    if app.config.get('TEMPLATE_WARMUP'):
+        start_warmup(app)
+
+
+def _template_names(app):
+    return app.jinja_env.list_templates(extensions=TEMPLATE_EXTENSIONS)
+
+
+def compile_templates(app):
+    """Load every template once so its bytecode lands in the cache.
+
+    Returns (compiled names, {name: error}) for templates that fail to parse.
+    """
+    compiled, errors = [], {}
+    for name in _template_names(app):
+        try:
+            app.jinja_env.get_template(name)
+        except TemplateSyntaxError as e:
+            errors[name] = f'line {e.lineno}: {e.message}'
+        else:
+            compiled.append(name)
+    return compiled, errors
+
+
+def warm_up(app):
+    """Load all templates and render the critical ones in this process"""
+    started = time.perf_counter()
+    compiled, errors = compile_templates(app)
+
+    rendered = 0
+    with app.test_request_context('/'):
+        for name in app.config.get('TEMPLATE_WARMUP_TEMPLATES', ()):
+            if name not in compiled:
+                continue
+            try:
+                app.jinja_env.get_template(name).render()
+                rendered += 1
+            except Exception as e:
+                # Without a real request and its data most pages stop part way;
+                # what they extend and include is loaded by then
+                log.debug("Warm-up render stopped early", extra={'template': name, 'error': str(e)})
+
+    log.info("Templates warmed up", extra={
+        'templates': len(compiled),
+        'rendered': rendered,
+        'errors': len(errors),
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+    })
+    return compiled, errors
+
+
+def _run_warmup(app):
+    try:
+        warm_up(app)
+        _warmup['state'] = 'done'
+    except Exception as e:
+        log.exception("Template warm-up failed")
+        _warmup.update(state='failed', error=str(e))
+
+
+def start_warmup(app):
+    """Warm templates up in a background thread (once per process)"""
+    with _warmup_lock:
+        if _warmup['state'] != 'idle':
+            return
+        _warmup['state'] = 'running'
+    threading.Thread(target=_run_warmup, args=(app,), name='template-warmup', daemon=True).start()
+
+
+def check_templates():
+    """Readiness of the template warm-up; a failed warm-up does not hold the instance back"""
+    state = _warmup['state']
+    result = {'ok': state != 'running', 'warmup': state}
+    if _warmup['error']:
+        result['error'] = _warmup['error']
+    return result
+
+
+@click.command('templates-compile')
+@with_appcontext
+def templates_compile_command():
+    """Precompile all app and blueprint templates into the bytecode cache."""
+    app = current_app._get_current_object()
+    if app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set, there is nowhere to compile to')
+
+    compiled, errors = compile_templates(app)
+    for name, error in sorted(errors.items()):
+        click.echo(f"{name}: {error}", err=True)
+    click.echo(f"Compiled {len(compiled)} templates into {app.config['TEMPLATE_CACHE_DIR']}")
+    if errors:
+        raise click.ClickException(f'{len(errors)} templates failed to compile')
@@ -0,0 +1,316 @@
+"""
+Daily attendance rollups for the clock blueprint.
+
+Clock-in/out events and attendance edits refresh the affected employee days in
+attendance_daily_rollups, so monthly and payroll-period reports can sum a
+handful of indexed rows per employee instead of recomputing hours from every
+raw punch.
+"""
+import csv
+import io
+from datetime import date, datetime, time, timedelta
+
+import click
+from flask import Blueprint, Response, current_app, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, event, inspect, text
+
+from extensions import db
+
+attendance_rollup_bp = Blueprint('attendance_rollup', __name__, cli_group='attendance')
+
+REPORT_ROLES = ('Admin', 'Manager', 'Shop Manager')
+
+_UPSERT_ROLLUP_SQL = text("""
+    INSERT INTO attendance_daily_rollups
+        (employee_id, work_date, first_check_in, last_check_out, punch_count, open_punches,
+         worked_minutes, overtime_minutes, late_minutes, edit_count, updated_at)
+    VALUES
+        (:employee_id, :work_date, :first_check_in, :last_check_out, :punch_count, :open_punches,
+         :worked_minutes, :overtime_minutes, :late_minutes, :edit_count, :updated_at)
+    ON CONFLICT (employee_id, work_date) DO UPDATE SET
+        first_check_in = excluded.first_check_in,
+        last_check_out = excluded.last_check_out,
+        punch_count = excluded.punch_count,
+        open_punches = excluded.open_punches,
+        worked_minutes = excluded.worked_minutes,
+        overtime_minutes = excluded.overtime_minutes,
+        late_minutes = excluded.late_minutes,
+        edit_count = excluded.edit_count,
+        updated_at = excluded.updated_at
+""")
+
+
+def _rules():
+    """Shift start and standard day length from config"""
+    config = current_app.config
+    hours, minutes = (int(part) for part in config.get('ATTENDANCE_SHIFT_START', '08:00').split(':'))
+    return time(hours, minutes), int(config.get('ATTENDANCE_STANDARD_MINUTES', 480))
+
+
+def _fetch_punches(connection, start, end, employee_ids=None):
+    """Attendances whose check-in falls in [start, end), with their edit counts"""
+    employee_filter = "AND a.employee_id IN :employee_ids" if employee_ids else ""
+    query = text(f"""
+        SELECT a.id, a.employee_id, a.check_in, a.check_out,
+               (SELECT COUNT(*) FROM attendance_edits e WHERE e.attendance_id = a.id) AS edit_count
+        FROM attendances a
+        WHERE a.check_in >= :start AND a.check_in < :end {employee_filter}
+        ORDER BY a.employee_id, a.check_in
+    """).columns(check_in=db.DateTime, check_out=db.DateTime)
+    params = {'start': start, 'end': end}
+    if employee_ids:
+        query = query.bindparams(bindparam('employee_ids', expanding=True))
+        params['employee_ids'] = list(employee_ids)
+    return connection.execute(query, params)
+
+
+def _summarise(punches):
+    """Fold raw punches into one rollup row per employee day"""
+    shift_start, standard_minutes = _rules()
+    days = {}
+
+    for punch in punches:
+        key = (punch.employee_id, punch.check_in.date())
+        day = days.get(key)
+        if day is None:
+            day = days[key] = {
+                'employee_id': punch.employee_id,
+                'work_date': key[1],
+                'first_check_in': punch.check_in,
+                'last_check_out': None,
+                'punch_count': 0,
+                'open_punches': 0,
+                'worked_minutes': 0,
+                'edit_count': 0,
+            }
+
+        day['punch_count'] += 1
+        day['edit_count'] += punch.edit_count or 0
+        day['first_check_in'] = min(day['first_check_in'], punch.check_in)
+
+        if punch.check_out and punch.check_out > punch.check_in:
+            day['worked_minutes'] += int((punch.check_out - punch.check_in).total_seconds() // 60)
+            if day['last_check_out'] is None or punch.check_out > day['last_check_out']:
+                day['last_check_out'] = punch.check_out
+        elif punch.check_out is None:
+            day['open_punches'] += 1
+
+    now = datetime.utcnow()
+    for day in days.values():
+        shift_begins = datetime.combine(day['work_date'], shift_start)
+        late_seconds = (day['first_check_in'] - shift_begins).total_seconds()
+        day['late_minutes'] = int(late_seconds // 60) if late_seconds > 0 else 0
+        day['overtime_minutes'] = max(0, day['worked_minutes'] - standard_minutes)
+        day['updated_at'] = now
+
+    return days
+
+
+def refresh_days(connection, keys):
+    """Recompute the rollups for a set of (employee_id, work_date) keys"""
+    keys = {(employee_id, work_date) for employee_id, work_date in keys
+            if employee_id is not None and work_date is not None}
+    if not keys:
+        return 0
+
+    start = min(work_date for _, work_date in keys)
+    end = max(work_date for _, work_date in keys) + timedelta(days=1)
+    employee_ids = {employee_id for employee_id, _ in keys}
+
+    days = _summarise(_fetch_punches(connection, datetime.combine(start, time.min),
+                                     datetime.combine(end, time.min), employee_ids))
+
+    rows = [day for key, day in days.items() if key in keys]
+    if rows:
+        connection.execute(_UPSERT_ROLLUP_SQL, rows)
+
+    emptied = [{'employee_id': employee_id, 'work_date': work_date}
+               for employee_id, work_date in keys if (employee_id, work_date) not in days]
+    if emptied:
+        connection.execute(text("""
+            DELETE FROM attendance_daily_rollups
+            WHERE employee_id = :employee_id AND work_date = :work_date
+        """), emptied)
+
+    return len(rows)
+
+
+def rebuild_rollups(start=None, end=None, batch_days=31):
+    """Backfill rollups for [start, end], one window of batch_days at a time"""
+    if start is None:
+        first = db.session.execute(text(
+            "SELECT MIN(check_in) AS first_check_in FROM attendances"
+        ).columns(first_check_in=db.DateTime)).scalar()
+        if first is None:
+            return 0
+        start = first.date() if isinstance(first, datetime) else date.fromisoformat(str(first)[:10])
+    end = end or datetime.utcnow().date()
+
+    total = 0
+    window_start = start
+    try:
+        while window_start <= end:
+            window_end = min(end, window_start + timedelta(days=batch_days - 1))
+            connection = db.session.connection()
+            connection.execute(text("""
+                DELETE FROM attendance_daily_rollups
+                WHERE work_date >= :start AND work_date <= :end
+            """), {'start': window_start, 'end': window_end})
+
+            days = _summarise(_fetch_punches(
+                connection,
+                datetime.combine(window_start, time.min),
+                datetime.combine(window_end + timedelta(days=1), time.min),
+            ))
+            if days:
+                connection.execute(_UPSERT_ROLLUP_SQL, list(days.values()))
+            db.session.commit()
+
+            total += len(days)
+            window_start = window_end + timedelta(days=1)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return total
+
+
+def rollup_report(start, end, employee_ids=None):
+    """Attendance totals per employee for an arbitrary date range"""
+    employee_filter = "AND r.employee_id IN :employee_ids" if employee_ids else ""
+    query = text(f"""
+        SELECT r.employee_id, e.first_name, e.last_name,
+               COUNT(*) AS days_present,
+               SUM(r.worked_minutes) AS worked_minutes,
+               SUM(r.overtime_minutes) AS overtime_minutes,
+               SUM(r.late_minutes) AS late_minutes,
+               SUM(CASE WHEN r.late_minutes > 0 THEN 1 ELSE 0 END) AS late_days,
+               SUM(r.open_punches) AS open_punches,
+               SUM(r.edit_count) AS edit_count
+        FROM attendance_daily_rollups r
+        JOIN employees e ON e.id = r.employee_id
+        WHERE r.work_date >= :start AND r.work_date <= :end {employee_filter}
+        GROUP BY r.employee_id, e.first_name, e.last_name
+        ORDER BY e.last_name, e.first_name
+    """)
+    params = {'start': start, 'end': end}
+    if employee_ids:
+        query = query.bindparams(bindparam('employee_ids', expanding=True))
+        params['employee_ids'] = list(employee_ids)
+
+    report = []
+    for row in db.session.execute(query, params).mappings():
+        row = dict(row)
+        row['worked_hours'] = round((row['worked_minutes'] or 0) / 60.0, 2)
+        row['overtime_hours'] = round((row['overtime_minutes'] or 0) / 60.0, 2)
+        report.append(row)
+    return report
+
+
+def register_attendance_listeners():
+    """Refresh rollups whenever attendances or attendance edits change through the ORM"""
+    from modules.employees.models import Attendance, AttendanceEdit
+
+    if event.contains(Attendance, 'after_insert', _attendance_changed):
+        return
+
+    event.listen(Attendance, 'before_update', _remember_previous_day)
+    event.listen(Attendance, 'before_delete', _remember_previous_day)
+    event.listen(Attendance, 'after_insert', _attendance_changed)
+    event.listen(Attendance, 'after_update', _attendance_changed)
+    event.listen(Attendance, 'after_delete', _attendance_changed)
+    event.listen(AttendanceEdit, 'after_insert', _attendance_edited)
+    event.listen(AttendanceEdit, 'after_delete', _attendance_edited)
+
+
+def _day_of(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _stored_day(connection, attendance_id):
+    punch = connection.execute(
+        text("SELECT employee_id, check_in FROM attendances WHERE id = :id").columns(check_in=db.DateTime),
+        {'id': attendance_id}
+    ).first()
+    return (punch.employee_id, _day_of(punch.check_in)) if punch else None
+
+
+def _remember_previous_day(mapper, connection, target):
+    # An edit can move a punch to another day or employee, and the old values
+    # are usually expired by then, so read them back before the row changes
+    inspect(target).info['attendance_rollup_previous_day'] = _stored_day(connection, target.id)
+
+
+def _attendance_changed(mapper, connection, target):
+    state = inspect(target)
+    keys = set()
+    if not state.deleted and not state.was_deleted:
+        keys.add((target.employee_id, _day_of(target.check_in)))
+    previous = state.info.pop('attendance_rollup_previous_day', None)
+    if previous:
+        keys.add(previous)
+
+    refresh_days(connection, keys)
+
+
+def _attendance_edited(mapper, connection, target):
+    day = _stored_day(connection, target.attendance_id)
+    if day:
+        refresh_days(connection, {day})
+
+
+def _parse_range():
+    today = datetime.utcnow().date()
+    start = request.args.get('start')
+    end = request.args.get('end')
+    start = date.fromisoformat(start) if start else today.replace(day=1)
+    end = date.fromisoformat(end) if end else today
+    return start, end
+
+
+@attendance_rollup_bp.route('/reports/summary')
+@login_required
+def attendance_summary():
+    """Attendance totals per employee over a date range (JSON or CSV)"""
+    if not any(current_user.has_role(role) for role in REPORT_ROLES):
+        return jsonify({'error': 'You do not have permission to view attendance reports'}), 403
+
+    try:
+        start, end = _parse_range()
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    employee_ids = request.args.getlist('employee_id', type=int)
+    report = rollup_report(start, end, employee_ids)
+
+    if request.args.get('format') != 'csv':
+        return jsonify({'start': start.isoformat(), 'end': end.isoformat(), 'employees': report})
+
+    columns = ['employee_id', 'first_name', 'last_name', 'days_present', 'worked_hours',
+               'overtime_hours', 'late_minutes', 'late_days', 'open_punches', 'edit_count']
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in report:
+            writer.writerow([row[column] for column in columns])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    filename = f'attendance_{start.isoformat()}_{end.isoformat()}.csv'
+    return Response(generate(), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@attendance_rollup_bp.cli.command('backfill-rollups')
+@click.option('--start', help='First day to rebuild (YYYY-MM-DD), defaults to the first punch')
+@click.option('--end', help='Last day to rebuild (YYYY-MM-DD), defaults to today')
+def backfill_rollups_command(start, end):
+    """Rebuild attendance daily rollups from raw punches."""
+    start = date.fromisoformat(start) if start else None
+    end = date.fromisoformat(end) if end else None
+    count = rebuild_rollups(start, end)
+    print(f"Attendance rollups rebuilt: {count} employee days")
@@ -0,0 +1,36 @@
+from datetime import datetime
+from extensions import db
+
+
+class AttendanceDailyRollup(db.Model):
+    """Per-employee, per-day attendance totals.
+
+    Derived from attendances and attendance_edits by
+    modules.employees.attendance_rollup; period reports sum these rows
+    instead of recomputing hours from raw punches.
+    """
+    __tablename__ = 'attendance_daily_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('employee_id', 'work_date', name='uq_attendance_rollup_day'),
+        db.Index('ix_attendance_rollup_date_employee', 'work_date', 'employee_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employees.id'), nullable=False)
+    work_date = db.Column(db.Date, nullable=False)
+    first_check_in = db.Column(db.DateTime)
+    last_check_out = db.Column(db.DateTime)
+    punch_count = db.Column(db.Integer, nullable=False, default=0)
+    open_punches = db.Column(db.Integer, nullable=False, default=0)
+    worked_minutes = db.Column(db.Integer, nullable=False, default=0)
+    overtime_minutes = db.Column(db.Integer, nullable=False, default=0)
+    late_minutes = db.Column(db.Integer, nullable=False, default=0)
+    edit_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def worked_hours(self):
+        return round((self.worked_minutes or 0) / 60.0, 2)
+
+    def __repr__(self):
+        return f'<AttendanceDailyRollup employee={self.employee_id} date={self.work_date}>'
@@ -0,0 +1,236 @@
+"""
+Nightly demand forecast per product and branch.
+
+Nothing planned from the sales history: reorder points only knew the
+product's min_stock and a flat recent average. `flask forecast run` reads
+the daily sales of every product and branch over the last
+FORECAST_HISTORY_DAYS in one query (POS order lines net of processed
+returns, plus confirmed sales order lines under branch 0) and computes, for
+thousands of series at once as rows of a NumPy series x day matrix:
+
+- short and long moving averages (FORECAST_SHORT_DAYS, FORECAST_LONG_DAYS),
+  averaged into the daily forecast;
+- a weekday profile, applied to the next FORECAST_HORIZON_DAYS;
+- the day-to-day deviation once the weekday pattern is removed, giving the
+  safety stock for FORECAST_SERVICE_LEVEL over REORDER_LEAD_DAYS.
+
+The query streams its rows ordered by product and branch, and the matrix is
+built FORECAST_CHUNK_SERIES series at a time, so memory stays bounded with
+50k products across 20 branches. The results replace demand_forecasts in one
+transaction; the reorder engine's daily refresh uses them for its velocity
+and reorder points.
+"""
+import time
+from datetime import date, datetime, timedelta
+from statistics import NormalDist
+
+import click
+import numpy as np
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import login_required
+from sqlalchemy import bindparam, text
+
+from extensions import db
+from modules.core.archival import history_table
+from modules.core.branch_scope import branch_column
+from modules.core.structured_logging import get_logger
+from modules.inventory.models_forecast import DemandForecast
+
+forecast_bp = Blueprint('forecast', __name__, cli_group='forecast')
+
+log = get_logger('inventory')
+
+# Order states counted as demand
+POS_ORDER_STATES = ('paid',)
+POS_RETURN_STATES = ('validated',)
+SALES_ORDER_STATES = ('confirmed', 'done')
+
+# Rows fetched from the history query at a time
+FETCH_SIZE = 50000
+
+
+def _settings():
+    config = current_app.config
+    return {
+        'history_days': config.get('FORECAST_HISTORY_DAYS', 182),
+        'short_days': config.get('FORECAST_SHORT_DAYS', 7),
+        'long_days': config.get('FORECAST_LONG_DAYS', 28),
+        'horizon_days': config.get('FORECAST_HORIZON_DAYS', 14),
+        'service_level': config.get('FORECAST_SERVICE_LEVEL', 0.95),
+        'chunk_series': config.get('FORECAST_CHUNK_SERIES', 20000),
+        'lead_days': config.get('REORDER_LEAD_DAYS', 7),
+    }
+
+
+def _history_sql(connection):
+    orders, order_lines = history_table('pos_orders'), history_table('pos_order_lines')
+    branch = branch_column(connection, 'pos_orders', 'o')
+    return text(f"""
+        SELECT product_id, branch_id, day, SUM(quantity) AS quantity FROM (
+            SELECT l.product_id, COALESCE({branch}, 0) AS branch_id, DATE(o.order_date) AS day,
+                   l.quantity
+            FROM {order_lines} l JOIN {orders} o ON o.id = l.order_id
+            WHERE o.state IN :pos_states AND o.order_date >= :start AND o.order_date < :end
+            UNION ALL
+            SELECT rl.product_id, COALESCE({branch}, 0), DATE(r.return_date), -rl.quantity
+            FROM pos_return_lines rl
+            JOIN pos_returns r ON r.id = rl.return_id
+            LEFT JOIN {orders} o ON o.id = r.original_order_id
+            WHERE r.state IN :return_states AND r.return_date >= :start AND r.return_date < :end
+            UNION ALL
+            SELECT l.product_id, 0, DATE(o.order_date), l.quantity
+            FROM sales_order_lines l JOIN sales_orders o ON o.id = l.order_id
+            WHERE o.state IN :sales_states AND o.order_date >= :start AND o.order_date < :end
+        ) s
+        GROUP BY product_id, branch_id, day
+        ORDER BY product_id, branch_id
+    """).bindparams(bindparam('pos_states', expanding=True), bindparam('return_states', expanding=True),
+                    bindparam('sales_states', expanding=True))
+
+
+def forecast_matrix(matrix, first_day, settings):
+    """Forecast every row of a series x day matrix of daily sales ending yesterday.
+
+    Returns a dict of arrays, one value per series.
+    """
+    matrix = np.clip(matrix, 0, None)
+    days = matrix.shape[1]
+    short_average = matrix[:, -settings['short_days']:].mean(axis=1)
+    long_average = matrix[:, -settings['long_days']:].mean(axis=1)
+    level = (short_average + long_average) / 2
+
+    # Share of a week's sales falling on each weekday, relative to a flat week
+    weekdays = (np.arange(days) + first_day.weekday()) % 7
+    overall = matrix.mean(axis=1, keepdims=True)
+    if days >= 14:
+        profile = np.stack([matrix[:, weekdays == weekday].mean(axis=1) for weekday in range(7)], axis=1)
+        factors = np.divide(profile, overall, out=np.ones_like(profile), where=overall > 0)
+    else:
+        factors = np.ones((len(matrix), 7))
+
+    horizon = (np.arange(settings['horizon_days']) + (first_day + timedelta(days=days)).weekday()) % 7
+    forecast_horizon = level * factors[:, horizon].sum(axis=1)
+
+    recent = slice(-settings['long_days'], None)
+    residuals = matrix[:, recent] - long_average[:, None] * factors[:, weekdays[recent]]
+    daily_std = residuals.std(axis=1)
+
+    z = NormalDist().inv_cdf(settings['service_level'])
+    safety_stock = z * daily_std * np.sqrt(settings['lead_days'])
+    return {
+        'short_average': short_average,
+        'long_average': long_average,
+        'daily_std': daily_std,
+        'forecast_daily': level,
+        'forecast_horizon': forecast_horizon,
+        'safety_stock': safety_stock,
+        'reorder_point': level * settings['lead_days'] + safety_stock,
+    }
+
+
+def _series_count(products, branches):
+    # Rows are ordered by product and branch
+    if not len(products):
+        return 0
+    return 1 + int(np.count_nonzero((np.diff(products) != 0) | (np.diff(branches) != 0)))
+
+
+def _write_chunk(connection, products, branches, days, quantities, first_day, settings, now):
+    # One dense matrix for the series in this chunk; the query already summed
+    # each (product, branch, day), so every cell is assigned once
+    series, index = np.unique(np.stack([products, branches], axis=1), axis=0, return_inverse=True)
+    matrix = np.zeros((len(series), settings['history_days']))
+    matrix[index.reshape(-1), days] = quantities
+    result = forecast_matrix(matrix, first_day, settings)
+
+    columns = list(result)
+    values = zip(series[:, 0].tolist(), series[:, 1].tolist(),
+                 *(np.round(result[column], 4).tolist() for column in columns))
+    connection.execute(DemandForecast.__table__.insert(), [
+        dict(zip(columns, measures), product_id=product_id, branch_id=branch_id, computed_at=now)
+        for product_id, branch_id, *measures in values])
+    return len(series)
+
+
+def run_forecast(as_of=None):
+    """Recompute demand_forecasts from the sales before as_of (default today); returns the series count"""
+    settings = _settings()
+    end = as_of or date.today()
+    first_day = end - timedelta(days=settings['history_days'])
+    first = np.datetime64(first_day, 'D')
+    now = datetime.utcnow()
+    started = time.monotonic()
+
+    count = 0
+    pending = None
+    try:
+        connection = db.session.connection()
+        connection.execute(DemandForecast.__table__.delete())
+        result = connection.execute(_history_sql(connection), {
+            'start': first_day, 'end': end,
+            'pos_states': list(POS_ORDER_STATES), 'return_states': list(POS_RETURN_STATES),
+            'sales_states': list(SALES_ORDER_STATES),
+        }, execution_options={'stream_results': True})
+
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            products, branches, days, quantities = zip(*rows)
+            fetched = [np.array(products, dtype=np.int64), np.array(branches, dtype=np.int64),
+                       (np.array(days, dtype='datetime64[D]') - first).astype(np.int64),
+                       np.array(quantities, dtype=np.float64)]
+            pending = fetched if pending is None else [np.concatenate(pair) for pair in zip(pending, fetched)]
+
+            # The last series may continue in the next fetch, so it waits
+            tail = (pending[0] == pending[0][-1]) & (pending[1] == pending[1][-1])
+            if _series_count(pending[0][~tail], pending[1][~tail]) >= settings['chunk_series']:
+                count += _write_chunk(connection, *(column[~tail] for column in pending), first_day, settings, now)
+                pending = [column[tail] for column in pending]
+
+        if pending is not None and len(pending[0]):
+            count += _write_chunk(connection, *pending, first_day, settings, now)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Demand forecast computed", extra={'series': count, 'first_day': first_day.isoformat(),
+                                                'seconds': round(time.monotonic() - started, 1)})
+    return count
+
+
+def product_forecasts(product_ids=None, branch_id=None):
+    """Forecast rows as dicts, for the reorder and transfer screens"""
+    query = DemandForecast.query
+    if product_ids:
+        query = query.filter(DemandForecast.product_id.in_(product_ids))
+    if branch_id is not None:
+        query = query.filter(DemandForecast.branch_id == branch_id)
+    return [{
+        'product_id': f.product_id, 'branch_id': f.branch_id,
+        'short_average': f.short_average, 'long_average': f.long_average,
+        'forecast_daily': f.forecast_daily, 'forecast_horizon': f.forecast_horizon,
+        'daily_std': f.daily_std, 'safety_stock': f.safety_stock, 'reorder_point': f.reorder_point,
+        'computed_at': f.computed_at.isoformat() if f.computed_at else None,
+    } for f in query.order_by(DemandForecast.product_id, DemandForecast.branch_id)]
+
+
+@forecast_bp.route('/forecasts')
+@login_required
+def forecasts_route():
+    """Forecasts for ?product_id=1&product_id=2 and/or ?branch_id="""
+    product_ids = request.args.getlist('product_id', type=int)
+    branch_id = request.args.get('branch_id', type=int)
+    if not product_ids and branch_id is None:
+        return jsonify({'error': 'Give at least one product_id or a branch_id'}), 400
+    return jsonify({'forecasts': product_forecasts(product_ids, branch_id)})
+
+
+@forecast_bp.cli.command('run')
+@click.option('--as-of', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Forecast from the sales before this day (default today)')
+def run_command(as_of):
+    """Recompute the demand forecast of every product and branch (run nightly, before `flask reorder refresh`)."""
+    count = run_forecast(as_of.date() if as_of else None)
+    print(f"Forecast {count} product/branch series")
@@ -0,0 +1,35 @@
+from datetime import datetime
+from extensions import db
+
+
+class DemandForecast(db.Model):
+    """Nightly demand forecast of one product at one branch.
+
+    Written by `flask forecast run` (modules.inventory.forecast) for every
+    product and branch with sales in the history window, replacing the
+    previous night's rows. branch_id 0 holds sales without a branch (sales
+    orders and POS orders not tied to a branch). Quantities are units:
+    moving averages and the daily forecast per day, forecast_horizon over the
+    next FORECAST_HORIZON_DAYS with the weekday pattern applied, and
+    safety_stock / reorder_point for the reorder lead time.
+    """
+    __tablename__ = 'demand_forecasts'
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'branch_id', name='uq_demand_forecasts_product_branch'),
+        db.Index('ix_demand_forecasts_branch', 'branch_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    branch_id = db.Column(db.Integer, nullable=False, default=0)
+    short_average = db.Column(db.Float, nullable=False, default=0.0)
+    long_average = db.Column(db.Float, nullable=False, default=0.0)
+    daily_std = db.Column(db.Float, nullable=False, default=0.0)
+    forecast_daily = db.Column(db.Float, nullable=False, default=0.0)
+    forecast_horizon = db.Column(db.Float, nullable=False, default=0.0)
+    safety_stock = db.Column(db.Float, nullable=False, default=0.0)
+    reorder_point = db.Column(db.Float, nullable=False, default=0.0)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DemandForecast product={self.product_id} branch={self.branch_id} {self.forecast_daily:.2f}/day>'
@@ -0,0 +1,55 @@
+from datetime import datetime
+from extensions import db
+
+
+class StockLevel(db.Model):
+    """On-hand quantity of a product at one stock location or warehouse.
+
+    Maintained by modules.inventory.reorder as stock moves are done and
+    warehouse quantities change, together with the reorder point it is
+    checked against, so low stock is read from is_low instead of scanning
+    every product. scope is 'location' (site_id a stock_locations id) or
+    'warehouse' (site_id a warehouses id, quantities from warehouse_products).
+    daily_velocity is the recent net sales per day, reorder_point the larger
+    of the product's min_stock and the sales expected over the lead time.
+    """
+    __tablename__ = 'stock_levels'
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'site_id', 'product_id', name='uq_stock_levels_site_product'),
+        db.Index('ix_stock_levels_low', 'scope', 'site_id', 'is_low'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(10), nullable=False)
+    site_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
+    quantity = db.Column(db.Float, nullable=False, default=0.0)
+    reorder_point = db.Column(db.Float, nullable=False, default=0.0)
+    daily_velocity = db.Column(db.Float, nullable=False, default=0.0)
+    is_low = db.Column(db.Boolean, nullable=False, default=False)
+    low_since = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StockLevel {self.scope} {self.site_id} product={self.product_id} {self.quantity}>'
+
+
+class ReorderAlert(db.Model):
+    """A low-stock alert already sent, at most one per product, site and day"""
+    __tablename__ = 'reorder_alerts'
+    __table_args__ = (
+        db.UniqueConstraint('alert_date', 'scope', 'site_id', 'product_id', name='uq_reorder_alerts_day'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    alert_date = db.Column(db.Date, nullable=False)
+    scope = db.Column(db.String(10), nullable=False)
+    site_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+    reorder_point = db.Column(db.Float, nullable=False)
+    suggested_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ReorderAlert {self.alert_date} {self.scope} {self.site_id} product={self.product_id}>'
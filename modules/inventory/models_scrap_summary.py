@@ -0,0 +1,32 @@
+from datetime import datetime
+from extensions import db
+
+
+class ScrapSummary(db.Model):
+    """Running scrap totals per warehouse, product and reason.
+
+    Maintained incrementally from scrap_items (see modules.inventory.scrap_pipeline)
+    so scrap valuation reports never have to scan the raw scrap log.
+    """
+    __tablename__ = 'scrap_summaries'
+    __table_args__ = (
+        db.UniqueConstraint('warehouse_id', 'product_id', 'reason', name='uq_scrap_summary_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
+    reason = db.Column(db.String(255), nullable=False)
+    pending_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+    # Everything that has left the pending state (received or discarded)
+    received_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    received_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def total_quantity(self):
+        return (self.pending_quantity or 0) + (self.received_quantity or 0)
+
+    def __repr__(self):
+        return f'<ScrapSummary wh={self.warehouse_id} product={self.product_id} reason={self.reason!r}>'
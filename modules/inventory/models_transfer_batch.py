@@ -0,0 +1,39 @@
+from datetime import datetime
+from extensions import db
+
+
+class TransferBatch(db.Model):
+    """A group of warehouse-to-shop transfer moves approved or rejected together.
+
+    The moves are stock_moves rows (reference_type 'batch_transfer') and the
+    warehouse stock taken out or put back is written as warehouse_movements
+    rows; both point back here through their transfer_batch_id column, which
+    migrations/create_transfer_batches_table.py adds. state goes from
+    pending_approval through processing (while a decision is being posted) to
+    done, or rejected when no line was approved. The line counters are set
+    when the batch is decided.
+    """
+    __tablename__ = 'transfer_batches'
+    __table_args__ = (
+        db.Index('ix_transfer_batches_state_destination', 'state', 'destination_location_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), unique=True)
+    warehouse_id = db.Column(db.Integer, db.ForeignKey('warehouses.id'), nullable=False)
+    source_location_id = db.Column(db.Integer, db.ForeignKey('stock_locations.id'), nullable=False)
+    destination_location_id = db.Column(db.Integer, db.ForeignKey('stock_locations.id'), nullable=False)
+    state = db.Column(db.String(20), nullable=False, default='pending_approval')
+    line_count = db.Column(db.Integer, nullable=False, default=0)
+    total_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    approved_lines = db.Column(db.Integer, nullable=False, default=0)
+    rejected_lines = db.Column(db.Integer, nullable=False, default=0)
+    notes = db.Column(db.Text)
+    decision_notes = db.Column(db.Text)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    decided_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    decided_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<TransferBatch {self.name} {self.state}>'
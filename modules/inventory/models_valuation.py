@@ -0,0 +1,53 @@
+from datetime import datetime
+from extensions import db
+
+
+class StockValuationLayer(db.Model):
+    """One stock valuation event for a product.
+
+    Incoming layers (opening stock, purchase receipts, supplier restocks,
+    customer returns, count surpluses) have a positive quantity and keep
+    track of what is left of them in remaining_qty/remaining_value. Outgoing
+    layers (sales, scrap, count shortages) have a negative quantity and
+    value: the cost taken off the incoming layers by FIFO or average costing. The sum of value over
+    all layers up to a point in time is the stock value at that time.
+    """
+    __tablename__ = 'stock_valuation_layers'
+    __table_args__ = (
+        db.UniqueConstraint('source_type', 'source_id', 'product_id', name='uq_valuation_layer_source'),
+        db.Index('ix_valuation_layer_product_open', 'product_id', 'remaining_qty'),
+        db.Index('ix_valuation_layer_created', 'created_at', 'product_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    quantity = db.Column(db.Float, nullable=False)
+    unit_cost = db.Column(db.Float, nullable=False, default=0.0)
+    value = db.Column(db.Float, nullable=False, default=0.0)
+    remaining_qty = db.Column(db.Float, nullable=False, default=0.0)
+    remaining_value = db.Column(db.Float, nullable=False, default=0.0)
+    source_type = db.Column(db.String(32), nullable=False)  # opening, purchase_receipt, supplier_restock, sale, return, scrap, adjustment
+    source_id = db.Column(db.Integer, nullable=False)
+    reference = db.Column(db.String(64))
+
+    def __repr__(self):
+        return f'<StockValuationLayer {self.source_type}:{self.source_id} product={self.product_id} qty={self.quantity}>'
+
+
+class StockValuationSnapshot(db.Model):
+    """Quantity and value per product at the end of snapshot_date"""
+    __tablename__ = 'stock_valuation_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('snapshot_date', 'product_id', name='uq_valuation_snapshot_product'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    snapshot_date = db.Column(db.Date, nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    quantity = db.Column(db.Float, nullable=False, default=0.0)
+    value = db.Column(db.Float, nullable=False, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StockValuationSnapshot {self.snapshot_date} product={self.product_id}>'
@@ -0,0 +1,267 @@
+"""
+Bulk posting of purchase receipts and supplier restocks into warehouse stock.
+
+Posting used to look up and update one WarehouseProduct per line and commit
+after every line, so a 2,000-line container delivery took minutes. Here a
+receipt is posted with a fixed number of statements whatever its size:
+
+- one query resolves every product;
+- one batched INSERT ... ON CONFLICT adds the quantities to the warehouse
+  product rows, creating the missing ones (warehouse_products is unique on
+  warehouse and product, see migrations/add_warehouse_products_unique_index.py);
+- one batched INSERT writes the warehouse movements;
+- for purchase receipts, one UPDATE adds the received quantities to the
+  purchase order lines;
+- the warehouse's stock levels are refreshed for the received products,
+  which clears (or raises) their low-stock flags.
+
+Everything happens in one transaction and the caller gets a per-line
+summary back.
+"""
+from datetime import datetime
+
+from flask import Blueprint, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, text
+
+from extensions import db
+from modules.core.structured_logging import get_logger
+from modules.inventory.reorder import refresh_warehouse_levels
+
+receipt_posting_bp = Blueprint('receipt_posting', __name__)
+
+log = get_logger('inventory')
+
+RECEIVING_ROLES = ('Admin', 'Manager', 'Inventory Manager', 'Inventory', 'Purchase')
+
+
+class PostingError(Exception):
+    """Raised when a receipt or restock cannot be posted"""
+
+
+_ADD_STOCK_SQL = text("""
+    INSERT INTO warehouse_products (product_id, warehouse_id, quantity, created_at, updated_at)
+    VALUES (:product_id, :warehouse_id, :quantity, :now, :now)
+    ON CONFLICT (warehouse_id, product_id)
+    DO UPDATE SET quantity = warehouse_products.quantity + excluded.quantity, updated_at = excluded.updated_at
+""")
+
+
+def add_warehouse_stock(warehouse_id, quantities, now=None):
+    """Add {product_id: quantity} to a warehouse's stock with one batched upsert"""
+    now = now or datetime.utcnow()
+    db.session.execute(_ADD_STOCK_SQL, [
+        {'product_id': product_id, 'warehouse_id': warehouse_id, 'quantity': quantity, 'now': now}
+        for product_id, quantity in quantities.items()])
+
+
+def post_warehouse_receipt(warehouse_id, lines, reference, reference_type, user_id=None, notes=None):
+    """Add received quantities to a warehouse in bulk.
+
+    lines is a list of {'line_id', 'product_id', 'quantity'}; lines for the
+    same product are added together. Does not commit: the caller owns the
+    transaction. Returns one summary dict per input line.
+    """
+    now = datetime.utcnow()
+    product_ids = {line['product_id'] for line in lines}
+    if not product_ids:
+        return []
+
+    products = {row.id: row for row in db.session.execute(text("""
+        SELECT id, name FROM products WHERE id IN :product_ids
+    """).bindparams(bindparam('product_ids', expanding=True)), {'product_ids': list(product_ids)})}
+
+    received = {}
+    summary = []
+    for line in lines:
+        product = products.get(line['product_id'])
+        quantity = line.get('quantity') or 0
+        entry = {'line_id': line.get('line_id'), 'product_id': line['product_id'], 'quantity': quantity}
+        if product is None:
+            entry['status'] = 'unknown_product'
+        elif quantity <= 0:
+            entry['status'] = 'skipped'
+        else:
+            entry.update(status='posted', product_name=product.name)
+            received[product.id] = received.get(product.id, 0) + quantity
+        summary.append(entry)
+
+    if not received:
+        return summary
+
+    add_warehouse_stock(warehouse_id, received, now)
+
+    db.session.execute(text("""
+        INSERT INTO warehouse_movements
+            (product_id, warehouse_id, quantity, movement_type, reference, reference_type,
+             created_by_id, created_at, notes)
+        VALUES
+            (:product_id, :warehouse_id, :quantity, 'in', :reference, :reference_type,
+             :user_id, :now, :notes)
+    """), [{'product_id': product_id, 'warehouse_id': warehouse_id, 'quantity': quantity,
+            'reference': reference, 'reference_type': reference_type, 'user_id': user_id,
+            'now': now, 'notes': notes} for product_id, quantity in received.items()])
+
+    refresh_warehouse_levels(db.session.connection(), warehouse_id, received)
+
+    # Report the stock level each product ended up at
+    levels = dict(db.session.execute(text("""
+        SELECT product_id, quantity FROM warehouse_products
+        WHERE warehouse_id = :warehouse_id AND product_id IN :product_ids
+    """).bindparams(bindparam('product_ids', expanding=True)),
+        {'warehouse_id': warehouse_id, 'product_ids': list(received)}).all())
+    for entry in summary:
+        if entry['status'] == 'posted':
+            entry['warehouse_quantity'] = levels.get(entry['product_id'])
+
+    return summary
+
+
+def post_supplier_restock(restock_id, user_id=None):
+    """Confirm a supplier restock and add all its items to the warehouse"""
+    from modules.inventory.valuation import value_supplier_restock
+
+    restock = db.session.execute(text("""
+        SELECT id, supplier_name, warehouse_id, status FROM supplier_restocks WHERE id = :id
+    """), {'id': restock_id}).first()
+    if restock is None:
+        raise PostingError(f'Supplier restock {restock_id} does not exist')
+
+    items = [{'line_id': row.id, 'product_id': row.product_id, 'quantity': row.quantity}
+             for row in db.session.execute(text("""
+                 SELECT id, product_id, quantity FROM supplier_restock_items WHERE restock_id = :id
+             """), {'id': restock_id})]
+    if not items:
+        raise PostingError('The restock has no items')
+
+    try:
+        # Claim the restock first so it can never be posted twice
+        claimed = db.session.execute(text("""
+            UPDATE supplier_restocks SET status = 'confirmed', confirmed_at = :now
+            WHERE id = :id AND COALESCE(status, 'pending') NOT IN ('confirmed', 'cancelled')
+        """), {'id': restock_id, 'now': datetime.utcnow()}).rowcount
+        if not claimed:
+            raise PostingError(f'Supplier restock {restock_id} has already been confirmed or was cancelled')
+
+        summary = post_warehouse_receipt(
+            restock.warehouse_id, items,
+            reference=f'Supplier Restock #{restock_id}',
+            reference_type='supplier_restock',
+            user_id=user_id,
+            notes=f'Product received from supplier: {restock.supplier_name}',
+        )
+        value_supplier_restock(db.session.connection(), restock_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Supplier restock posted", extra={'restock_id': restock_id, 'lines': len(summary)})
+    return summary
+
+
+def post_purchase_receipt(receipt_id, warehouse_id, user_id=None):
+    """Validate a purchase receipt: stock into the warehouse and received quantities onto the order"""
+    from modules.inventory.valuation import value_purchase_receipt
+
+    receipt = db.session.execute(text("""
+        SELECT r.id, r.name, r.state, r.purchase_order_id, o.name AS order_name
+        FROM purchase_receipts r
+        LEFT JOIN purchase_orders o ON o.id = r.purchase_order_id
+        WHERE r.id = :id
+    """), {'id': receipt_id}).first()
+    if receipt is None:
+        raise PostingError(f'Purchase receipt {receipt_id} does not exist')
+
+    lines = [{'line_id': row.id, 'product_id': row.product_id, 'quantity': row.quantity}
+             for row in db.session.execute(text("""
+                 SELECT id, product_id, quantity FROM purchase_receipt_lines WHERE receipt_id = :id
+             """), {'id': receipt_id})]
+    if not lines:
+        raise PostingError('The receipt has no lines')
+
+    now = datetime.utcnow()
+    try:
+        claimed = db.session.execute(text("""
+            UPDATE purchase_receipts SET state = 'done', receipt_date = COALESCE(receipt_date, :now)
+            WHERE id = :id AND COALESCE(state, 'draft') NOT IN ('done', 'cancelled')
+        """), {'id': receipt_id, 'now': now}).rowcount
+        if not claimed:
+            raise PostingError(f'Purchase receipt {receipt.name} has already been validated')
+
+        summary = post_warehouse_receipt(
+            warehouse_id, lines,
+            reference=receipt.name,
+            reference_type='purchase_receipt',
+            user_id=user_id,
+            notes=(f'Received against purchase order {receipt.order_name}' if receipt.order_name
+                   else f'Received on purchase receipt {receipt.name}'),
+        )
+
+        # Received quantities go onto the first order line for each product
+        if receipt.purchase_order_id is not None:
+            db.session.execute(text("""
+                UPDATE purchase_order_lines
+                SET received_quantity = COALESCE(received_quantity, 0) + (
+                    SELECT SUM(l.quantity) FROM purchase_receipt_lines l
+                    WHERE l.receipt_id = :receipt_id AND l.product_id = purchase_order_lines.product_id
+                )
+                WHERE order_id = :order_id
+                  AND id IN (SELECT MIN(id) FROM purchase_order_lines WHERE order_id = :order_id GROUP BY product_id)
+                  AND product_id IN (SELECT product_id FROM purchase_receipt_lines WHERE receipt_id = :receipt_id)
+            """), {'receipt_id': receipt_id, 'order_id': receipt.purchase_order_id})
+
+        value_purchase_receipt(db.session.connection(), receipt_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Purchase receipt posted", extra={'receipt_id': receipt_id, 'lines': len(summary)})
+    return summary
+
+
+def _default_warehouse_id():
+    return db.session.execute(text("SELECT MIN(id) FROM warehouses")).scalar()
+
+
+def _can_receive():
+    return any(current_user.has_role(role) for role in RECEIVING_ROLES)
+
+
+@receipt_posting_bp.route('/supplier-restocks/<int:restock_id>/post', methods=['POST'])
+@login_required
+def post_supplier_restock_route(restock_id):
+    if not _can_receive():
+        return jsonify({'error': 'You do not have permission to receive stock'}), 403
+
+    try:
+        summary = post_supplier_restock(restock_id, current_user.id)
+    except PostingError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'restock_id': restock_id, 'lines': summary})
+
+
+@receipt_posting_bp.route('/purchase-receipts/<int:receipt_id>/post', methods=['POST'])
+@login_required
+def post_purchase_receipt_route(receipt_id):
+    """Validate a purchase receipt into {"warehouse_id": ...} (defaults to the main warehouse)"""
+    if not _can_receive():
+        return jsonify({'error': 'You do not have permission to receive stock'}), 403
+
+    data = request.get_json(silent=True) or {}
+    warehouse_id = data.get('warehouse_id') or _default_warehouse_id()
+    if warehouse_id is None:
+        return jsonify({'error': 'There is no warehouse to receive into'}), 400
+    try:
+        warehouse_id = int(warehouse_id)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'warehouse_id must be a number'}), 400
+
+    try:
+        summary = post_purchase_receipt(receipt_id, warehouse_id, current_user.id)
+    except PostingError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'receipt_id': receipt_id, 'warehouse_id': warehouse_id, 'lines': summary})
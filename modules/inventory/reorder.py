@@ -0,0 +1,586 @@
+"""
+Low-stock tracking, reorder points and suggested purchase orders.
+
+Low stock was found by scanning: the dashboard checked every active
+product's available quantity, and the warehouse index compared every
+warehouse product with its min_stock, on each page view. Here the on-hand
+quantity per product and stock location (or warehouse) is kept in
+stock_levels as stock changes, together with a reorder point, and is_low is
+re-evaluated only for the rows that changed:
+
+- A done stock move adds to its destination and takes from its source;
+  an edited or deleted move has its locations recomputed. Changes to
+  warehouse_products rows set the warehouse quantity. Raw-SQL writers (receipt posting, count validation) call
+  refresh_location_levels() / refresh_warehouse_levels() for what they
+  touched.
+- `flask reorder refresh` (daily) takes each row's sales velocity from the
+  nightly demand forecast (modules.inventory.forecast) or, where there is
+  none, from the sales cube over the last REORDER_WINDOW_DAYS: net units
+  sold per day by the location's branch, or by every branch for a
+  warehouse. The reorder point is the larger of the product's min_stock
+  (REORDER_DEFAULT_MIN_STOCK when unset) and the sales expected over
+  REORDER_LEAD_DAYS plus the forecast's safety stock.
+- When a row turns low, a reorder_alerts row and a notification for the
+  Admin, Inventory Manager and Purchase users are written, at most once per
+  product, site and day.
+
+Reorder suggestions top a low row up to its reorder point plus
+REORDER_COVER_DAYS of sales (or to max_stock, when higher), and can be
+turned into a draft purchase order for a supplier.
+"""
+import math
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, event, inspect, text
+
+from extensions import db
+from modules.core.archival import history_table
+from modules.core.branch_scope import has_branch_column
+from modules.core.structured_logging import get_logger
+
+reorder_bp = Blueprint('reorder', __name__, cli_group='reorder')
+
+log = get_logger('inventory')
+
+# Users notified of low stock, and allowed to see suggestions and order
+REORDER_ROLES = ('Admin', 'Inventory Manager', 'Purchase')
+
+# Location types that hold sellable stock
+STOCKED_LOCATION_TYPES = ('internal', 'bin')
+
+LOCATION, WAREHOUSE = 'location', 'warehouse'
+
+_MOVE_FIELDS = ('state', 'quantity', 'product_id', 'source_location_id', 'destination_location_id')
+
+
+def _settings():
+    config = current_app.config
+    return {
+        'window_days': config.get('REORDER_WINDOW_DAYS', 28),
+        'lead_days': config.get('REORDER_LEAD_DAYS', 7),
+        'cover_days': config.get('REORDER_COVER_DAYS', 14),
+        'default_min': config.get('REORDER_DEFAULT_MIN_STOCK', 5),
+    }
+
+
+# --- Quantities -------------------------------------------------------------
+
+def _upsert_sql(absolute):
+    # New rows start at the product's static reorder point; `flask reorder
+    # refresh` adds the sales velocity
+    quantity = 'excluded.quantity' if absolute else 'stock_levels.quantity + excluded.quantity'
+    return text(f"""
+        INSERT INTO stock_levels (scope, site_id, product_id, quantity, reorder_point, daily_velocity, is_low, updated_at)
+        VALUES (:scope, :site_id, :product_id, :quantity,
+                COALESCE((SELECT COALESCE(NULLIF(p.min_stock, 0), :default_min) FROM products p
+                          WHERE p.id = :product_id), :default_min),
+                0, :is_low, :now)
+        ON CONFLICT (scope, site_id, product_id) DO UPDATE SET
+            quantity = {quantity},
+            updated_at = excluded.updated_at
+    """)
+
+
+def _stocked_locations(connection, location_ids):
+    location_ids = [location_id for location_id in location_ids if location_id]
+    if not location_ids:
+        return set()
+    return {row.id for row in connection.execute(text("""
+        SELECT id FROM stock_locations WHERE id IN :ids AND location_type IN :types
+    """).bindparams(bindparam('ids', expanding=True), bindparam('types', expanding=True)),
+        {'ids': location_ids, 'types': list(STOCKED_LOCATION_TYPES)})}
+
+
+def apply_changes(connection, scope, changes, absolute=False):
+    """Add (or with absolute, set) {(site_id, product_id): quantity} and re-check those rows"""
+    changes = {key: quantity for key, quantity in changes.items() if absolute or quantity}
+    if not changes:
+        return
+    now = datetime.utcnow()
+    default_min = _settings()['default_min']
+    connection.execute(_upsert_sql(absolute), [
+        {'scope': scope, 'site_id': site_id, 'product_id': product_id, 'quantity': quantity,
+         'default_min': default_min, 'is_low': False, 'now': now}
+        for (site_id, product_id), quantity in changes.items()])
+    evaluate(connection, scope, list(changes))
+
+
+def _location_quantities(connection, keys):
+    # On-hand quantity of (location, product) keys, from every done move
+    location_ids = sorted({location_id for location_id, _ in keys})
+    product_ids = sorted({product_id for _, product_id in keys})
+    rows = connection.execute(text(f"""
+        SELECT location_id, product_id, SUM(quantity) AS quantity FROM (
+            SELECT destination_location_id AS location_id, product_id, quantity
+            FROM {history_table('stock_moves')}
+            WHERE state = 'done' AND destination_location_id IN :locations AND product_id IN :products
+            UNION ALL
+            SELECT source_location_id, product_id, -quantity
+            FROM {history_table('stock_moves')}
+            WHERE state = 'done' AND source_location_id IN :locations AND product_id IN :products
+        ) m
+        GROUP BY location_id, product_id
+    """).bindparams(bindparam('locations', expanding=True), bindparam('products', expanding=True)),
+        {'locations': location_ids, 'products': product_ids})
+    quantities = {(row.location_id, row.product_id): row.quantity or 0 for row in rows}
+    return {key: quantities.get(key, 0) for key in keys}
+
+
+def refresh_location_levels(connection, location_ids, product_ids):
+    """Recompute the levels of these stocked locations and products from the done moves"""
+    stocked = _stocked_locations(connection, location_ids)
+    keys = [(location_id, product_id) for location_id in stocked for product_id in set(product_ids)]
+    if keys:
+        apply_changes(connection, LOCATION, _location_quantities(connection, keys), absolute=True)
+
+
+def refresh_warehouse_levels(connection, warehouse_id, product_ids):
+    """Recompute the levels of these warehouse products from warehouse_products"""
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return
+    rows = connection.execute(text("""
+        SELECT product_id, SUM(quantity) AS quantity FROM warehouse_products
+        WHERE warehouse_id = :warehouse_id AND product_id IN :products
+        GROUP BY product_id
+    """).bindparams(bindparam('products', expanding=True)),
+        {'warehouse_id': warehouse_id, 'products': product_ids})
+    quantities = {row.product_id: row.quantity or 0 for row in rows}
+    apply_changes(connection, WAREHOUSE, {(warehouse_id, product_id): quantities.get(product_id, 0)
+                                          for product_id in product_ids}, absolute=True)
+
+
+# --- Low-stock evaluation and alerts -----------------------------------------
+
+def suggested_quantity(row, settings, max_stock=None):
+    """Units to order to bring a level to its reorder point plus the cover period"""
+    target = row.reorder_point + row.daily_velocity * settings['cover_days']
+    if max_stock:
+        target = max(target, max_stock)
+    return max(0, math.ceil(target - row.quantity))
+
+
+def evaluate(connection, scope, keys):
+    """Flip is_low on the given (site_id, product_id) rows and alert the ones that turned low"""
+    if not keys:
+        return
+    keys = set(keys)
+    rows = connection.execute(text("""
+        SELECT id, scope, site_id, product_id, quantity, reorder_point, daily_velocity, is_low
+        FROM stock_levels
+        WHERE scope = :scope AND site_id IN :sites AND product_id IN :products
+    """).bindparams(bindparam('sites', expanding=True), bindparam('products', expanding=True)),
+        {'scope': scope, 'sites': sorted({site for site, _ in keys}),
+         'products': sorted({product for _, product in keys})})
+    _flip([row for row in rows if (row.site_id, row.product_id) in keys], connection)
+
+
+def _flip(rows, connection, notify=True):
+    now = datetime.utcnow()
+    turned_low = [row for row in rows if row.quantity < row.reorder_point and not row.is_low]
+    recovered = [row for row in rows if row.quantity >= row.reorder_point and row.is_low]
+    if turned_low:
+        connection.execute(text("UPDATE stock_levels SET is_low = :low, low_since = :now WHERE id = :id"),
+                           [{'id': row.id, 'low': True, 'now': now} for row in turned_low])
+    if recovered:
+        connection.execute(text("UPDATE stock_levels SET is_low = :low, low_since = NULL WHERE id = :id"),
+                           [{'id': row.id, 'low': False} for row in recovered])
+    if turned_low and notify:
+        _alert(connection, turned_low, now)
+
+
+def _site_names(connection, rows):
+    names = {}
+    for scope, table in ((LOCATION, 'stock_locations'), (WAREHOUSE, 'warehouses')):
+        ids = sorted({row.site_id for row in rows if row.scope == scope})
+        if ids:
+            names.update({(scope, row.id): row.name for row in connection.execute(
+                text(f"SELECT id, name FROM {table} WHERE id IN :ids")
+                .bindparams(bindparam('ids', expanding=True)), {'ids': ids})})
+    return names
+
+
+def _alert(connection, rows, now):
+    settings = _settings()
+    products = {row.id: row for row in connection.execute(text("""
+        SELECT id, name, max_stock FROM products WHERE id IN :ids
+    """).bindparams(bindparam('ids', expanding=True)), {'ids': sorted({row.product_id for row in rows})})}
+    sites = _site_names(connection, rows)
+    recipients = [row.user_id for row in connection.execute(text("""
+        SELECT DISTINCT ur.user_id FROM user_roles ur JOIN roles r ON r.id = ur.role_id
+        WHERE r.name IN :roles
+    """).bindparams(bindparam('roles', expanding=True)), {'roles': list(REORDER_ROLES)})]
+
+    notifications = []
+    for row in rows:
+        product = products.get(row.product_id)
+        suggested = suggested_quantity(row, settings, product.max_stock if product else None)
+        # The unique key keeps it to one alert per product, site and day
+        sent = connection.execute(text("""
+            INSERT INTO reorder_alerts (alert_date, scope, site_id, product_id, quantity, reorder_point,
+                                        suggested_quantity, created_at)
+            VALUES (:day, :scope, :site_id, :product_id, :quantity, :reorder_point, :suggested, :now)
+            ON CONFLICT (alert_date, scope, site_id, product_id) DO NOTHING
+        """), {'day': now.date(), 'scope': row.scope, 'site_id': row.site_id, 'product_id': row.product_id,
+               'quantity': row.quantity, 'reorder_point': row.reorder_point, 'suggested': suggested,
+               'now': now}).rowcount
+        if not sent:
+            continue
+
+        name = product.name if product else f'Product {row.product_id}'
+        site = sites.get((row.scope, row.site_id), f'{row.scope} {row.site_id}')
+        message = (f'"{name}" is low in {site}: {row.quantity:g} on hand, reorder point '
+                   f'{row.reorder_point:g}. Suggested order: {suggested}.')
+        notifications.extend({'user_id': user_id, 'title': 'Low Stock', 'message': message,
+                              'url': f'/inventory/products/{row.product_id}/view', 'now': now,
+                              'unread': False, 'action': True} for user_id in recipients)
+        log.info("Low stock alert", extra={'scope': row.scope, 'site_id': row.site_id,
+                                           'product_id': row.product_id, 'quantity': row.quantity})
+
+    if notifications:
+        connection.execute(text("""
+            INSERT INTO notifications (user_id, title, message, category, is_read, requires_action,
+                                       action_url, created_at)
+            VALUES (:user_id, :title, :message, 'warning', :unread, :action, :url, :now)
+        """), notifications)
+
+
+# --- Thresholds and full rebuild ---------------------------------------------
+
+def refresh_thresholds(notify=True):
+    """Recompute sales velocity and reorder points, then re-check every row"""
+    settings = _settings()
+    since = datetime.utcnow().date() - timedelta(days=settings['window_days'])
+    try:
+        connection = db.session.connection()
+        # Locations see their branch's sales; warehouses supply every branch
+        location_branch = "(SELECT COALESCE(l.branch_id, 0) FROM stock_locations l WHERE l.id = stock_levels.site_id)"
+        if has_branch_column(connection, 'stock_locations'):
+            cube_filter = f"AND (stock_levels.scope = 'warehouse' OR c.branch_id = {location_branch})"
+            forecast_filter = f"AND (stock_levels.scope = 'warehouse' OR f.branch_id = {location_branch})"
+        else:
+            cube_filter = forecast_filter = ""
+        # The nightly demand forecast, when it has run, replaces the flat
+        # average and adds its safety stock
+        if 'demand_forecasts' in inspect(connection).get_table_names():
+            forecast_velocity = f"""(SELECT SUM(f.forecast_daily) FROM demand_forecasts f
+                                     WHERE f.product_id = stock_levels.product_id {forecast_filter}),"""
+            safety_stock = f"""COALESCE((SELECT SUM(f.safety_stock) FROM demand_forecasts f
+                                         WHERE f.product_id = stock_levels.product_id {forecast_filter}), 0)"""
+        else:
+            forecast_velocity, safety_stock = "", "0"
+        connection.execute(text(f"""
+            UPDATE stock_levels SET daily_velocity = COALESCE({forecast_velocity} (
+                SELECT SUM(c.quantity - c.returned_quantity) FROM sales_cube c
+                WHERE c.product_id = stock_levels.product_id AND c.sale_date >= :since {cube_filter}
+            ) / :days, 0)
+        """), {'since': since, 'days': float(settings['window_days'])})
+        lead_demand = f"stock_levels.daily_velocity * :lead_days + {safety_stock}"
+        connection.execute(text(f"""
+            UPDATE stock_levels SET reorder_point = (
+                SELECT CASE WHEN {lead_demand} > COALESCE(NULLIF(p.min_stock, 0), :default_min)
+                            THEN {lead_demand}
+                            ELSE COALESCE(NULLIF(p.min_stock, 0), :default_min) END
+                FROM products p WHERE p.id = stock_levels.product_id
+            ), updated_at = :now
+        """), {'lead_days': settings['lead_days'], 'default_min': settings['default_min'],
+               'now': datetime.utcnow()})
+        changed = connection.execute(text("""
+            SELECT id, scope, site_id, product_id, quantity, reorder_point, daily_velocity, is_low
+            FROM stock_levels
+            WHERE (quantity < reorder_point AND NOT is_low) OR (quantity >= reorder_point AND is_low)
+        """)).all()
+        _flip(changed, connection, notify)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(changed)
+
+
+def rebuild_levels(notify=False):
+    """Recompute every stock level from the stock moves and warehouse products.
+
+    Rows found low are flagged without alerts unless notify is set, so the
+    first build does not notify about every product already short.
+    """
+    now = datetime.utcnow()
+    default_min = _settings()['default_min']
+    try:
+        connection = db.session.connection()
+        connection.execute(text("UPDATE stock_levels SET quantity = 0"))
+        connection.execute(text(f"""
+            INSERT INTO stock_levels (scope, site_id, product_id, quantity, reorder_point, daily_velocity, is_low, updated_at)
+            SELECT 'location', m.location_id, m.product_id, SUM(m.quantity), :default_min, 0, :is_low, :now
+            FROM (
+                SELECT destination_location_id AS location_id, product_id, quantity
+                FROM {history_table('stock_moves')} WHERE state = 'done'
+                UNION ALL
+                SELECT source_location_id, product_id, -quantity
+                FROM {history_table('stock_moves')} WHERE state = 'done'
+            ) m
+            JOIN stock_locations l ON l.id = m.location_id AND l.location_type IN :types
+            JOIN products p ON p.id = m.product_id
+            GROUP BY m.location_id, m.product_id
+            ON CONFLICT (scope, site_id, product_id) DO UPDATE SET
+                quantity = excluded.quantity, updated_at = excluded.updated_at
+        """).bindparams(bindparam('types', expanding=True)),
+            {'types': list(STOCKED_LOCATION_TYPES), 'default_min': default_min, 'is_low': False, 'now': now})
+        connection.execute(text("""
+            INSERT INTO stock_levels (scope, site_id, product_id, quantity, reorder_point, daily_velocity, is_low, updated_at)
+            SELECT 'warehouse', wp.warehouse_id, wp.product_id, SUM(wp.quantity), :default_min, 0, :is_low, :now
+            FROM warehouse_products wp
+            JOIN products p ON p.id = wp.product_id
+            WHERE wp.warehouse_id IS NOT NULL
+            GROUP BY wp.warehouse_id, wp.product_id
+            ON CONFLICT (scope, site_id, product_id) DO UPDATE SET
+                quantity = excluded.quantity, updated_at = excluded.updated_at
+        """), {'default_min': default_min, 'is_low': False, 'now': now})
+        count = connection.execute(text("SELECT COUNT(*) FROM stock_levels")).scalar()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    refresh_thresholds(notify)
+    return count
+
+
+# --- ORM listeners ----------------------------------------------------------
+
+def register_reorder_listeners():
+    """Keep stock_levels in sync with stock moves and warehouse products changed through the ORM"""
+    from modules.inventory.models import StockMove
+    from modules.inventory.models_warehouse import WarehouseProduct
+
+    if event.contains(StockMove, 'after_insert', _move_inserted):
+        return
+    event.listen(StockMove, 'after_insert', _move_inserted)
+    event.listen(StockMove, 'after_update', _move_updated)
+    event.listen(StockMove, 'after_delete', _move_deleted)
+    event.listen(WarehouseProduct, 'after_insert', _warehouse_product_inserted)
+    event.listen(WarehouseProduct, 'after_update', _warehouse_product_updated)
+    event.listen(WarehouseProduct, 'after_delete', _warehouse_product_inserted)
+
+
+def _previous(target, attribute):
+    # The value before this flush when it was loaded, otherwise the current one
+    history = inspect(target).attrs[attribute].history
+    return history.deleted[0] if history.deleted else getattr(target, attribute)
+
+
+def _move_inserted(mapper, connection, target):
+    if target.state != 'done':
+        return
+    stocked = _stocked_locations(connection, [target.source_location_id, target.destination_location_id])
+    changes = defaultdict(float)
+    if target.source_location_id in stocked:
+        changes[(target.source_location_id, target.product_id)] -= target.quantity or 0
+    if target.destination_location_id in stocked:
+        changes[(target.destination_location_id, target.product_id)] += target.quantity or 0
+    apply_changes(connection, LOCATION, changes)
+
+
+def _move_updated(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in _MOVE_FIELDS):
+        _move_deleted(mapper, connection, target)
+
+
+def _move_deleted(mapper, connection, target):
+    # Edited and deleted moves recompute the affected levels: the old
+    # quantity and state are not always loaded to reverse them
+    locations = {target.source_location_id, target.destination_location_id,
+                 _previous(target, 'source_location_id'), _previous(target, 'destination_location_id')}
+    products = {target.product_id, _previous(target, 'product_id')}
+    refresh_location_levels(connection, locations, products)
+
+
+def _warehouse_product_inserted(mapper, connection, target):
+    # Also used for deletes: the row is already gone when this is read
+    if target.warehouse_id:
+        refresh_warehouse_levels(connection, target.warehouse_id, [target.product_id])
+
+
+def _warehouse_product_updated(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[field].history.has_changes() for field in ('quantity', 'warehouse_id', 'product_id')):
+        return
+    for warehouse_id, product_id in {(_previous(target, 'warehouse_id'), _previous(target, 'product_id')),
+                                     (target.warehouse_id, target.product_id)}:
+        if warehouse_id:
+            refresh_warehouse_levels(connection, warehouse_id, [product_id])
+
+
+# --- Reads, suggestions and purchase orders ----------------------------------
+
+def _site_filter(scope, site_id):
+    filters, params = [], {}
+    if scope:
+        filters.append('s.scope = :scope')
+        params['scope'] = scope
+    if site_id:
+        filters.append('s.site_id = :site_id')
+        params['site_id'] = site_id
+    return ''.join(f' AND {condition}' for condition in filters), params
+
+
+def low_stock(scope=None, site_id=None, limit=None):
+    """The current low-stock set, lowest cover first"""
+    where, params = _site_filter(scope, site_id)
+    rows = db.session.execute(text(f"""
+        SELECT s.scope, s.site_id, s.product_id, p.name AS product_name, p.sku, s.quantity,
+               s.reorder_point, s.daily_velocity, s.low_since
+        FROM stock_levels s JOIN products p ON p.id = s.product_id
+        WHERE s.is_low AND (p.is_active IS NULL OR p.is_active = :active) {where}
+        ORDER BY s.quantity - s.reorder_point, p.name
+        {'LIMIT :limit' if limit else ''}
+    """).columns(low_since=db.DateTime), dict(params, active=True, limit=limit)).all()
+    return [dict(row._mapping) for row in rows]
+
+
+def reorder_suggestions(scope=None, site_id=None, product_ids=None):
+    """Order quantities for every low row, with the cost at the product's cost price"""
+    settings = _settings()
+    where, params = _site_filter(scope, site_id)
+    query = text(f"""
+        SELECT s.scope, s.site_id, s.product_id, p.name AS product_name, p.cost_price, p.max_stock,
+               s.quantity, s.reorder_point, s.daily_velocity
+        FROM stock_levels s JOIN products p ON p.id = s.product_id
+        WHERE s.is_low {where} {'AND s.product_id IN :product_ids' if product_ids else ''}
+        ORDER BY p.name
+    """)
+    if product_ids:
+        query = query.bindparams(bindparam('product_ids', expanding=True))
+        params['product_ids'] = list(product_ids)
+
+    suggestions = []
+    for row in db.session.execute(query, params):
+        quantity = suggested_quantity(row, settings, row.max_stock)
+        if quantity:
+            suggestions.append({
+                'scope': row.scope, 'site_id': row.site_id, 'product_id': row.product_id,
+                'product_name': row.product_name, 'on_hand': row.quantity,
+                'reorder_point': row.reorder_point, 'daily_velocity': round(row.daily_velocity, 3),
+                'suggested_quantity': quantity, 'unit_cost': row.cost_price or 0,
+                'estimated_cost': round(quantity * (row.cost_price or 0), 2),
+            })
+    return suggestions
+
+
+def create_purchase_order(supplier_id, suggestions, user_id=None):
+    """Draft purchase order for the suggested quantities (summed per product)"""
+    from modules.purchase.models import PurchaseOrder, PurchaseOrderLine
+
+    quantities, lines = defaultdict(float), {}
+    for suggestion in suggestions:
+        quantities[suggestion['product_id']] += suggestion['suggested_quantity']
+        lines[suggestion['product_id']] = suggestion
+    if not quantities:
+        return None
+
+    now = datetime.utcnow()
+    expected = now + timedelta(days=_settings()['lead_days'])
+    try:
+        year_count = db.session.execute(text("""
+            SELECT COUNT(*) FROM purchase_orders WHERE name LIKE :prefix
+        """), {'prefix': f'PO-{now:%Y}-%'}).scalar()
+        order = PurchaseOrder(
+            name=f'PO-{now:%Y}-{year_count + 1:03d}',
+            supplier_id=supplier_id,
+            order_date=now,
+            expected_date=expected,
+            state='draft',
+            total_amount=sum(quantities[product_id] * lines[product_id]['unit_cost'] for product_id in quantities),
+            tax_amount=0,
+            notes='Suggested by the reorder engine',
+            created_by=user_id,
+        )
+        db.session.add(order)
+        db.session.flush()
+        db.session.add_all([
+            PurchaseOrderLine(order_id=order.id, product_id=product_id, description=lines[product_id]['product_name'],
+                              quantity=quantity, received_quantity=0, unit_price=lines[product_id]['unit_cost'],
+                              tax_percent=0, expected_date=expected)
+            for product_id, quantity in quantities.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    log.info("Suggested purchase order created", extra={'purchase_order_id': order.id, 'lines': len(quantities)})
+    return order.id
+
+
+def _can_reorder():
+    return any(current_user.has_role(role) for role in REORDER_ROLES)
+
+
+def _scope_args(source):
+    scope = source.get('scope')
+    if scope not in (None, '', LOCATION, WAREHOUSE):
+        raise ValueError(f"scope must be '{LOCATION}' or '{WAREHOUSE}'")
+    site_id = source.get('site_id')
+    return scope or None, int(site_id) if site_id else None
+
+
+@reorder_bp.route('/reorder/low-stock')
+@login_required
+def low_stock_route():
+    """Precomputed low-stock set, optionally for ?scope=location|warehouse&site_id="""
+    try:
+        scope, site_id = _scope_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'low_stock': low_stock(scope, site_id, request.args.get('limit', type=int))})
+
+
+@reorder_bp.route('/reorder/suggestions')
+@login_required
+def suggestions_route():
+    if not _can_reorder():
+        return jsonify({'error': 'You do not have permission to see reorder suggestions'}), 403
+    try:
+        scope, site_id = _scope_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'suggestions': reorder_suggestions(scope, site_id)})
+
+
+@reorder_bp.route('/reorder/purchase-orders', methods=['POST'])
+@login_required
+def create_purchase_order_route():
+    """Draft a purchase order from {"supplier_id", "scope", "site_id", "product_ids"} suggestions"""
+    if not _can_reorder():
+        return jsonify({'error': 'You do not have permission to create purchase orders'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        scope, site_id = _scope_args(data)
+        supplier_id = int(data['supplier_id'])
+        product_ids = [int(product_id) for product_id in data.get('product_ids') or []]
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+
+    suggestions = reorder_suggestions(scope, site_id, product_ids or None)
+    order_id = create_purchase_order(supplier_id, suggestions, current_user.id)
+    if order_id is None:
+        return jsonify({'error': 'Nothing needs reordering'}), 400
+    return jsonify({'purchase_order_id': order_id, 'lines': suggestions}), 201
+
+
+@reorder_bp.cli.command('rebuild')
+@click.option('--notify', is_flag=True, help='Alert about levels that turn low')
+def rebuild_command(notify):
+    """Recompute all stock levels and reorder points from scratch."""
+    count = rebuild_levels(notify)
+    print(f"Rebuilt {count} stock levels")
+
+
+@reorder_bp.cli.command('refresh')
+def refresh_command():
+    """Recompute sales velocity and reorder points (run daily)."""
+    changed = refresh_thresholds()
+    print(f"Reorder points refreshed, {changed} levels changed state")
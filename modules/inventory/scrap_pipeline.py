@@ -0,0 +1,299 @@
+"""
+Scrap pipeline: bulk receiving of scrap items and the scrap summary table.
+
+Scrap items used to be received one at a time and the scrap valuation report
+re-aggregated the whole scrap_items log on every view. This module keeps the
+per-warehouse/product/reason totals in scrap_summaries up to date as items are
+created, received or deleted, and offers a bulk receive that marks a whole
+selection received with a single UPDATE.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+from sqlalchemy import bindparam, event, inspect, text
+
+from extensions import db
+
+scrap_pipeline_bp = Blueprint('scrap_pipeline', __name__, cli_group='scrap')
+
+# Roles allowed to receive scrap and see scrap valuation
+SCRAP_ROLES = ('Admin', 'Inventory Manager', 'Manager')
+
+_UPSERT_SUMMARY_SQL = text("""
+    INSERT INTO scrap_summaries
+        (warehouse_id, product_id, reason, pending_quantity, pending_count,
+         received_quantity, received_count, updated_at)
+    VALUES
+        (:warehouse_id, :product_id, :reason, :pending_quantity, :pending_count,
+         :received_quantity, :received_count, :updated_at)
+    ON CONFLICT (warehouse_id, product_id, reason) DO UPDATE SET
+        pending_quantity = scrap_summaries.pending_quantity + excluded.pending_quantity,
+        pending_count = scrap_summaries.pending_count + excluded.pending_count,
+        received_quantity = scrap_summaries.received_quantity + excluded.received_quantity,
+        received_count = scrap_summaries.received_count + excluded.received_count,
+        updated_at = excluded.updated_at
+""")
+
+
+def _bucket(status):
+    """Scrap items are either still pending or have been processed by the warehouse"""
+    return 'pending' if (status or 'pending') == 'pending' else 'received'
+
+
+class ScrapDelta:
+    """Accumulates summary changes so each key is written once per flush"""
+
+    def __init__(self):
+        self._rows = defaultdict(lambda: {
+            'pending_quantity': 0.0, 'pending_count': 0,
+            'received_quantity': 0.0, 'received_count': 0,
+        })
+
+    def add(self, warehouse_id, product_id, reason, status, quantity, sign=1):
+        row = self._rows[(warehouse_id, product_id, reason or '')]
+        bucket = _bucket(status)
+        row[f'{bucket}_quantity'] += sign * float(quantity or 0)
+        row[f'{bucket}_count'] += sign
+
+    def params(self):
+        now = datetime.utcnow()
+        return [
+            dict(warehouse_id=wh, product_id=prod, reason=reason, updated_at=now, **values)
+            for (wh, prod, reason), values in self._rows.items()
+            if any(values.values())
+        ]
+
+    def apply(self, connection):
+        params = self.params()
+        if params:
+            connection.execute(_UPSERT_SUMMARY_SQL, params)
+        return len(params)
+
+
+def bulk_receive(item_ids, user_id, notes=None):
+    """Mark a selection of pending scrap items as received in one transaction.
+
+    Writes one UPDATE for the scrap items, a bulk insert of the matching
+    warehouse movements and one summary upsert per (warehouse, product, reason).
+    Items that are not pending any more are skipped.
+    """
+    ids = sorted({int(i) for i in item_ids})
+    if not ids:
+        return {'received': 0, 'skipped': 0, 'quantity': 0}
+
+    pending = db.session.execute(
+        text("""
+            SELECT id, product_id, warehouse_id, quantity, reason
+            FROM scrap_items
+            WHERE status = 'pending' AND id IN :ids
+        """).bindparams(bindparam('ids', expanding=True)),
+        {'ids': ids}
+    ).fetchall()
+
+    if not pending:
+        return {'received': 0, 'skipped': len(ids), 'quantity': 0}
+
+    now = datetime.utcnow()
+    pending_ids = [row.id for row in pending]
+
+    try:
+        result = db.session.execute(
+            text("""
+                UPDATE scrap_items
+                SET status = 'received', received_by_id = :user_id, received_at = :now
+                WHERE status = 'pending' AND id IN :ids
+            """).bindparams(bindparam('ids', expanding=True)),
+            {'user_id': user_id, 'now': now, 'ids': pending_ids}
+        )
+        if result.rowcount != len(pending_ids):
+            raise ValueError("Some scrap items were received by someone else, please reload and try again")
+
+        db.session.execute(
+            text("""
+                INSERT INTO warehouse_movements
+                    (product_id, warehouse_id, quantity, movement_type, reference,
+                     reference_type, created_by_id, created_at, notes)
+                VALUES
+                    (:product_id, :warehouse_id, :quantity, 'scrap', :reference,
+                     'scrap_receive', :user_id, :now, :notes)
+            """),
+            [{
+                'product_id': row.product_id,
+                'warehouse_id': row.warehouse_id,
+                'quantity': row.quantity,
+                'reference': f'SCRAP#{row.id}',
+                'user_id': user_id,
+                'now': now,
+                'notes': notes or f'Scrap received: {row.reason}',
+            } for row in pending]
+        )
+
+        delta = ScrapDelta()
+        for row in pending:
+            delta.add(row.warehouse_id, row.product_id, row.reason, 'pending', row.quantity, sign=-1)
+            delta.add(row.warehouse_id, row.product_id, row.reason, 'received', row.quantity)
+        delta.apply(db.session.connection())
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {
+        'received': len(pending),
+        'skipped': len(ids) - len(pending),
+        'quantity': sum(row.quantity or 0 for row in pending),
+    }
+
+
+def rebuild_scrap_summary():
+    """Recompute scrap_summaries from the scrap_items log"""
+    try:
+        db.session.execute(text("DELETE FROM scrap_summaries"))
+        db.session.execute(text("""
+            INSERT INTO scrap_summaries
+                (warehouse_id, product_id, reason, pending_quantity, pending_count,
+                 received_quantity, received_count, updated_at)
+            SELECT warehouse_id, product_id, COALESCE(reason, ''),
+                   SUM(CASE WHEN COALESCE(status, 'pending') = 'pending' THEN quantity ELSE 0 END),
+                   SUM(CASE WHEN COALESCE(status, 'pending') = 'pending' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN COALESCE(status, 'pending') <> 'pending' THEN quantity ELSE 0 END),
+                   SUM(CASE WHEN COALESCE(status, 'pending') <> 'pending' THEN 1 ELSE 0 END),
+                   :now
+            FROM scrap_items
+            GROUP BY warehouse_id, product_id, COALESCE(reason, '')
+        """), {'now': datetime.utcnow()})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return db.session.execute(text("SELECT COUNT(*) FROM scrap_summaries")).scalar()
+
+
+def scrap_valuation(warehouse_id=None):
+    """Scrap quantities and value at current cost, read from the summary table"""
+    rows = db.session.execute(text("""
+        SELECT s.warehouse_id, w.name AS warehouse_name,
+               s.product_id, p.name AS product_name, p.sku,
+               s.reason, s.pending_quantity, s.received_quantity,
+               COALESCE(p.cost_price, 0) AS cost_price,
+               (s.pending_quantity + s.received_quantity) * COALESCE(p.cost_price, 0) AS total_value
+        FROM scrap_summaries s
+        JOIN products p ON p.id = s.product_id
+        JOIN warehouses w ON w.id = s.warehouse_id
+        WHERE (:warehouse_id IS NULL OR s.warehouse_id = :warehouse_id)
+          AND (s.pending_quantity <> 0 OR s.received_quantity <> 0)
+        ORDER BY total_value DESC
+    """), {'warehouse_id': warehouse_id}).mappings().all()
+
+    totals = defaultdict(lambda: {'pending_quantity': 0.0, 'received_quantity': 0.0, 'total_value': 0.0})
+    for row in rows:
+        wh = totals[row['warehouse_name']]
+        wh['pending_quantity'] += row['pending_quantity'] or 0
+        wh['received_quantity'] += row['received_quantity'] or 0
+        wh['total_value'] += row['total_value'] or 0
+
+    return {
+        'lines': [dict(row) for row in rows],
+        'warehouses': dict(totals),
+        'total_value': sum(t['total_value'] for t in totals.values()),
+    }
+
+
+def register_scrap_listeners():
+    """Keep scrap_summaries in sync with ORM changes to ScrapItem.
+
+    Bulk statements issued by bulk_receive() bypass these hooks and apply their
+    own delta, so nothing is counted twice.
+    """
+    from modules.inventory.models_scrap import ScrapItem
+
+    if event.contains(ScrapItem, 'after_insert', _scrap_inserted):
+        return
+
+    event.listen(ScrapItem, 'after_insert', _scrap_inserted)
+    event.listen(ScrapItem, 'after_update', _scrap_updated)
+    event.listen(ScrapItem, 'after_delete', _scrap_deleted)
+
+
+def _scrap_inserted(mapper, connection, target):
+    delta = ScrapDelta()
+    delta.add(target.warehouse_id, target.product_id, target.reason, target.status, target.quantity)
+    delta.apply(connection)
+
+
+def _scrap_deleted(mapper, connection, target):
+    delta = ScrapDelta()
+    delta.add(target.warehouse_id, target.product_id, target.reason, target.status, target.quantity, sign=-1)
+    delta.apply(connection)
+
+
+def _scrap_updated(mapper, connection, target):
+    state = inspect(target)
+    fields = ('warehouse_id', 'product_id', 'reason', 'status', 'quantity')
+    if not any(state.attrs[f].history.has_changes() for f in fields):
+        return
+
+    def previous(field):
+        history = state.attrs[field].history
+        return history.deleted[0] if history.deleted else getattr(target, field)
+
+    delta = ScrapDelta()
+    delta.add(previous('warehouse_id'), previous('product_id'), previous('reason'),
+              previous('status'), previous('quantity'), sign=-1)
+    delta.add(target.warehouse_id, target.product_id, target.reason, target.status, target.quantity)
+    delta.apply(connection)
+
+
+def _can_manage_scrap():
+    return any(current_user.has_role(role) for role in SCRAP_ROLES)
+
+
+@scrap_pipeline_bp.route('/bulk-receive', methods=['POST'])
+@login_required
+def bulk_receive_items():
+    """Receive a selection of scrap items at once"""
+    if not _can_manage_scrap():
+        return jsonify({'error': 'You do not have permission to receive scrap'}), 403
+
+    data = request.get_json(silent=True) or {}
+    item_ids = data.get('item_ids') or request.form.getlist('item_ids[]')
+    notes = data.get('notes') or request.form.get('notes')
+
+    try:
+        item_ids = [int(i) for i in item_ids]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid scrap item ids'}), 400
+
+    if not item_ids:
+        return jsonify({'error': 'No scrap items selected'}), 400
+
+    try:
+        summary = bulk_receive(item_ids, current_user.id, notes=notes)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        return jsonify({'error': f'Error receiving scrap items: {str(e)}'}), 500
+
+    return jsonify({'success': True, **summary})
+
+
+@scrap_pipeline_bp.route('/valuation')
+@login_required
+def valuation():
+    """Scrap valuation per warehouse, product and reason"""
+    if not _can_manage_scrap():
+        return jsonify({'error': 'You do not have permission to view scrap valuation'}), 403
+
+    warehouse_id = request.args.get('warehouse_id', type=int)
+    return jsonify(scrap_valuation(warehouse_id))
+
+
+@scrap_pipeline_bp.cli.command('rebuild-summary')
+def rebuild_summary_command():
+    """Rebuild the scrap summary table from scrap_items."""
+    count = rebuild_scrap_summary()
+    print(f"Scrap summary rebuilt: {count} rows")
@@ -0,0 +1,462 @@
+"""
+Physical inventory counts (stocktakes) done in bulk.
+
+The count sheet used to be built product by product and every variance was
+posted as its own StockMove. Here each step is a set-based statement over
+inventories/inventory_lines:
+
+- start_count() snapshots the theoretical quantity of every active product at
+  a location with one INSERT ... SELECT over the done stock moves.
+- record_counts() applies scanned or uploaded quantities with one bulk UPDATE
+  per batch; scanner batches add to what was already counted, a CSV upload
+  replaces it.
+- count_variances() computes counted minus theoretical (and its value at cost)
+  in SQL.
+- validate_count() posts every variance against the inventory loss location
+  with a single INSERT ... SELECT into stock_moves, in one transaction,
+  values the adjustments (valuation layers) and refreshes the stock levels of
+  the counted products at both locations.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+
+import click
+from flask import Blueprint, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, text
+
+from extensions import db
+from modules.core.archival import history_table
+from modules.core.structured_logging import get_logger
+from modules.inventory.reorder import STOCKED_LOCATION_TYPES, refresh_location_levels
+from modules.inventory.valuation import value_stock_moves
+
+stock_count_bp = Blueprint('stock_count', __name__, cli_group='stock-count')
+
+log = get_logger('inventory')
+
+COUNT_ROLES = ('Admin', 'Inventory Manager', 'Manager', 'Inventory')
+
+# Codes the inventory loss location has been created with over time
+LOSS_LOCATION_CODES = ('INV-LOSS', 'INVENTORY_LOSS')
+
+# Scanner lines applied per UPDATE batch when a count is streamed in
+SCAN_BATCH_SIZE = 1000
+
+
+class CountError(Exception):
+    """Raised when a count cannot be started, updated or posted"""
+
+
+def _loss_location_id():
+    row = db.session.execute(text("""
+        SELECT id FROM stock_locations
+        WHERE code IN :codes OR location_type = 'inventory_loss'
+        ORDER BY CASE WHEN code IN :codes THEN 0 ELSE 1 END,
+                 CASE WHEN warehouse_id IS NULL THEN 0 ELSE 1 END, id
+        LIMIT 1
+    """).bindparams(bindparam('codes', expanding=True)), {'codes': list(LOSS_LOCATION_CODES)}).first()
+    if row is None:
+        raise CountError('No inventory loss location (INV-LOSS) is configured')
+    return row.id
+
+
+def _open_inventory(inventory_id):
+    row = db.session.execute(
+        text("SELECT id, name, location_id, state FROM inventories WHERE id = :id"),
+        {'id': inventory_id}
+    ).first()
+    if row is None:
+        raise CountError(f'Inventory count {inventory_id} does not exist')
+    if row.state != 'in_progress':
+        raise CountError(f'Inventory count {row.name} is {row.state}')
+    return row
+
+
+def start_count(location_id, name=None, only_stocked=False):
+    """Open a count for a location and snapshot theoretical quantities.
+
+    Every active product gets a line with its quantity at the location
+    according to done stock moves and an empty (NULL) counted quantity.
+    With only_stocked, products with nothing on hand are left out.
+    Returns (inventory id, number of lines).
+    """
+    from modules.inventory.models import Inventory
+
+    location = db.session.execute(text("SELECT location_type FROM stock_locations WHERE id = :id"),
+                                  {'id': location_id}).first()
+    if location is None:
+        raise CountError(f'Location {location_id} does not exist')
+    if location.location_type not in STOCKED_LOCATION_TYPES:
+        raise CountError(f'Location {location_id} is not a stock location')
+
+    now = datetime.utcnow()
+    stocked_filter = "AND COALESCE(s.quantity, 0) <> 0" if only_stocked else ""
+    try:
+        inventory = Inventory(
+            name=name or f'Count {now:%Y-%m-%d %H:%M}',
+            location_id=location_id,
+            state='in_progress',
+            created_at=now,
+        )
+        db.session.add(inventory)
+        db.session.flush()
+
+        result = db.session.execute(text(f"""
+            INSERT INTO inventory_lines (inventory_id, product_id, theoretical_qty, product_qty)
+            SELECT :inventory_id, p.id, COALESCE(s.quantity, 0), NULL
+            FROM products p
+            LEFT JOIN (
+                SELECT product_id,
+                       SUM(CASE WHEN destination_location_id = :location_id
+                                THEN quantity ELSE -quantity END) AS quantity
+                FROM {history_table('stock_moves')}
+                WHERE state = 'done'
+                  AND (source_location_id = :location_id OR destination_location_id = :location_id)
+                  AND source_location_id <> destination_location_id
+                GROUP BY product_id
+            ) s ON s.product_id = p.id
+            WHERE (p.is_active IS NULL OR p.is_active = :active) {stocked_filter}
+        """), {'inventory_id': inventory.id, 'location_id': location_id, 'active': True})
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Inventory count started", extra={
+        'inventory_id': inventory.id, 'location_id': location_id, 'lines': result.rowcount,
+    })
+    return inventory.id, result.rowcount
+
+
+def _resolve_products(entries):
+    """Map scanned rows ({product_id|barcode|sku, quantity}) to {product_id: quantity}.
+
+    Quantities for the same product are summed, so a product counted in two
+    bins (or scanned twice) adds up. Returns (quantities, unknown codes);
+    a product_id that matches no product raises CountError.
+    """
+    quantities = {}
+    codes = {}
+    for entry in entries:
+        quantity = float(entry.get('quantity', 1) or 0)
+        product_id = entry.get('product_id')
+        if product_id not in (None, ''):
+            product_id = int(product_id)
+            quantities[product_id] = quantities.get(product_id, 0.0) + quantity
+            continue
+        code = str(entry.get('barcode') or entry.get('sku') or '').strip()
+        if code:
+            codes[code] = codes.get(code, 0.0) + quantity
+
+    if quantities:
+        known = {row.id for row in db.session.execute(text("""
+            SELECT id FROM products WHERE id IN :ids
+        """).bindparams(bindparam('ids', expanding=True)), {'ids': list(quantities)})}
+        missing = sorted(set(quantities) - known)
+        if missing:
+            raise CountError(f'Unknown products: {missing}')
+
+    if not codes:
+        return quantities, []
+
+    by_sku, by_barcode = {}, {}
+    rows = db.session.execute(text("""
+        SELECT id, sku, barcode FROM products
+        WHERE barcode IN :codes OR sku IN :codes
+    """).bindparams(bindparam('codes', expanding=True)), {'codes': list(codes)})
+    for row in rows:
+        if row.sku:
+            by_sku[row.sku] = row.id
+        if row.barcode:
+            by_barcode[row.barcode] = row.id
+
+    unknown = []
+    for code, quantity in codes.items():
+        # A barcode match wins when the same string is also some product's SKU
+        product_id = by_barcode.get(code) or by_sku.get(code)
+        if product_id is None:
+            unknown.append(code)
+        else:
+            quantities[product_id] = quantities.get(product_id, 0.0) + quantity
+
+    return quantities, sorted(unknown)
+
+
+def record_counts(inventory_id, entries, replace=False):
+    """Apply a batch of counted quantities to an open count.
+
+    With replace=False (scanner batches) quantities are added to what was
+    already counted; with replace=True (a full CSV sheet) they overwrite it.
+    Products found at the location that were not on the sheet get a line with
+    a theoretical quantity of zero. Returns a dict with the number of
+    products updated and the codes that matched no product.
+    """
+    _open_inventory(inventory_id)
+    quantities, unknown = _resolve_products(entries)
+    if not quantities:
+        return {'updated': 0, 'added': 0, 'unknown': unknown}
+
+    new_value = ":quantity" if replace else "COALESCE(product_qty, 0) + :quantity"
+    try:
+        existing = {row.product_id for row in db.session.execute(text("""
+            SELECT product_id FROM inventory_lines
+            WHERE inventory_id = :inventory_id AND product_id IN :product_ids
+        """).bindparams(bindparam('product_ids', expanding=True)),
+            {'inventory_id': inventory_id, 'product_ids': list(quantities)})}
+
+        missing = [{'inventory_id': inventory_id, 'product_id': product_id}
+                   for product_id in quantities if product_id not in existing]
+        if missing:
+            db.session.execute(text("""
+                INSERT INTO inventory_lines (inventory_id, product_id, theoretical_qty, product_qty)
+                VALUES (:inventory_id, :product_id, 0, NULL)
+            """), missing)
+
+        db.session.execute(text(f"""
+            UPDATE inventory_lines SET product_qty = {new_value}
+            WHERE inventory_id = :inventory_id AND product_id = :product_id
+        """), [{'inventory_id': inventory_id, 'product_id': product_id, 'quantity': quantity}
+               for product_id, quantity in quantities.items()])
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {'updated': len(quantities), 'added': len(missing), 'unknown': unknown}
+
+
+def parse_count_csv(stream):
+    """Read count rows from an uploaded CSV.
+
+    Needs a quantity column and one of product_id, barcode or sku.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig'))
+    fields = {name.strip().lower() for name in reader.fieldnames or ()}
+    if 'quantity' not in fields or not fields & {'product_id', 'barcode', 'sku'}:
+        raise CountError('CSV needs a quantity column and a product_id, barcode or sku column')
+    for row in reader:
+        yield {key.strip().lower(): value for key, value in row.items() if key}
+
+
+def count_variances(inventory_id, limit=None):
+    """Counted minus theoretical quantity (and value at cost) for every counted line that differs"""
+    limit_clause = "LIMIT :limit" if limit else ""
+    rows = db.session.execute(text(f"""
+        SELECT l.product_id, p.name, p.sku, p.barcode,
+               COALESCE(l.theoretical_qty, 0) AS theoretical_qty,
+               l.product_qty AS counted_qty,
+               l.product_qty - COALESCE(l.theoretical_qty, 0) AS variance,
+               (l.product_qty - COALESCE(l.theoretical_qty, 0)) * COALESCE(p.cost_price, 0) AS variance_value
+        FROM inventory_lines l
+        JOIN products p ON p.id = l.product_id
+        WHERE l.inventory_id = :inventory_id
+          AND l.product_qty IS NOT NULL
+          AND l.product_qty <> COALESCE(l.theoretical_qty, 0)
+        ORDER BY ABS((l.product_qty - COALESCE(l.theoretical_qty, 0)) * COALESCE(p.cost_price, 0)) DESC
+        {limit_clause}
+    """), {'inventory_id': inventory_id, 'limit': limit})
+    return [dict(row) for row in rows.mappings()]
+
+
+def count_progress(inventory_id):
+    row = db.session.execute(text("""
+        SELECT COUNT(*) AS lines,
+               SUM(CASE WHEN product_qty IS NOT NULL THEN 1 ELSE 0 END) AS counted,
+               SUM(CASE WHEN product_qty IS NOT NULL
+                         AND product_qty <> COALESCE(theoretical_qty, 0) THEN 1 ELSE 0 END) AS variances
+        FROM inventory_lines WHERE inventory_id = :inventory_id
+    """), {'inventory_id': inventory_id}).mappings().first()
+    return {key: int(value or 0) for key, value in row.items()}
+
+
+def validate_count(inventory_id, user_id=None, zero_uncounted=False):
+    """Post all variances of a count to the inventory loss location in one transaction.
+
+    Surpluses move stock from the loss location into the counted location,
+    shortages the other way round. Lines nobody counted are skipped unless
+    zero_uncounted is set, in which case they are treated as counted empty.
+    Returns the number of stock moves created.
+    """
+    inventory = _open_inventory(inventory_id)
+    loss_location_id = _loss_location_id()
+    now = datetime.utcnow()
+
+    try:
+        # Claim the count first so two validations cannot both post it
+        claimed = db.session.execute(text("""
+            UPDATE inventories SET state = 'posting'
+            WHERE id = :id AND state = 'in_progress'
+        """), {'id': inventory_id}).rowcount
+        if not claimed:
+            raise CountError(f'Inventory count {inventory.name} is already being posted')
+
+        if zero_uncounted:
+            db.session.execute(text("""
+                UPDATE inventory_lines SET product_qty = 0
+                WHERE inventory_id = :inventory_id AND product_qty IS NULL
+            """), {'inventory_id': inventory_id})
+
+        posted = db.session.execute(text("""
+            INSERT INTO stock_moves
+                (product_id, source_location_id, destination_location_id, quantity, state,
+                 reference, reference_type, created_at, scheduled_date, effective_date,
+                 created_by_id, notes)
+            SELECT l.product_id,
+                   CASE WHEN l.product_qty > COALESCE(l.theoretical_qty, 0) THEN :loss_id ELSE :location_id END,
+                   CASE WHEN l.product_qty > COALESCE(l.theoretical_qty, 0) THEN :location_id ELSE :loss_id END,
+                   ABS(l.product_qty - COALESCE(l.theoretical_qty, 0)),
+                   'done', :reference, 'adjustment', :now, :now, :now, :user_id, :notes
+            FROM inventory_lines l
+            WHERE l.inventory_id = :inventory_id
+              AND l.product_qty IS NOT NULL
+              AND l.product_qty <> COALESCE(l.theoretical_qty, 0)
+            RETURNING id, product_id
+        """), {
+            'inventory_id': inventory_id,
+            'location_id': inventory.location_id,
+            'loss_id': loss_location_id,
+            'reference': inventory.name,
+            'now': now,
+            'user_id': user_id,
+            'notes': f'Physical inventory count #{inventory_id}',
+        }).all()
+        moves = len(posted)
+
+        if posted:
+            # The INSERT ... SELECT bypasses the ORM events that value moves
+            connection = db.session.connection()
+            value_stock_moves(connection, [move.id for move in posted])
+            refresh_location_levels(connection, [inventory.location_id, loss_location_id],
+                                    {move.product_id for move in posted})
+
+        db.session.execute(text("""
+            UPDATE inventories SET state = 'done', validated_at = :now WHERE id = :id
+        """), {'id': inventory_id, 'now': now})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Inventory count validated", extra={'inventory_id': inventory_id, 'moves': moves})
+    return moves
+
+
+def _can_count():
+    return any(current_user.has_role(role) for role in COUNT_ROLES)
+
+
+def _iter_scan_batches(stream):
+    """Yield lists of scanner rows from a newline-delimited JSON body"""
+    batch = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(json.loads(line))
+        if len(batch) >= SCAN_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@stock_count_bp.route('/counts', methods=['POST'])
+@login_required
+def start_count_route():
+    """Open a count: {"location_id": 1, "name": "Q2 count", "only_stocked": false}"""
+    if not _can_count():
+        return jsonify({'error': 'You do not have permission to run inventory counts'}), 403
+
+    data = request.get_json(silent=True) or {}
+    location_id = data.get('location_id')
+    if not location_id:
+        return jsonify({'error': 'location_id is required'}), 400
+
+    try:
+        inventory_id, lines = start_count(int(location_id), data.get('name'), bool(data.get('only_stocked')))
+    except CountError as e:
+        return jsonify({'error': str(e)}), 400
+    except (TypeError, ValueError):
+        return jsonify({'error': 'location_id must be a number'}), 400
+    return jsonify({'inventory_id': inventory_id, 'lines': lines}), 201
+
+
+@stock_count_bp.route('/counts/<int:inventory_id>/lines', methods=['POST'])
+@login_required
+def record_counts_route(inventory_id):
+    """Record counted quantities.
+
+    Accepts a CSV upload (field "file", replaces counted quantities), a
+    newline-delimited JSON stream of scanner rows, or a JSON body
+    {"scans": [{"barcode": "...", "quantity": 1}, ...], "replace": false}.
+    """
+    if not _can_count():
+        return jsonify({'error': 'You do not have permission to run inventory counts'}), 403
+
+    try:
+        if 'file' in request.files:
+            result = record_counts(inventory_id, list(parse_count_csv(request.files['file'].stream)),
+                                   replace=True)
+        elif request.mimetype == 'application/x-ndjson':
+            result = {'updated': 0, 'added': 0, 'unknown': []}
+            for batch in _iter_scan_batches(request.stream):
+                applied = record_counts(inventory_id, batch)
+                result['updated'] += applied['updated']
+                result['added'] += applied['added']
+                result['unknown'].extend(applied['unknown'])
+        else:
+            data = request.get_json(silent=True) or {}
+            result = record_counts(inventory_id, data.get('scans') or [], replace=bool(data.get('replace')))
+    except CountError as e:
+        return jsonify({'error': str(e)}), 400
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid count data: {e}'}), 400
+
+    result['progress'] = count_progress(inventory_id)
+    return jsonify(result)
+
+
+@stock_count_bp.route('/counts/<int:inventory_id>/variances')
+@login_required
+def variances_route(inventory_id):
+    if not _can_count():
+        return jsonify({'error': 'You do not have permission to run inventory counts'}), 403
+
+    variances = count_variances(inventory_id, limit=request.args.get('limit', type=int))
+    return jsonify({
+        'inventory_id': inventory_id,
+        'progress': count_progress(inventory_id),
+        'total_value': sum(row['variance_value'] or 0 for row in variances),
+        'variances': variances,
+    })
+
+
+@stock_count_bp.route('/counts/<int:inventory_id>/validate', methods=['POST'])
+@login_required
+def validate_count_route(inventory_id):
+    if not any(current_user.has_role(role) for role in ('Admin', 'Inventory Manager', 'Manager')):
+        return jsonify({'error': 'Only managers can post inventory counts'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        moves = validate_count(inventory_id, current_user.id, bool(data.get('zero_uncounted')))
+    except CountError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({'inventory_id': inventory_id, 'moves': moves})
+
+
+@stock_count_bp.cli.command('import')
+@click.argument('inventory_id', type=int)
+@click.argument('csv_file', type=click.File('rb'))
+def import_counts_command(inventory_id, csv_file):
+    """Load a count sheet CSV into an open inventory count."""
+    result = record_counts(inventory_id, list(parse_count_csv(csv_file)), replace=True)
+    print(f"Counted {result['updated']} products ({result['added']} not on the sheet)")
+    if result['unknown']:
+        print(f"Unknown codes: {', '.join(result['unknown'])}")
@@ -0,0 +1,448 @@
+"""
+Warehouse-to-shop transfers created, approved and rejected in batches.
+
+Every transfer used to be its own StockMove, approved or rejected one by one
+by the shop manager with a commit per click, and a rejection had to put the
+deducted warehouse stock back by hand (fix_rejected_transfers.py repaired
+the ones that did not). A daily replenishment of a shop is hundreds of
+moves. Here a transfer_batches row groups them:
+
+- create_batch() checks the warehouse stock of every product in one query,
+  deducts it with one batched UPDATE and writes the pending stock moves and
+  the 'out' warehouse movements with one batched INSERT each.
+- approve_batch() marks every pending move of the batch done in one UPDATE.
+  Moves passed as rejected, or all of them with reject_batch(), are marked
+  rejected and their quantities go back to the warehouse with one batched
+  upsert and 'in' warehouse movements, in the same transaction.
+- Moves and warehouse movements carry transfer_batch_id, so
+  batch_progress() counts approved, rejected and pending lines per batch
+  with one GROUP BY, including moves still decided one at a time.
+
+Creating, approving and rejecting a batch are recorded in the activity
+feed. Branch users only see batches for locations of their branch
+(stock_locations.branch_id) or shared ones without a branch.
+"""
+import math
+from collections import defaultdict
+from datetime import datetime
+
+from flask import Blueprint, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, text
+
+from extensions import db
+from modules.core.audit_log import record_activity
+from modules.core.branch_scope import current_branch_id, has_branch_column
+from modules.core.structured_logging import get_logger
+from modules.inventory.models_transfer_batch import TransferBatch
+from modules.inventory.receipt_posting import add_warehouse_stock
+from modules.inventory.reorder import STOCKED_LOCATION_TYPES, refresh_location_levels, refresh_warehouse_levels
+
+transfer_batches_bp = Blueprint('transfer_batches', __name__)
+
+log = get_logger('inventory')
+
+# Roles that send stock to the shops, and roles that accept it there
+SENDING_ROLES = ('Admin', 'Manager', 'Inventory Manager', 'Inventory')
+APPROVING_ROLES = ('Admin', 'Manager', 'Shop Manager')
+
+PENDING, PROCESSING, DONE, REJECTED = 'pending_approval', 'processing', 'done', 'rejected'
+
+
+class TransferError(Exception):
+    """Raised when a transfer batch cannot be created or decided"""
+
+
+def _source_location_id(warehouse_id):
+    # The location warehouse transfers leave from: its input location, else its stock
+    row = db.session.execute(text("""
+        SELECT id FROM stock_locations
+        WHERE warehouse_id = :warehouse_id AND location_type IN ('input', 'internal')
+        ORDER BY CASE location_type WHEN 'input' THEN 0 ELSE 1 END, id
+        LIMIT 1
+    """), {'warehouse_id': warehouse_id}).first()
+    if row is None:
+        raise TransferError(f'Warehouse {warehouse_id} has no stock location to transfer from')
+    return row.id
+
+
+def _check_destination(location_id):
+    # Moves into a missing or non-stock location would strand the stock (or
+    # fail on the foreign key mid-batch)
+    row = db.session.execute(text("SELECT location_type FROM stock_locations WHERE id = :id"),
+                             {'id': location_id}).first()
+    if row is None:
+        raise TransferError(f'Destination location {location_id} does not exist')
+    if row.location_type not in STOCKED_LOCATION_TYPES:
+        raise TransferError(f'Destination location {location_id} is not a stock location')
+
+
+def _warehouse_stock(warehouse_id, product_ids):
+    return {row.product_id: row for row in db.session.execute(text("""
+        SELECT p.id AS product_id, p.name, wp.id AS warehouse_product_id, COALESCE(wp.quantity, 0) AS quantity
+        FROM products p
+        LEFT JOIN warehouse_products wp ON wp.product_id = p.id AND wp.warehouse_id = :warehouse_id
+        WHERE p.id IN :product_ids
+    """).bindparams(bindparam('product_ids', expanding=True)),
+        {'warehouse_id': warehouse_id, 'product_ids': list(product_ids)})}
+
+
+def _movements(batch, quantities, movement_type, reference, reference_type, user_id, now, notes):
+    db.session.execute(text("""
+        INSERT INTO warehouse_movements
+            (product_id, warehouse_id, quantity, movement_type, reference, reference_type,
+             created_by_id, created_at, notes, transfer_batch_id)
+        VALUES
+            (:product_id, :warehouse_id, :quantity, :movement_type, :reference, :reference_type,
+             :user_id, :now, :notes, :batch_id)
+    """), [{'product_id': product_id, 'warehouse_id': batch.warehouse_id, 'quantity': quantity,
+            'movement_type': movement_type, 'reference': reference, 'reference_type': reference_type,
+            'user_id': user_id, 'now': now, 'notes': notes, 'batch_id': batch.id}
+           for product_id, quantity in quantities.items()])
+
+
+def create_batch(warehouse_id, destination_location_id, lines, user_id=None, notes=None, source_location_id=None):
+    """Deduct the lines' stock from a warehouse and queue them for the shop to approve.
+
+    lines is a list of {'product_id', 'quantity'}; lines for the same product
+    become one move. Returns the new batch.
+    """
+    quantities = defaultdict(float)
+    for line in lines:
+        quantity = float(line['quantity'])
+        # NaN and infinity pass both comparisons below and would poison the stock
+        if not math.isfinite(quantity) or quantity <= 0:
+            raise TransferError(f"Quantity for product {line['product_id']} must be a positive number")
+        quantities[int(line['product_id'])] += quantity
+    if not quantities:
+        raise TransferError('A transfer batch needs at least one line')
+
+    now = datetime.utcnow()
+    try:
+        source_location_id = source_location_id or _source_location_id(warehouse_id)
+        _check_destination(destination_location_id)
+        stock = _warehouse_stock(warehouse_id, quantities)
+        missing = sorted(set(quantities) - set(stock))
+        if missing:
+            raise TransferError(f'Unknown products: {missing}')
+        short = [f'{stock[product_id].name} ({stock[product_id].quantity:g} < {quantity:g})'
+                 for product_id, quantity in quantities.items() if stock[product_id].quantity < quantity]
+        if short:
+            raise TransferError('Not enough warehouse stock: ' + ', '.join(short))
+
+        batch = TransferBatch(
+            warehouse_id=warehouse_id,
+            source_location_id=source_location_id,
+            destination_location_id=destination_location_id,
+            state=PENDING,
+            line_count=len(quantities),
+            total_quantity=sum(quantities.values()),
+            notes=notes,
+            created_by_id=user_id,
+            created_at=now,
+        )
+        db.session.add(batch)
+        db.session.flush()
+        batch.name = f'TB-{batch.id:05d}'
+        db.session.flush()
+
+        db.session.execute(text("""
+            UPDATE warehouse_products SET quantity = quantity - :quantity, updated_at = :now WHERE id = :id
+        """), [{'id': stock[product_id].warehouse_product_id, 'quantity': quantity, 'now': now}
+               for product_id, quantity in quantities.items()])
+        # Another transfer may have taken the same stock since it was checked
+        oversold = db.session.execute(text("""
+            SELECT COUNT(*) FROM warehouse_products WHERE id IN :ids AND quantity < 0
+        """).bindparams(bindparam('ids', expanding=True)),
+            {'ids': [stock[product_id].warehouse_product_id for product_id in quantities]}).scalar()
+        if oversold:
+            raise TransferError('Warehouse stock changed while the batch was created, please retry')
+
+        db.session.execute(text("""
+            INSERT INTO stock_moves
+                (product_id, source_location_id, destination_location_id, quantity, state,
+                 reference, reference_type, created_at, scheduled_date, created_by_id, notes,
+                 transfer_batch_id)
+            VALUES
+                (:product_id, :source_id, :destination_id, :quantity, :state,
+                 :reference, 'batch_transfer', :now, :now, :user_id, :notes, :batch_id)
+        """), [{'product_id': product_id, 'source_id': source_location_id,
+                'destination_id': destination_location_id, 'quantity': quantity, 'state': PENDING,
+                'reference': batch.name, 'now': now, 'user_id': user_id, 'notes': notes,
+                'batch_id': batch.id} for product_id, quantity in quantities.items()])
+        _movements(batch, quantities, 'out', batch.name, 'transfer', user_id, now,
+                   f'Deducted for transfer batch {batch.name}')
+        refresh_warehouse_levels(db.session.connection(), warehouse_id, quantities)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Transfer batch created", extra={'batch_id': batch.id, 'lines': len(quantities),
+                                              'warehouse_id': warehouse_id,
+                                              'destination_location_id': destination_location_id})
+    return batch
+
+
+def _restore(batch, moves, user_id, now):
+    # Put the stock of rejected moves back into the warehouse
+    quantities = defaultdict(float)
+    for move in moves:
+        quantities[move.product_id] += move.quantity
+    add_warehouse_stock(batch.warehouse_id, quantities, now)
+    _movements(batch, quantities, 'in', f'Rejected {batch.name}', 'transfer_reject', user_id, now,
+               f'Restored for rejected transfer batch {batch.name}')
+    refresh_warehouse_levels(db.session.connection(), batch.warehouse_id, quantities)
+
+
+def _decide(batch_id, user_id, reject_move_ids, notes):
+    now = datetime.utcnow()
+    try:
+        # Claim the batch first so two decisions cannot both post it
+        claimed = db.session.execute(text("""
+            UPDATE transfer_batches SET state = :processing WHERE id = :id AND state = :pending
+        """), {'id': batch_id, 'processing': PROCESSING, 'pending': PENDING}).rowcount
+        batch = db.session.get(TransferBatch, batch_id)
+        if batch is None:
+            raise TransferError(f'Transfer batch {batch_id} not found')
+        if not claimed:
+            raise TransferError(f'Transfer batch {batch.name} has already been decided')
+
+        moves = db.session.execute(text("""
+            SELECT id, product_id, quantity FROM stock_moves
+            WHERE transfer_batch_id = :batch_id AND state = :pending
+        """), {'batch_id': batch_id, 'pending': PENDING}).all()
+        if reject_move_ids is None:
+            reject_move_ids = {move.id for move in moves}
+        unknown = set(reject_move_ids) - {move.id for move in moves}
+        if unknown:
+            raise TransferError(f'Moves {sorted(unknown)} are not pending in batch {batch.name}')
+        rejected = [move for move in moves if move.id in reject_move_ids]
+        approved = [move for move in moves if move.id not in reject_move_ids]
+
+        decision = {'user_id': user_id, 'now': now, 'notes': notes}
+        if approved:
+            db.session.execute(text("""
+                UPDATE stock_moves SET state = 'done', approved_by_id = :user_id, approved_at = :now,
+                                       effective_date = :now, approval_notes = :notes
+                WHERE id IN :ids
+            """).bindparams(bindparam('ids', expanding=True)),
+                dict(decision, ids=[move.id for move in approved]))
+            refresh_location_levels(db.session.connection(),
+                                    [batch.source_location_id, batch.destination_location_id],
+                                    {move.product_id for move in approved})
+        if rejected:
+            db.session.execute(text("""
+                UPDATE stock_moves SET state = 'rejected', approved_by_id = :user_id, approved_at = :now,
+                                       approval_notes = :notes
+                WHERE id IN :ids
+            """).bindparams(bindparam('ids', expanding=True)),
+                dict(decision, ids=[move.id for move in rejected]))
+            _restore(batch, rejected, user_id, now)
+
+        batch.state = DONE if approved or not moves else REJECTED
+        batch.approved_lines = (batch.approved_lines or 0) + len(approved)
+        batch.rejected_lines = (batch.rejected_lines or 0) + len(rejected)
+        batch.decided_by_id = user_id
+        batch.decided_at = now
+        batch.decision_notes = notes
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Transfer batch decided", extra={'batch_id': batch_id, 'approved': len(approved),
+                                              'rejected': len(rejected)})
+    return {'batch_id': batch_id, 'name': batch.name, 'state': batch.state,
+            'approved': len(approved), 'rejected': len(rejected)}
+
+
+def approve_batch(batch_id, user_id, reject_move_ids=(), notes=None):
+    """Accept every pending move of a batch except reject_move_ids, in one transaction"""
+    return _decide(batch_id, user_id, set(reject_move_ids), notes)
+
+
+def reject_batch(batch_id, user_id, notes=None):
+    """Reject every pending move of a batch and return the stock to the warehouse"""
+    return _decide(batch_id, user_id, None, notes)
+
+
+def batch_progress(batch_ids):
+    """{batch_id: line and quantity counts by state} for the given batches"""
+    if not batch_ids:
+        return {}
+    rows = db.session.execute(text("""
+        SELECT transfer_batch_id,
+               COUNT(*) AS lines,
+               SUM(CASE WHEN state = 'done' THEN 1 ELSE 0 END) AS approved,
+               SUM(CASE WHEN state = 'rejected' THEN 1 ELSE 0 END) AS rejected,
+               SUM(CASE WHEN state = :pending THEN 1 ELSE 0 END) AS pending,
+               SUM(quantity) AS quantity,
+               SUM(CASE WHEN state = 'done' THEN quantity ELSE 0 END) AS approved_quantity
+        FROM stock_moves
+        WHERE transfer_batch_id IN :ids
+        GROUP BY transfer_batch_id
+    """).bindparams(bindparam('ids', expanding=True)), {'ids': list(batch_ids), 'pending': PENDING})
+    progress = {}
+    for row in rows:
+        decided = (row.approved or 0) + (row.rejected or 0)
+        progress[row.transfer_batch_id] = {
+            'lines': row.lines, 'approved': row.approved or 0, 'rejected': row.rejected or 0,
+            'pending': row.pending or 0, 'quantity': row.quantity or 0,
+            'approved_quantity': row.approved_quantity or 0,
+            'percent_decided': round(100.0 * decided / row.lines, 1) if row.lines else 100.0,
+        }
+    return progress
+
+
+def _batch_dict(batch, progress):
+    return {
+        'id': batch.id, 'name': batch.name, 'state': batch.state,
+        'warehouse_id': batch.warehouse_id, 'source_location_id': batch.source_location_id,
+        'destination_location_id': batch.destination_location_id,
+        'line_count': batch.line_count, 'total_quantity': batch.total_quantity,
+        'notes': batch.notes, 'decision_notes': batch.decision_notes,
+        'created_by_id': batch.created_by_id,
+        'created_at': batch.created_at.isoformat() if batch.created_at else None,
+        'decided_by_id': batch.decided_by_id,
+        'decided_at': batch.decided_at.isoformat() if batch.decided_at else None,
+        'progress': progress.get(batch.id),
+    }
+
+
+def _branch_locations(branch_id):
+    # Locations without a branch are shared by every branch, as in
+    # branch_scope; None while stock_locations has no branch_id column
+    if not has_branch_column(db.session.connection(), 'stock_locations'):
+        return None
+    return [row.id for row in db.session.execute(
+        text("SELECT id FROM stock_locations WHERE branch_id = :branch_id OR branch_id IS NULL"),
+        {'branch_id': branch_id})]
+
+
+def _in_branch(batch):
+    # Branch users only see and decide batches for their own shop
+    branch_id = current_branch_id()
+    if branch_id is None:
+        return True
+    locations = _branch_locations(branch_id)
+    return locations is None or batch.destination_location_id in locations
+
+
+def _can(roles):
+    return any(current_user.has_role(role) for role in roles)
+
+
+def _record_decision(action, result):
+    record_activity(
+        description=f"Transfer batch {action}: {result['name']}",
+        details=f"{result['approved']} lines approved, {result['rejected']} rejected",
+        user=current_user.username,
+        activity_type="transfer"
+    )
+
+
+@transfer_batches_bp.route('/transfer-batches', methods=['POST'])
+@login_required
+def create_batch_route():
+    """Create a batch from {"warehouse_id", "destination_location_id", "lines": [{"product_id", "quantity"}], "notes"}"""
+    if not _can(SENDING_ROLES):
+        return jsonify({'error': 'You do not have permission to transfer stock'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        batch = create_batch(int(data['warehouse_id']), int(data['destination_location_id']),
+                             data.get('lines') or [], current_user.id, data.get('notes'))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    except TransferError as e:
+        return jsonify({'error': str(e)}), 400
+
+    record_activity(
+        description=f"Transfer batch created: {batch.name}",
+        details=f"{batch.line_count} lines, {batch.total_quantity:g} units to location {batch.destination_location_id}",
+        user=current_user.username,
+        activity_type="transfer"
+    )
+    return jsonify(_batch_dict(batch, batch_progress([batch.id]))), 201
+
+
+@transfer_batches_bp.route('/transfer-batches')
+@login_required
+def list_batches_route():
+    """Batches with their progress, newest first, optionally ?state=&destination_location_id="""
+    query = TransferBatch.query
+    if request.args.get('state'):
+        query = query.filter(TransferBatch.state == request.args['state'])
+    destination_id = request.args.get('destination_location_id', type=int)
+    if destination_id:
+        query = query.filter(TransferBatch.destination_location_id == destination_id)
+    branch_id = current_branch_id()
+    locations = _branch_locations(branch_id) if branch_id is not None else None
+    if locations is not None:
+        query = query.filter(TransferBatch.destination_location_id.in_(locations))
+
+    batches = query.order_by(TransferBatch.created_at.desc()).limit(request.args.get('limit', 50, type=int)).all()
+    progress = batch_progress([batch.id for batch in batches])
+    return jsonify({'batches': [_batch_dict(batch, progress) for batch in batches]})
+
+
+@transfer_batches_bp.route('/transfer-batches/<int:batch_id>')
+@login_required
+def batch_detail_route(batch_id):
+    batch = db.session.get(TransferBatch, batch_id)
+    if batch is None or not _in_branch(batch):
+        return jsonify({'error': 'Transfer batch not found'}), 404
+
+    lines = db.session.execute(text("""
+        SELECT m.id, m.product_id, p.name AS product_name, m.quantity, m.state, m.approved_at
+        FROM stock_moves m JOIN products p ON p.id = m.product_id
+        WHERE m.transfer_batch_id = :batch_id
+        ORDER BY p.name
+    """).columns(approved_at=db.DateTime), {'batch_id': batch_id})
+    result = _batch_dict(batch, batch_progress([batch_id]))
+    result['lines'] = [dict(line._mapping, approved_at=line.approved_at.isoformat() if line.approved_at else None)
+                       for line in lines]
+    return jsonify(result)
+
+
+@transfer_batches_bp.route('/transfer-batches/<int:batch_id>/approve', methods=['POST'])
+@login_required
+def approve_batch_route(batch_id):
+    """Approve a batch; {"reject_move_ids": [...]} rejects those lines in the same step"""
+    if not _can(APPROVING_ROLES):
+        return jsonify({'error': 'You do not have permission to approve transfers'}), 403
+    batch = db.session.get(TransferBatch, batch_id)
+    if batch is None or not _in_branch(batch):
+        return jsonify({'error': 'Transfer batch not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        reject_move_ids = [int(move_id) for move_id in data.get('reject_move_ids') or []]
+        result = approve_batch(batch_id, current_user.id, reject_move_ids, data.get('notes'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+    except TransferError as e:
+        return jsonify({'error': str(e)}), 400
+
+    _record_decision('approved', result)
+    return jsonify(result)
+
+
+@transfer_batches_bp.route('/transfer-batches/<int:batch_id>/reject', methods=['POST'])
+@login_required
+def reject_batch_route(batch_id):
+    if not _can(APPROVING_ROLES):
+        return jsonify({'error': 'You do not have permission to reject transfers'}), 403
+    batch = db.session.get(TransferBatch, batch_id)
+    if batch is None or not _in_branch(batch):
+        return jsonify({'error': 'Transfer batch not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        result = reject_batch(batch_id, current_user.id, data.get('notes'))
+    except TransferError as e:
+        return jsonify({'error': str(e)}), 400
+
+    _record_decision('rejected', result)
+    return jsonify(result)
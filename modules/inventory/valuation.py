@@ -0,0 +1,544 @@
+"""
+Stock valuation from FIFO or average cost layers.
+
+Inventory value used to be sum(available_quantity * cost_price) over every
+product in Python, which ignores what the stock actually cost when it came
+in. Here every valued stock event writes a row to stock_valuation_layers:
+
+- purchase receipts and confirmed supplier restocks create incoming layers
+  at their purchase cost, and initial warehouse receipts (opening stock)
+  come in at the product's cost price;
+- sales, returns to suppliers, scrap and count shortages consume layers,
+  oldest first (FIFO) or at the running average (INVENTORY_COSTING_METHOD);
+- customer returns and count surpluses come back in at the current cost.
+
+Valuation is a SUM over the layers. For a past date the latest
+stock_valuation_snapshots row per product is used and only the layers
+created after it are added, so month-end figures stay fast and keep the
+costs that applied at the time. Take a snapshot at each period close with
+``flask valuation snapshot``.
+"""
+from datetime import date, datetime, time, timedelta
+
+import click
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, event, inspect, text
+
+from extensions import db
+from modules.core.archival import history_table
+from modules.core.structured_logging import get_logger
+
+valuation_bp = Blueprint('valuation', __name__, cli_group='valuation')
+
+log = get_logger('inventory')
+
+VALUATION_ROLES = ('Admin', 'Manager', 'Inventory Manager')
+
+# Stock in these locations is company stock and carries value
+VALUED_LOCATION_TYPES = ('internal', 'bin', 'input', 'output')
+
+RECEIVED_RECEIPT_STATES = ('done', 'received')
+
+# Remaining quantities below this are treated as used up
+EPSILON = 1e-6
+
+_INSERT_LAYER_SQL = text("""
+    INSERT INTO stock_valuation_layers
+        (product_id, created_at, quantity, unit_cost, value, remaining_qty, remaining_value,
+         source_type, source_id, reference)
+    VALUES
+        (:product_id, :created_at, :quantity, :unit_cost, :value, :remaining_qty, :remaining_value,
+         :source_type, :source_id, :reference)
+""")
+
+
+def _costing_method():
+    return current_app.config.get('INVENTORY_COSTING_METHOD', 'fifo')
+
+
+def _already_valued(connection, source_type, source_id, product_id):
+    return connection.execute(text("""
+        SELECT 1 FROM stock_valuation_layers
+        WHERE source_type = :source_type AND source_id = :source_id AND product_id = :product_id
+    """), {'source_type': source_type, 'source_id': source_id, 'product_id': product_id}).first() is not None
+
+
+def _lock_product(connection, product_id):
+    # Layers are read and then rewritten, so two sales of one product on
+    # different workers would consume the same layers. The product row lock
+    # serializes every layer change of the product until the transaction
+    # ends; SQLite already allows a single writer at a time.
+    if connection.dialect.name != 'sqlite':
+        connection.execute(text("SELECT id FROM products WHERE id = :id FOR UPDATE"), {'id': product_id})
+
+
+def _list_cost(connection, product_id):
+    return connection.execute(
+        text("SELECT COALESCE(cost_price, 0) FROM products WHERE id = :id"), {'id': product_id}
+    ).scalar() or 0.0
+
+
+def current_unit_cost(connection, product_id):
+    """Average cost of what is still in stock, or the product's cost price when nothing is"""
+    row = connection.execute(text("""
+        SELECT SUM(remaining_qty) AS quantity, SUM(remaining_value) AS value
+        FROM stock_valuation_layers
+        WHERE product_id = :product_id AND remaining_qty > :epsilon
+    """), {'product_id': product_id, 'epsilon': EPSILON}).first()
+    if row.quantity and row.quantity > EPSILON:
+        return row.value / row.quantity
+    return _list_cost(connection, product_id)
+
+
+def add_incoming(connection, product_id, quantity, unit_cost, source_type, source_id,
+                 reference=None, at=None):
+    """Create an incoming layer; unit_cost None means the product's cost price.
+
+    Locks the product's layers until the caller's transaction ends.
+    """
+    quantity = float(quantity or 0)
+    if quantity <= 0:
+        return None
+    _lock_product(connection, product_id)
+    if _already_valued(connection, source_type, source_id, product_id):
+        return None
+
+    if unit_cost is None:
+        unit_cost = _list_cost(connection, product_id)
+    value = quantity * unit_cost
+    connection.execute(_INSERT_LAYER_SQL, {
+        'product_id': product_id, 'created_at': at or datetime.utcnow(),
+        'quantity': quantity, 'unit_cost': unit_cost, 'value': value,
+        'remaining_qty': quantity, 'remaining_value': value,
+        'source_type': source_type, 'source_id': source_id, 'reference': reference,
+    })
+    return value
+
+
+def add_outgoing(connection, product_id, quantity, source_type, source_id, reference=None, at=None):
+    """Consume incoming layers for quantity and record the cost taken out.
+
+    Anything beyond the stock the layers know about is costed at the
+    product's cost price. Locks the product's layers until the caller's
+    transaction ends, so concurrent sales take consecutive layers.
+    """
+    quantity = float(quantity or 0)
+    if quantity <= 0:
+        return None
+    _lock_product(connection, product_id)
+    if _already_valued(connection, source_type, source_id, product_id):
+        return None
+
+    params = {'product_id': product_id, 'epsilon': EPSILON}
+    taken = 0.0
+    cost = 0.0
+
+    if _costing_method() == 'average':
+        row = connection.execute(text("""
+            SELECT SUM(remaining_qty) AS quantity, SUM(remaining_value) AS value
+            FROM stock_valuation_layers
+            WHERE product_id = :product_id AND remaining_qty > :epsilon
+        """), params).first()
+        if row.quantity and row.quantity > EPSILON:
+            taken = min(quantity, row.quantity)
+            cost = row.value * taken / row.quantity
+            keep = 1 - taken / row.quantity
+            connection.execute(text("""
+                UPDATE stock_valuation_layers
+                SET remaining_qty = CASE WHEN :keep > 0 THEN remaining_qty * :keep ELSE 0 END,
+                    remaining_value = CASE WHEN :keep > 0 THEN remaining_value * :keep ELSE 0 END
+                WHERE product_id = :product_id AND remaining_qty > :epsilon
+            """), dict(params, keep=keep))
+    else:
+        updates = []
+        for layer in connection.execute(text("""
+            SELECT id, remaining_qty, remaining_value FROM stock_valuation_layers
+            WHERE product_id = :product_id AND remaining_qty > :epsilon
+            ORDER BY created_at, id
+        """), params).fetchall():
+            if taken >= quantity - EPSILON:
+                break
+            take = min(quantity - taken, layer.remaining_qty)
+            take_value = layer.remaining_value * take / layer.remaining_qty
+            left = layer.remaining_qty - take
+            updates.append({
+                'id': layer.id,
+                'remaining_qty': left if left > EPSILON else 0.0,
+                'remaining_value': layer.remaining_value - take_value if left > EPSILON else 0.0,
+            })
+            taken += take
+            cost += take_value
+        if updates:
+            connection.execute(text("""
+                UPDATE stock_valuation_layers
+                SET remaining_qty = :remaining_qty, remaining_value = :remaining_value
+                WHERE id = :id
+            """), updates)
+
+    if quantity - taken > EPSILON:
+        cost += (quantity - taken) * _list_cost(connection, product_id)
+
+    connection.execute(_INSERT_LAYER_SQL, {
+        'product_id': product_id, 'created_at': at or datetime.utcnow(),
+        'quantity': -quantity, 'unit_cost': cost / quantity, 'value': -cost,
+        'remaining_qty': 0.0, 'remaining_value': 0.0,
+        'source_type': source_type, 'source_id': source_id, 'reference': reference,
+    })
+    return cost
+
+
+def _value_move(connection, move_id, product_id, quantity, reference_type, reference,
+                source_type, destination_type, at):
+    """Value a done stock move that brings stock into or takes it out of company stock"""
+    from_stock = source_type in VALUED_LOCATION_TYPES
+    to_stock = destination_type in VALUED_LOCATION_TYPES
+    if from_stock == to_stock:
+        # Internal transfer, or stock that never was company stock
+        return
+
+    if to_stock:
+        if source_type == 'supplier':
+            # Supplier stock is valued by its purchase receipt at purchase cost
+            return
+        kind = 'return' if reference_type == 'return' or source_type == 'customer' else 'adjustment'
+        add_incoming(connection, product_id, quantity, current_unit_cost(connection, product_id),
+                     kind, move_id, reference, at)
+    else:
+        if destination_type == 'customer':
+            kind = 'sale'
+        elif destination_type == 'supplier':
+            kind = 'return'
+        else:
+            kind = 'adjustment'
+        add_outgoing(connection, product_id, quantity, kind, move_id, reference, at)
+
+
+def _location_types(connection, *location_ids):
+    rows = connection.execute(text("""
+        SELECT id, location_type FROM stock_locations WHERE id IN :ids
+    """).bindparams(bindparam('ids', expanding=True)), {'ids': list(location_ids)})
+    return {row.id: row.location_type for row in rows}
+
+
+def _receipt_lines(connection, receipt_id=None, line_id=None):
+    """Received purchase receipt lines with the unit price from their purchase order"""
+    filters = ["r.state IN :states"]
+    if receipt_id is not None:
+        filters.append("r.id = :receipt_id")
+    if line_id is not None:
+        filters.append("l.id = :line_id")
+    return connection.execute(text(f"""
+        SELECT l.id, l.product_id, l.quantity, r.name AS reference,
+               COALESCE(r.receipt_date, r.created_at) AS received_at,
+               (SELECT pol.unit_price FROM purchase_order_lines pol
+                WHERE pol.order_id = r.purchase_order_id AND pol.product_id = l.product_id
+                ORDER BY pol.id LIMIT 1) AS unit_cost
+        FROM purchase_receipt_lines l
+        JOIN purchase_receipts r ON r.id = l.receipt_id
+        JOIN products p ON p.id = l.product_id
+        WHERE {' AND '.join(filters)}
+    """).bindparams(bindparam('states', expanding=True)).columns(received_at=db.DateTime),
+        {'receipt_id': receipt_id, 'line_id': line_id, 'states': list(RECEIVED_RECEIPT_STATES)})
+
+
+def _restock_items(connection, restock_id=None, item_id=None):
+    """Items of confirmed supplier restocks"""
+    filters = ["r.status = 'confirmed'"]
+    if restock_id is not None:
+        filters.append("r.id = :restock_id")
+    if item_id is not None:
+        filters.append("i.id = :item_id")
+    return connection.execute(text(f"""
+        SELECT i.id, i.product_id, i.quantity, i.unit_cost, r.reference,
+               COALESCE(r.confirmed_at, r.created_at) AS received_at
+        FROM supplier_restock_items i
+        JOIN supplier_restocks r ON r.id = i.restock_id
+        JOIN products p ON p.id = i.product_id
+        WHERE {' AND '.join(filters)}
+    """).columns(received_at=db.DateTime), {'restock_id': restock_id, 'item_id': item_id})
+
+
+def value_supplier_restock(connection, restock_id):
+    """Create incoming layers for a confirmed supplier restock (for posting done outside the ORM)"""
+    for item in _restock_items(connection, restock_id=restock_id):
+        add_incoming(connection, item.product_id, item.quantity, item.unit_cost,
+                     'supplier_restock', item.id, item.reference, item.received_at)
+
+
+def value_stock_moves(connection, move_ids):
+    """Value done stock moves inserted outside the ORM (such as count adjustments)"""
+    if not move_ids:
+        return
+    for move in connection.execute(text("""
+        SELECT m.id, m.product_id, m.quantity, m.reference_type, m.reference,
+               COALESCE(m.effective_date, m.created_at) AS moved_at,
+               s.location_type AS source_type, d.location_type AS destination_type
+        FROM stock_moves m
+        JOIN stock_locations s ON s.id = m.source_location_id
+        JOIN stock_locations d ON d.id = m.destination_location_id
+        WHERE m.id IN :ids AND m.state = 'done'
+        ORDER BY m.id
+    """).bindparams(bindparam('ids', expanding=True)).columns(moved_at=db.DateTime), {'ids': list(move_ids)}):
+        _value_move(connection, move.id, move.product_id, move.quantity, move.reference_type, move.reference,
+                    move.source_type, move.destination_type, move.moved_at)
+
+
+def value_purchase_receipt(connection, receipt_id):
+    """Create incoming layers for a received purchase receipt (for posting done outside the ORM)"""
+    for line in _receipt_lines(connection, receipt_id=receipt_id):
+        add_incoming(connection, line.product_id, line.quantity, line.unit_cost,
+                     'purchase_receipt', line.id, line.reference, line.received_at)
+
+
+def rebuild_layers():
+    """Replay every valued stock event in date order into fresh layers.
+
+    Snapshots are dropped as well, since they were computed from the old
+    layers.
+    """
+    connection = db.session.connection()
+    events = []
+
+    for line in _receipt_lines(connection):
+        events.append((line.received_at, 0, lambda c, l=line: add_incoming(
+            c, l.product_id, l.quantity, l.unit_cost, 'purchase_receipt', l.id, l.reference, l.received_at)))
+
+    for item in _restock_items(connection):
+        events.append((item.received_at, 0, lambda c, i=item: add_incoming(
+            c, i.product_id, i.quantity, i.unit_cost, 'supplier_restock', i.id, i.reference, i.received_at)))
+
+    for receipt in connection.execute(text(f"""
+        SELECT id, product_id, quantity, reference, created_at FROM {history_table('warehouse_movements')}
+        WHERE movement_type = 'receipt'
+    """).columns(created_at=db.DateTime)):
+        events.append((receipt.created_at, 0, lambda c, r=receipt: add_incoming(
+            c, r.product_id, r.quantity, None, 'opening', r.id, r.reference, r.created_at)))
+
+    for move in connection.execute(text(f"""
+        SELECT m.id, m.product_id, m.quantity, m.reference_type, m.reference,
+               COALESCE(m.effective_date, m.created_at) AS moved_at,
+               s.location_type AS source_type, d.location_type AS destination_type
+        FROM {history_table('stock_moves')} m
+        JOIN stock_locations s ON s.id = m.source_location_id
+        JOIN stock_locations d ON d.id = m.destination_location_id
+        WHERE m.state = 'done'
+    """).columns(moved_at=db.DateTime)):
+        # Incoming moves sort before outgoing ones at the same instant
+        order = 0 if move.destination_type in VALUED_LOCATION_TYPES else 1
+        events.append((move.moved_at, order, lambda c, m=move: _value_move(
+            c, m.id, m.product_id, m.quantity, m.reference_type, m.reference,
+            m.source_type, m.destination_type, m.moved_at)))
+
+    for scrap in connection.execute(text("""
+        SELECT id, product_id, quantity, reference, created_at FROM scrap_items
+    """).columns(created_at=db.DateTime)):
+        events.append((scrap.created_at, 1, lambda c, s=scrap: add_outgoing(
+            c, s.product_id, s.quantity, 'scrap', s.id, s.reference, s.created_at)))
+
+    events.sort(key=lambda item: (item[0] or datetime.min, item[1]))
+
+    try:
+        connection.execute(text("DELETE FROM stock_valuation_snapshots"))
+        connection.execute(text("DELETE FROM stock_valuation_layers"))
+        for _, _, apply in events:
+            apply(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return len(events)
+
+
+def stock_value(at=None, product_ids=None):
+    """Quantity and value per product now, or at the end of the day `at`"""
+    params = {}
+    parts = []
+    snapshot_date = None
+
+    if at is None:
+        parts.append("SELECT product_id, quantity, value FROM stock_valuation_layers")
+    else:
+        snapshot_date = db.session.execute(text("""
+            SELECT MAX(snapshot_date) AS snapshot_date FROM stock_valuation_snapshots
+            WHERE snapshot_date <= :at
+        """).columns(snapshot_date=db.Date), {'at': at}).scalar()
+
+        params['until'] = datetime.combine(at + timedelta(days=1), time.min)
+        layer_filter = "created_at < :until"
+        if snapshot_date:
+            parts.append("""
+                SELECT product_id, quantity, value FROM stock_valuation_snapshots
+                WHERE snapshot_date = :snapshot_date
+            """)
+            params['snapshot_date'] = snapshot_date
+            params['since'] = datetime.combine(snapshot_date + timedelta(days=1), time.min)
+            layer_filter += " AND created_at >= :since"
+        parts.append(f"SELECT product_id, quantity, value FROM stock_valuation_layers WHERE {layer_filter}")
+
+    product_filter = "WHERE t.product_id IN :product_ids" if product_ids else ""
+    query = text(f"""
+        SELECT t.product_id, p.name, p.sku,
+               SUM(t.quantity) AS quantity, SUM(t.value) AS value
+        FROM ({' UNION ALL '.join(parts)}) t
+        JOIN products p ON p.id = t.product_id
+        {product_filter}
+        GROUP BY t.product_id, p.name, p.sku
+        HAVING SUM(t.quantity) <> 0 OR SUM(t.value) <> 0
+        ORDER BY SUM(t.value) DESC
+    """)
+    if product_ids:
+        query = query.bindparams(bindparam('product_ids', expanding=True))
+        params['product_ids'] = list(product_ids)
+
+    products = []
+    for row in db.session.execute(query, params).mappings():
+        row = dict(row)
+        row['unit_cost'] = round(row['value'] / row['quantity'], 4) if row['quantity'] else None
+        products.append(row)
+
+    return {
+        'at': at.isoformat() if at else None,
+        'snapshot_date': snapshot_date.isoformat() if snapshot_date else None,
+        'total_value': round(sum(row['value'] for row in products), 2),
+        'products': products,
+    }
+
+
+def take_snapshot(snapshot_date):
+    """Store quantity and value per product at the end of snapshot_date"""
+    try:
+        db.session.execute(text("DELETE FROM stock_valuation_snapshots WHERE snapshot_date = :d"),
+                           {'d': snapshot_date})
+        rows = stock_value(snapshot_date)['products']
+        if rows:
+            now = datetime.utcnow()
+            db.session.execute(text("""
+                INSERT INTO stock_valuation_snapshots (snapshot_date, product_id, quantity, value, created_at)
+                VALUES (:snapshot_date, :product_id, :quantity, :value, :created_at)
+            """), [{'snapshot_date': snapshot_date, 'product_id': row['product_id'],
+                    'quantity': row['quantity'], 'value': row['value'], 'created_at': now}
+                   for row in rows])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    log.info("Stock valuation snapshot taken", extra={'snapshot_date': snapshot_date.isoformat(),
+                                                      'products': len(rows)})
+    return len(rows)
+
+
+def register_valuation_listeners():
+    """Create and consume cost layers as stock documents are posted through the ORM"""
+    from modules.inventory.models import StockMove
+    from modules.inventory.models_scrap import ScrapItem
+    from modules.inventory.models_supplier_restock import SupplierRestock, SupplierRestockItem
+    from modules.inventory.models_warehouse import WarehouseMovement
+    from modules.purchase.models import PurchaseReceipt, PurchaseReceiptLine
+
+    if event.contains(StockMove, 'after_insert', _move_inserted):
+        return
+
+    event.listen(StockMove, 'after_insert', _move_inserted)
+    event.listen(StockMove, 'after_update', _move_updated)
+    event.listen(ScrapItem, 'after_insert', _scrap_inserted)
+    event.listen(WarehouseMovement, 'after_insert', _warehouse_movement_inserted)
+    event.listen(SupplierRestock, 'after_insert', _restock_changed)
+    event.listen(SupplierRestock, 'after_update', _restock_changed)
+    event.listen(SupplierRestockItem, 'after_insert', _restock_item_inserted)
+    event.listen(PurchaseReceipt, 'after_insert', _receipt_changed)
+    event.listen(PurchaseReceipt, 'after_update', _receipt_changed)
+    event.listen(PurchaseReceiptLine, 'after_insert', _receipt_line_inserted)
+
+
+def _became(target, attribute, values):
+    """True when attribute is in values and was set in this flush"""
+    return getattr(target, attribute) in values and bool(inspect(target).attrs[attribute].history.added)
+
+
+def _post_move(connection, move):
+    types = _location_types(connection, move.source_location_id, move.destination_location_id)
+    _value_move(connection, move.id, move.product_id, move.quantity, move.reference_type, move.reference,
+                types.get(move.source_location_id), types.get(move.destination_location_id),
+                move.effective_date or move.created_at)
+
+
+def _move_inserted(mapper, connection, target):
+    if target.state == 'done':
+        _post_move(connection, target)
+
+
+def _move_updated(mapper, connection, target):
+    # Pending moves (e.g. batch transfers awaiting approval) are valued once they are done
+    if _became(target, 'state', ('done',)):
+        _post_move(connection, target)
+
+
+def _scrap_inserted(mapper, connection, target):
+    add_outgoing(connection, target.product_id, target.quantity, 'scrap', target.id,
+                 target.reference, target.created_at)
+
+
+def _warehouse_movement_inserted(mapper, connection, target):
+    # Initial stock entered straight into a warehouse, valued at the product's cost price
+    if target.movement_type == 'receipt':
+        add_incoming(connection, target.product_id, target.quantity, None, 'opening', target.id,
+                     target.reference, target.created_at)
+
+
+def _restock_changed(mapper, connection, target):
+    if _became(target, 'status', ('confirmed',)):
+        value_supplier_restock(connection, target.id)
+
+
+def _restock_item_inserted(mapper, connection, target):
+    # Items added to a restock that is already confirmed (or confirmed in the same flush)
+    for item in _restock_items(connection, item_id=target.id):
+        add_incoming(connection, item.product_id, item.quantity, item.unit_cost,
+                     'supplier_restock', item.id, item.reference, item.received_at)
+
+
+def _receipt_changed(mapper, connection, target):
+    if _became(target, 'state', RECEIVED_RECEIPT_STATES):
+        value_purchase_receipt(connection, target.id)
+
+
+def _receipt_line_inserted(mapper, connection, target):
+    for line in _receipt_lines(connection, line_id=target.id):
+        add_incoming(connection, line.product_id, line.quantity, line.unit_cost,
+                     'purchase_receipt', line.id, line.reference, line.received_at)
+
+
+@valuation_bp.route('/stock-valuation')
+@login_required
+def stock_valuation():
+    """Stock value per product, now or at the end of ?at=YYYY-MM-DD"""
+    if not any(current_user.has_role(role) for role in VALUATION_ROLES):
+        return jsonify({'error': 'You do not have permission to view stock valuation'}), 403
+
+    try:
+        at = date.fromisoformat(request.args['at']) if request.args.get('at') else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    result = stock_value(at, request.args.getlist('product_id', type=int))
+    result['costing_method'] = _costing_method()
+    return jsonify(result)
+
+
+@valuation_bp.cli.command('rebuild')
+def rebuild_command():
+    """Rebuild cost layers from receipts, restocks, stock moves and scrap."""
+    count = rebuild_layers()
+    print(f"Stock valuation rebuilt from {count} stock events")
+
+
+@valuation_bp.cli.command('snapshot')
+@click.option('--date', 'snapshot_date', help='Day to snapshot (YYYY-MM-DD), defaults to yesterday')
+def snapshot_command(snapshot_date):
+    """Store the stock valuation at the end of a day (run at each period close)."""
+    snapshot_date = date.fromisoformat(snapshot_date) if snapshot_date else datetime.utcnow().date() - timedelta(days=1)
+    count = take_snapshot(snapshot_date)
+    print(f"Stock valuation snapshot for {snapshot_date.isoformat()}: {count} products")
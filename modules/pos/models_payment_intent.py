@@ -0,0 +1,58 @@
+from datetime import datetime
+from sqlalchemy import text
+from extensions import db
+
+
+class PaymentIntent(db.Model):
+    """A Mobile Money or card payment started for a POS order.
+
+    Created as pending when the till initiates the payment. It is resolved
+    exactly once, to success, failed or abandoned, by the provider's webhook
+    or by the payment poller (modules.pos.payment_gateway). next_poll_at
+    spaces out the poller's checks while the payment is pending. Amounts are
+    in the currency's minor unit (pesewas), as providers expect them.
+    """
+    __tablename__ = 'payment_intents'
+    __table_args__ = (
+        db.Index('ix_payment_intents_status_next_poll', 'status', 'next_poll_at'),
+        # At most one pending payment per order, so two tills cannot charge it twice
+        db.Index('uq_payment_intents_order_pending', 'order_id', unique=True,
+                 postgresql_where=text("status = 'pending'"), sqlite_where=text("status = 'pending'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    reference = db.Column(db.String(64), nullable=False, unique=True)
+    provider = db.Column(db.String(20), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('pos_orders.id'), nullable=False, index=True)
+    method = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    currency = db.Column(db.String(3), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    provider_reference = db.Column(db.String(128))
+    authorization_url = db.Column(db.String(512))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_poll_at = db.Column(db.DateTime)
+    error = db.Column(db.String(255))
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    resolved_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<PaymentIntent {self.reference} {self.status}>'
+
+
+class PaymentWebhookEvent(db.Model):
+    """A provider webhook already processed, so redeliveries are ignored"""
+    __tablename__ = 'payment_webhook_events'
+    __table_args__ = (
+        db.UniqueConstraint('provider', 'event_key', name='uq_payment_webhook_events_provider_key'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    provider = db.Column(db.String(20), nullable=False)
+    event_key = db.Column(db.String(128), nullable=False)
+    reference = db.Column(db.String(64))
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<PaymentWebhookEvent {self.provider} {self.event_key}>'
@@ -0,0 +1,593 @@
+"""
+Mobile Money and card payments for POS orders (Paystack).
+
+Confirming a provider payment used to happen inside the till's request, so a
+gunicorn worker was held for the whole round-trip to the provider. The till
+now only starts the payment and then polls a cheap status endpoint:
+
+- POST /pos/api/payments creates a pending PaymentIntent for the order and
+  asks the provider to initialize the charge.
+- The provider reports the outcome to POST /pos/api/payments/webhook/<name>.
+  Each webhook event is recorded once, so redeliveries are acknowledged and
+  otherwise ignored.
+- `flask payments poll` runs in its own process. It checks pending intents
+  the provider has not reported on yet, with an asyncio loop that keeps at
+  most PAYMENT_POLL_CONCURRENCY requests in flight and backs off per intent.
+- GET /pos/api/payments/<reference> reads the intent's status with one
+  indexed lookup.
+
+An intent is resolved once, whichever comes first. A successful payment marks
+the POS order paid. The one exception is a success webhook for an intent the
+poller already abandoned: the provider has taken the money, so the intent is
+recovered and the order paid, or flagged for reconciliation when the order
+was settled some other way meanwhile.
+
+Without PAYSTACK_SECRET_KEY no provider is registered: starting a payment
+answers "Payments are not configured" and the poller exits, while the rest
+of the ERP runs as usual.
+
+PAYMENT_PROVIDER=mock swaps Paystack for a local provider, available only
+with DEBUG or TESTING. It confirms payments after PAYMENT_MOCK_DELAY seconds,
+and `flask payments mock-webhook` sends it webhooks signed with
+PAYMENT_MOCK_SECRET (a per-process random key when unset). Development and
+tests run the whole flow without network access.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import secrets
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import click
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from modules.core.structured_logging import get_logger
+from modules.pos.models_payment_intent import PaymentIntent
+from modules.pos.pricing import money
+from modules.reports.sales_cube import refresh_order
+
+payments_bp = Blueprint('payments', __name__, cli_group='payments')
+
+log = get_logger('pos')
+
+# POS payment method codes (setup_payment_methods.py) and the value stored
+# in pos_orders.payment_method once the payment succeeds
+METHODS = {'MOMO': 'momo', 'CARD': 'card'}
+
+RESOLVED_STATES = ('success', 'failed', 'abandoned')
+
+# Pending intents checked per poller round
+POLL_BATCH_SIZE = 100
+
+# Longest wait between two checks of the same intent
+MAX_POLL_INTERVAL = timedelta(minutes=1)
+
+_INTENT_COLUMNS = {'created_at': db.DateTime, 'next_poll_at': db.DateTime}
+
+
+class PaymentError(Exception):
+    """Raised when a payment cannot be started or a webhook is rejected"""
+
+
+class PaymentsNotConfigured(PaymentError):
+    """Raised when no payment provider is configured for this deployment"""
+
+
+class PaystackProvider:
+    """Paystack's transaction API and webhook format"""
+
+    name = 'paystack'
+
+    CHANNELS = {'MOMO': ['mobile_money'], 'CARD': ['card']}
+
+    # Paystack statuses that can still turn into a payment
+    PENDING_STATUSES = ('abandoned', 'ongoing', 'pending', 'processing', 'queued', 'send_otp', 'send_birthday')
+
+    def __init__(self, config):
+        self.secret = config.get('PAYSTACK_SECRET_KEY')
+        self.base_url = config.get('PAYSTACK_BASE_URL', 'https://api.paystack.co').rstrip('/')
+        self.timeout = config.get('PAYMENT_TIMEOUT', 10)
+        self.default_email = config.get('PAYMENT_DEFAULT_EMAIL')
+
+    def _request(self, method, path, payload=None):
+        if not self.secret:
+            raise PaymentError('PAYSTACK_SECRET_KEY is not set')
+
+        req = urllib.request.Request(
+            self.base_url + path, method=method,
+            data=json.dumps(payload).encode() if payload is not None else None,
+            headers={'Authorization': f'Bearer {self.secret}', 'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                body = json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e).get('message')
+            except ValueError:
+                message = None
+            raise PaymentError(message or f'Paystack returned HTTP {e.code}')
+        except (OSError, ValueError) as e:
+            raise PaymentError(f'Paystack could not be reached: {e}')
+
+        if not body.get('status'):
+            raise PaymentError(body.get('message') or 'Paystack rejected the request')
+        return body.get('data') or {}
+
+    def initialize(self, intent, email=None, phone=None):
+        """Start the charge; returns (provider reference, authorization URL)"""
+        payload = {
+            'email': email or self.default_email,
+            'amount': intent.amount,
+            'currency': intent.currency,
+            'reference': intent.reference,
+            'channels': self.CHANNELS[intent.method],
+            'metadata': {'order_id': intent.order_id, 'phone': phone},
+        }
+        if not payload['email']:
+            raise PaymentError('A customer email is required (or set PAYMENT_DEFAULT_EMAIL)')
+        data = self._request('POST', '/transaction/initialize', payload)
+        return data.get('reference') or intent.reference, data.get('authorization_url')
+
+    def verify(self, intent):
+        """Current outcome of a payment: (status, amount paid or None)"""
+        data = self._request('GET', f'/transaction/verify/{intent.reference}')
+        return self._status(data.get('status')), data.get('amount')
+
+    def _status(self, status):
+        if status == 'success':
+            return 'success'
+        if status in self.PENDING_STATUSES:
+            return 'pending'
+        return 'failed'
+
+    def sign(self, body):
+        return hmac.new((self.secret or '').encode(), body, hashlib.sha512).hexdigest()
+
+    def parse_webhook(self, body, headers):
+        """Check a webhook's signature; returns (event key, reference, status, amount)"""
+        signature = headers.get('X-Paystack-Signature') or ''
+        if not self.secret or not hmac.compare_digest(self.sign(body), signature):
+            raise PaymentError('Invalid webhook signature')
+        try:
+            payload = json.loads(body)
+            event, data = payload['event'], payload.get('data') or {}
+        except (ValueError, KeyError, TypeError):
+            raise PaymentError('Malformed webhook body')
+
+        if event == 'charge.success':
+            status = self._status(data.get('status'))
+        elif event == 'charge.failed':
+            status = 'failed'
+        else:
+            status = None
+        return f"{event}:{data.get('id') or data.get('reference')}", data.get('reference'), status, data.get('amount')
+
+
+class MockProvider(PaystackProvider):
+    """Local stand-in for Paystack: no network, same webhook format"""
+
+    name = 'mock'
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.outcome = config.get('PAYMENT_MOCK_OUTCOME', 'success')
+        self.delay = timedelta(seconds=config.get('PAYMENT_MOCK_DELAY', 0))
+        self.latency = config.get('PAYMENT_MOCK_LATENCY', 0)
+        self.secret = config.get('PAYMENT_MOCK_SECRET') or _MOCK_SECRET
+
+    def initialize(self, intent, email=None, phone=None):
+        return f'mock_{intent.reference}', None
+
+    def verify(self, intent):
+        if self.latency:
+            time.sleep(self.latency)
+        if datetime.utcnow() - intent.created_at < self.delay:
+            return 'pending', None
+        return self.outcome, intent.amount if self.outcome == 'success' else None
+
+
+# Signs mock webhooks when PAYMENT_MOCK_SECRET is unset; only this process
+# (e.g. `flask payments mock-webhook`) can produce a valid signature
+_MOCK_SECRET = secrets.token_hex(32)
+
+# Only registered when PAYSTACK_SECRET_KEY is set
+PROVIDERS = {PaystackProvider.name: PaystackProvider}
+
+# Only registered when the app runs with DEBUG or TESTING
+DEBUG_PROVIDERS = {MockProvider.name: MockProvider}
+
+
+def available_providers(config):
+    providers = {}
+    if config.get('PAYSTACK_SECRET_KEY'):
+        providers.update(PROVIDERS)
+    if config.get('DEBUG') or config.get('TESTING'):
+        providers.update(DEBUG_PROVIDERS)
+    return providers
+
+
+def payments_configured(config):
+    """Whether the configured PAYMENT_PROVIDER can take payments here"""
+    return config.get('PAYMENT_PROVIDER') in available_providers(config)
+
+
+def get_provider(name=None):
+    name = name or current_app.config.get('PAYMENT_PROVIDER')
+    if not name:
+        raise PaymentsNotConfigured('Payments are not configured')
+    providers = available_providers(current_app.config)
+    if name not in providers:
+        raise PaymentsNotConfigured(f'Payment provider {name} is not configured')
+    return providers[name](current_app.config)
+
+
+def _poll_delay(attempts):
+    interval = timedelta(seconds=current_app.config.get('PAYMENT_POLL_INTERVAL', 5))
+    return min(interval * 2 ** min(attempts, 10), MAX_POLL_INTERVAL)
+
+
+def initiate_payment(order_id, method, user_id=None, email=None, phone=None):
+    """Start a provider payment for a POS order and return its PaymentIntent.
+
+    The amount is the order's total. An order with a payment already pending
+    gets that intent back instead of a second charge; a unique index on the
+    pending intents of an order settles two tills starting it at once.
+    """
+    method = (method or '').upper()
+    if method not in METHODS:
+        raise PaymentError(f'Unsupported payment method: {method or "none"}')
+
+    order = db.session.execute(
+        text("SELECT id, state, total_amount FROM pos_orders WHERE id = :id"), {'id': order_id}).first()
+    if order is None:
+        raise PaymentError('Order not found')
+    if order.state == 'paid':
+        raise PaymentError('The order is already paid')
+
+    pending = PaymentIntent.query.filter_by(order_id=order_id, status='pending').first()
+    if pending is not None:
+        return pending
+
+    amount = int(money(Decimal(str(order.total_amount or 0))) * 100)
+    if amount <= 0:
+        raise PaymentError('The order total must be above zero')
+
+    provider = get_provider()
+    now = datetime.utcnow()
+    intent = PaymentIntent(
+        reference=f'POS-{order_id}-{uuid.uuid4().hex[:12]}',
+        provider=provider.name,
+        order_id=order_id,
+        method=method,
+        amount=amount,
+        currency=current_app.config.get('PAYMENT_CURRENCY', 'GHS'),
+        status='pending',
+        next_poll_at=now + _poll_delay(0),
+        created_by=user_id,
+        created_at=now,
+    )
+    try:
+        db.session.add(intent)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        pending = PaymentIntent.query.filter_by(order_id=order_id, status='pending').first()
+        if pending is None:
+            raise
+        return pending
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # The intent is saved first so no transaction is open during the call
+    try:
+        intent.provider_reference, intent.authorization_url = provider.initialize(intent, email, phone)
+    except PaymentError as e:
+        intent.status, intent.error, intent.resolved_at = 'failed', str(e)[:255], datetime.utcnow()
+        db.session.commit()
+        log.warning("Payment could not be initiated", extra={
+            'reference': intent.reference, 'order_id': order_id, 'error': str(e)})
+        raise
+    db.session.commit()
+
+    log.info("Payment initiated", extra={
+        'reference': intent.reference, 'order_id': order_id, 'method': method,
+        'amount': amount, 'provider': provider.name})
+    return intent
+
+
+def resolve_intent(intent, status, amount=None, error=None, source='poller'):
+    """Move a pending intent to its final status; False if already resolved.
+
+    Runs in the caller's transaction. A successful payment marks the order
+    paid; a payment of the wrong amount is recorded as failed.
+    """
+    if status == 'success' and amount is not None and int(amount) != intent.amount:
+        status, error = 'failed', f'Paid {amount} instead of {intent.amount}'
+
+    now = datetime.utcnow()
+    updated = db.session.execute(text("""
+        UPDATE payment_intents SET status = :status, error = :error, resolved_at = :now
+        WHERE id = :id AND status = 'pending'
+    """), {'id': intent.id, 'status': status, 'error': (error or '')[:255] or None, 'now': now}).rowcount
+    if not updated:
+        return False
+
+    if status == 'success':
+        _mark_order_paid(intent)
+
+    log.info("Payment resolved", extra={
+        'reference': intent.reference, 'order_id': intent.order_id, 'status': status,
+        'source': source, 'error': error})
+    return True
+
+
+def _mark_order_paid(intent):
+    # False when the order was already paid
+    updated = db.session.execute(text("""
+        UPDATE pos_orders SET state = 'paid', payment_method = :method, payment_reference = :reference
+        WHERE id = :order_id AND (state IS NULL OR state <> 'paid')
+    """), {'order_id': intent.order_id, 'method': METHODS[intent.method], 'reference': intent.reference}).rowcount
+    if updated:
+        # The raw UPDATE bypasses the ORM events that keep the sales cube current
+        refresh_order(db.session.connection(), intent.order_id)
+    return bool(updated)
+
+
+def recover_abandoned(intent, amount=None):
+    """Apply a provider-confirmed success to an intent the poller abandoned.
+
+    Runs in the caller's transaction. The intent becomes 'success' and its
+    order is paid; if the order was paid some other way meanwhile, or the
+    amount is wrong, the intent keeps a reconciliation note in its error
+    instead. Returns 'recovered', 'reconcile' or None when the intent was not
+    abandoned.
+    """
+    if amount is not None and int(amount) != intent.amount:
+        note = f'Late payment of {amount} instead of {intent.amount}; needs reconciliation'
+        status = 'abandoned'
+    else:
+        note, status = None, 'success'
+
+    updated = db.session.execute(text("""
+        UPDATE payment_intents SET status = :status, error = :error, resolved_at = :now
+        WHERE id = :id AND status = 'abandoned'
+    """), {'id': intent.id, 'status': status, 'error': note, 'now': datetime.utcnow()}).rowcount
+    if not updated:
+        return None
+
+    if note is None and not _mark_order_paid(intent):
+        note = 'Paid after the order was settled; needs reconciliation'
+        db.session.execute(text("UPDATE payment_intents SET error = :error WHERE id = :id"),
+                           {'id': intent.id, 'error': note})
+
+    outcome = 'reconcile' if note else 'recovered'
+    log.warning("Payment confirmed after it was abandoned", extra={
+        'reference': intent.reference, 'order_id': intent.order_id, 'amount': amount,
+        'outcome': outcome, 'error': note})
+    return outcome
+
+
+def _find_intent(reference):
+    return db.session.execute(
+        text("SELECT * FROM payment_intents WHERE reference = :reference").columns(**_INTENT_COLUMNS),
+        {'reference': reference}).first()
+
+
+def handle_webhook(provider_name, body, headers):
+    """Apply a provider webhook once.
+
+    Returns 'processed', 'duplicate', 'ignored', or 'recovered' / 'reconcile'
+    for a success reported after the intent was abandoned.
+    """
+    provider = get_provider(provider_name)
+    event_key, reference, status, amount = provider.parse_webhook(body, headers)
+
+    try:
+        inserted = db.session.execute(text("""
+            INSERT INTO payment_webhook_events (provider, event_key, reference, received_at)
+            VALUES (:provider, :event_key, :reference, :now)
+            ON CONFLICT (provider, event_key) DO NOTHING
+        """), {'provider': provider.name, 'event_key': event_key[:128], 'reference': reference,
+               'now': datetime.utcnow()}).rowcount
+        if not inserted:
+            db.session.rollback()
+            return 'duplicate'
+
+        intent = _find_intent(reference) if reference else None
+        outcome = 'ignored'
+        if intent is not None and intent.provider == provider.name and status in RESOLVED_STATES:
+            if resolve_intent(intent, status, amount, source='webhook'):
+                outcome = 'processed'
+            elif status == 'success' and intent.status == 'abandoned':
+                outcome = recover_abandoned(intent, amount) or outcome
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return outcome
+
+
+async def _verify_all(intents, config, concurrency):
+    # Provider calls are blocking HTTP requests; each runs in a thread while
+    # the semaphore caps how many are in flight
+    semaphore = asyncio.Semaphore(concurrency)
+    classes = available_providers(config)
+    providers = {}
+
+    async def verify(intent):
+        provider = providers.setdefault(intent.provider, classes[intent.provider](config))
+        async with semaphore:
+            try:
+                status, amount = await asyncio.to_thread(provider.verify, intent)
+                return intent, status, amount, None
+            except PaymentError as e:
+                return intent, 'pending', None, str(e)
+
+    return await asyncio.gather(*(verify(intent) for intent in intents))
+
+
+def poll_pending():
+    """Check every due pending intent with the provider once; returns counts"""
+    now = datetime.utcnow()
+    ttl = timedelta(minutes=current_app.config.get('PAYMENT_INTENT_TTL', 30))
+    counts = {'checked': 0, 'resolved': 0, 'abandoned': 0}
+
+    try:
+        counts['abandoned'] = db.session.execute(text("""
+            UPDATE payment_intents SET status = 'abandoned', error = 'No confirmation from the provider',
+                   resolved_at = :now
+            WHERE status = 'pending' AND created_at < :cutoff
+        """), {'now': now, 'cutoff': now - ttl}).rowcount
+
+        intents = db.session.execute(text("""
+            SELECT * FROM payment_intents
+            WHERE status = 'pending' AND next_poll_at <= :now
+            ORDER BY next_poll_at
+            LIMIT :limit
+        """).columns(**_INTENT_COLUMNS), {'now': now, 'limit': POLL_BATCH_SIZE}).all()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if not intents:
+        return counts
+
+    concurrency = current_app.config.get('PAYMENT_POLL_CONCURRENCY', 10)
+    results = asyncio.run(_verify_all(
+        [intent for intent in intents if intent.provider in available_providers(current_app.config)],
+        current_app.config, concurrency))
+
+    reschedule = []
+    try:
+        for intent, status, amount, error in results:
+            counts['checked'] += 1
+            if status in RESOLVED_STATES:
+                counts['resolved'] += resolve_intent(intent, status, amount)
+            else:
+                reschedule.append({'id': intent.id, 'error': error,
+                                   'next_poll_at': datetime.utcnow() + _poll_delay(intent.attempts + 1)})
+        if reschedule:
+            db.session.execute(text("""
+                UPDATE payment_intents SET attempts = attempts + 1, next_poll_at = :next_poll_at, error = :error
+                WHERE id = :id AND status = 'pending'
+            """), reschedule)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
+
+
+def _intent_json(intent):
+    return {
+        'reference': intent.reference,
+        'order_id': intent.order_id,
+        'method': intent.method,
+        'amount': str(Decimal(intent.amount).scaleb(-2)),
+        'currency': intent.currency,
+        'status': intent.status,
+        'authorization_url': intent.authorization_url,
+        'error': intent.error,
+    }
+
+
+@payments_bp.route('/pos/api/payments', methods=['POST'])
+@login_required
+def initiate_payment_route():
+    """Start a payment: {"order_id": 1, "method": "MOMO", "email": "...", "phone": "..."}"""
+    if not payments_configured(current_app.config):
+        return jsonify({'error': 'Payments are not configured'}), 503
+
+    data = request.get_json(silent=True) or {}
+    try:
+        order_id = int(data.get('order_id'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'order_id is required'}), 400
+
+    try:
+        intent = initiate_payment(order_id, data.get('method'), current_user.id, data.get('email'), data.get('phone'))
+    except PaymentsNotConfigured as e:
+        return jsonify({'error': str(e)}), 503
+    except PaymentError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(_intent_json(intent)), 201
+
+
+@payments_bp.route('/pos/api/payments/<reference>')
+@login_required
+def payment_status_route(reference):
+    intent = _find_intent(reference)
+    if intent is None:
+        return jsonify({'error': 'Payment not found'}), 404
+    return jsonify(_intent_json(intent))
+
+
+@payments_bp.route('/pos/api/payments/webhook/<provider_name>', methods=['POST'])
+def payment_webhook_route(provider_name):
+    # Authenticated by the provider's signature, not by a login
+    try:
+        outcome = handle_webhook(provider_name, request.get_data(), request.headers)
+    except PaymentError as e:
+        log.warning("Payment webhook rejected", extra={'provider': provider_name, 'error': str(e)})
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'status': outcome})
+
+
+@payments_bp.cli.command('poll')
+@click.option('--once', is_flag=True, help='Check due payments once and exit')
+def poll_command(once):
+    """Resolve pending payments with the provider until stopped."""
+    if not available_providers(current_app.config):
+        log.warning("Payments not configured, nothing to poll")
+        print("Payments are not configured (set PAYSTACK_SECRET_KEY); nothing to poll")
+        return
+
+    interval = current_app.config.get('PAYMENT_POLL_INTERVAL', 5)
+    while True:
+        try:
+            counts = poll_pending()
+        except Exception:
+            log.exception("Payment poll failed")
+            counts = {'checked': 0}
+        if counts['checked'] or counts.get('abandoned'):
+            log.info("Payments polled", extra=counts)
+        if once:
+            print(f"Checked {counts['checked']} payments, resolved {counts.get('resolved', 0)}, "
+                  f"abandoned {counts.get('abandoned', 0)}")
+            return
+        if counts['checked'] < POLL_BATCH_SIZE:
+            time.sleep(interval)
+
+
+@payments_bp.cli.command('mock-webhook')
+@click.argument('reference')
+@click.option('--status', type=click.Choice(['success', 'failed']), default='success', show_default=True)
+def mock_webhook_command(reference, status):
+    """Send the mock provider's webhook for payment REFERENCE."""
+    if MockProvider.name not in available_providers(current_app.config):
+        raise click.ClickException('The mock provider needs DEBUG or TESTING')
+    intent = _find_intent(reference)
+    if intent is None or intent.provider != MockProvider.name:
+        raise click.ClickException('No mock payment with that reference')
+
+    provider = MockProvider(current_app.config)
+    event = 'charge.success' if status == 'success' else 'charge.failed'
+    body = json.dumps({'event': event, 'data': {
+        'id': intent.id, 'reference': reference, 'status': status, 'amount': intent.amount}}).encode()
+    try:
+        outcome = handle_webhook(provider.name, body, {'X-Paystack-Signature': provider.sign(body)})
+    except PaymentError as e:
+        raise click.ClickException(str(e))
+    print(f"Webhook {outcome}")
@@ -0,0 +1,343 @@
+"""
+Pricing engine for POS carts.
+
+Cart totals used to be recomputed on every update from the POS settings and
+product prices, read again each time and summed as floats, and cents drifted
+between the till, the order and its returns. Totals are now computed here,
+with Decimal:
+
+- The POS settings and a branch's sale prices are loaded once into an
+  immutable RuleSet, cached per branch. The cache is dropped when a product or
+  the POS settings change in this process. Other processes pick the change up
+  within PRICING_CACHE_TTL seconds.
+- price_cart() makes a single pass over the lines. Each line is rounded to the
+  cent (half up) and its net amount is added to the tax base of its rate. The
+  order discount and the tax are then applied per rate, not per line, so the
+  totals always add up to the sum of the lines.
+
+POST /pos/api/price prices a cart without saving anything, so the till can
+call it on every change. `flask pricing bench` times 500-line carts.
+"""
+import threading
+import time
+from collections import namedtuple
+from decimal import ROUND_DOWN, ROUND_HALF_UP, Decimal, DecimalException
+from types import MappingProxyType
+
+import click
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import event
+
+from extensions import db
+from modules.core.branch_scope import ALL_BRANCHES, current_branch_id
+from modules.core.structured_logging import get_logger
+
+pricing_bp = Blueprint('pricing', __name__, cli_group='pricing')
+
+log = get_logger('pos')
+
+CENT = Decimal('0.01')
+HUNDRED = Decimal(100)
+
+# Roles that may override the list price while POS price edits are restricted
+PRICE_EDIT_ROLES = ('Admin', 'Manager', 'Shop Manager')
+
+# Lines accepted in one request
+MAX_LINES = 2000
+
+# Digits before and after the point accepted for any number
+MAX_DIGITS = 12
+MAX_DECIMAL_PLACES = 6
+
+RuleSet = namedtuple('RuleSet', [
+    'branch_id',
+    'enable_tax',
+    'restrict_price_edit',
+    'currency',
+    'default_tax_percent',
+    'prices',
+    'built_at',
+])
+
+_rule_sets = {}
+_rule_sets_lock = threading.Lock()
+_generation = 0
+
+
+class PricingError(ValueError):
+    """Raised when a cart cannot be priced"""
+
+
+def money(value):
+    """Round a Decimal to the cent, halves away from zero"""
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _decimal(value, field, default=None):
+    if value is None or value == '':
+        if default is None:
+            raise PricingError(f'{field} is required')
+        return default
+    try:
+        # str() first so floats from JSON keep their printed value
+        number = Decimal(str(value))
+    except DecimalException:
+        raise PricingError(f'{field} must be a number')
+    if not number.is_finite():
+        raise PricingError(f'{field} must be a number')
+    # Checked on the digits alone: arithmetic on a huge exponent would overflow
+    sign, digits, exponent = number.as_tuple()
+    places = len(digits) - len(''.join(map(str, digits)).rstrip('0'))
+    if number and (number.adjusted() >= MAX_DIGITS or exponent + places < -MAX_DECIMAL_PLACES):
+        raise PricingError(f'{field} is out of range')
+    return number
+
+
+def _build_rule_set(branch_id):
+    from modules.inventory.models import Product
+    from modules.pos.models import POSSettings
+
+    settings = POSSettings.query.first()
+    query = (db.session.query(Product.id, Product.sale_price)
+             .execution_options(**{ALL_BRANCHES: True})
+             .filter(Product.is_active.isnot(False)))
+    if branch_id is not None and 'branch_id' in Product.__table__.c:
+        query = query.filter((Product.branch_id == branch_id) | Product.branch_id.is_(None))
+
+    prices = {product_id: Decimal(str(price or 0)) for product_id, price in query}
+    return RuleSet(
+        branch_id=branch_id,
+        enable_tax=bool(settings and settings.enable_tax),
+        restrict_price_edit=bool(settings and settings.restrict_price_edit),
+        currency=(settings.currency_symbol if settings else None) or '',
+        default_tax_percent=Decimal(str(current_app.config.get('POS_DEFAULT_TAX_PERCENT', 0))),
+        prices=MappingProxyType(prices),
+        built_at=time.monotonic(),
+    )
+
+
+def rule_set(branch_id=None):
+    """The cached pricing rules of a branch (None: every branch's products)"""
+    ttl = current_app.config.get('PRICING_CACHE_TTL', 30)
+    with _rule_sets_lock:
+        cached = _rule_sets.get(branch_id)
+        generation = _generation
+    if cached and cached[0] == generation and time.monotonic() - cached[1].built_at < ttl:
+        return cached[1]
+
+    started = time.perf_counter()
+    rules = _build_rule_set(branch_id)
+    with _rule_sets_lock:
+        # A change during the build leaves the generation moved on; the stale
+        # rule set is returned this once but not cached
+        if generation == _generation:
+            _rule_sets[branch_id] = (generation, rules)
+    log.info("Pricing rules loaded", extra={
+        'branch_id': branch_id, 'products': len(rules.prices),
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+    return rules
+
+
+def invalidate_rule_sets(*args):
+    """Drop every cached rule set of this process"""
+    global _generation
+
+    with _rule_sets_lock:
+        _generation += 1
+        _rule_sets.clear()
+
+
+def register_pricing_listeners():
+    """Drop cached pricing rules when products or the POS settings change"""
+    from modules.inventory.models import Product
+    from modules.pos.models import POSSettings
+
+    for model in (Product, POSSettings):
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            if not event.contains(model, name, invalidate_rule_sets):
+                event.listen(model, name, invalidate_rule_sets)
+
+
+def _allocate(amount, bases):
+    # Split amount over bases in proportion to them, to the cent, with the
+    # leftover cents going to the largest remainders so the parts add up
+    total = sum(bases.values())
+    shares, remainders = {}, []
+    for key, base in bases.items():
+        exact = amount * base / total
+        shares[key] = exact.quantize(CENT, rounding=ROUND_DOWN)
+        remainders.append((exact - shares[key], key))
+
+    leftover = int((amount - sum(shares.values())) / CENT)
+    for _, key in sorted(remainders, key=lambda item: item[0], reverse=True)[:leftover]:
+        shares[key] += CENT
+    return shares
+
+
+def price_cart(rules, lines, order_discount=0, allow_price_edit=True):
+    """Price a cart against a rule set.
+
+    lines is a list of dicts with product_id and quantity, and optionally
+    unit_price, discount_percent, discount_amount and tax_percent. Prices
+    exclude tax. A unit_price other than the list price, or a tax_percent
+    other than the rule set's default, is an edit and is refused unless
+    allow_price_edit. Every amount in the result is a Decimal rounded to the
+    cent.
+    """
+    if len(lines) > MAX_LINES:
+        raise PricingError(f'A cart can have at most {MAX_LINES} lines')
+
+    prices = rules.prices
+    enable_tax = rules.enable_tax
+    default_tax = rules.default_tax_percent
+    zero = Decimal(0)
+
+    priced = []
+    subtotal = line_discounts = zero
+    bases = {}
+
+    for number, line in enumerate(lines, 1):
+        if not isinstance(line, dict):
+            raise PricingError(f'Line {number}: expected an object')
+        try:
+            product_id = int(line['product_id'])
+        except (KeyError, TypeError, ValueError):
+            raise PricingError(f'Line {number}: product_id is required')
+
+        quantity = _decimal(line.get('quantity'), f'Line {number}: quantity', Decimal(1))
+        if quantity <= 0:
+            raise PricingError(f'Line {number}: quantity must be above zero')
+        list_price = prices.get(product_id)
+        unit_price = line.get('unit_price')
+        if unit_price is None or unit_price == '':
+            if list_price is None:
+                raise PricingError(f'Line {number}: product {product_id} is not sold here')
+            unit_price = list_price
+        else:
+            unit_price = _decimal(unit_price, f'Line {number}: unit_price')
+            if unit_price < 0:
+                raise PricingError(f'Line {number}: unit_price cannot be negative')
+            if unit_price != list_price and not allow_price_edit:
+                raise PricingError(f'Line {number}: price edits are restricted')
+
+        discount_percent = _decimal(line.get('discount_percent'), f'Line {number}: discount_percent', zero)
+        if not zero <= discount_percent <= HUNDRED:
+            raise PricingError(f'Line {number}: discount_percent must be between 0 and 100')
+
+        gross = money(quantity * unit_price)
+        discount = money(gross * discount_percent / HUNDRED) + money(
+            _decimal(line.get('discount_amount'), f'Line {number}: discount_amount', zero))
+        if discount < 0 or (gross >= 0 and discount > gross):
+            raise PricingError(f'Line {number}: the discount is larger than the line')
+        net = gross - discount
+
+        tax_percent = zero
+        if enable_tax:
+            tax_percent = _decimal(line.get('tax_percent'), f'Line {number}: tax_percent', default_tax)
+            if not zero <= tax_percent <= HUNDRED:
+                raise PricingError(f'Line {number}: tax_percent must be between 0 and 100')
+            if tax_percent != default_tax and not allow_price_edit:
+                raise PricingError(f'Line {number}: tax rate edits are restricted')
+        bases[tax_percent] = bases.get(tax_percent, zero) + net
+
+        subtotal += gross
+        line_discounts += discount
+        priced.append({
+            'product_id': product_id,
+            'quantity': quantity,
+            'unit_price': unit_price,
+            'discount_amount': discount,
+            'tax_percent': tax_percent,
+            'subtotal': net,
+        })
+
+    net_total = subtotal - line_discounts
+    order_discount = money(_decimal(order_discount, 'discount_amount', zero))
+    if order_discount < 0 or order_discount > max(net_total, zero):
+        raise PricingError('The order discount must be between 0 and the cart total')
+
+    if order_discount and net_total:
+        for rate, share in _allocate(order_discount, bases).items():
+            bases[rate] -= share
+
+    taxes = []
+    tax_amount = zero
+    for rate, base in sorted(bases.items()):
+        amount = money(base * rate / HUNDRED)
+        tax_amount += amount
+        if rate:
+            taxes.append({'tax_percent': rate, 'base': base, 'amount': amount})
+
+    return {
+        'currency': rules.currency,
+        'lines': priced,
+        'subtotal': subtotal,
+        'discount_amount': line_discounts + order_discount,
+        'tax_amount': tax_amount,
+        'taxes': taxes,
+        'total_amount': net_total - order_discount + tax_amount,
+    }
+
+
+def _jsonable(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_jsonable(item) for item in value]
+    return value
+
+
+def _can_edit_prices(rules):
+    return not rules.restrict_price_edit or any(current_user.has_role(role) for role in PRICE_EDIT_ROLES)
+
+
+@pricing_bp.route('/pos/api/price', methods=['POST'])
+@login_required
+def price_route():
+    """Price a cart without saving it.
+
+    Body: {"lines": [{"product_id": 1, "quantity": 2, "discount_percent": 5}],
+    "discount_amount": "1.00"}. Amounts come back as strings ("12.50").
+    """
+    data = request.get_json(silent=True) or {}
+    lines = data.get('lines')
+    if not isinstance(lines, list):
+        return jsonify({'error': 'lines must be a list'}), 400
+
+    rules = rule_set(current_branch_id())
+    try:
+        result = price_cart(rules, lines, data.get('discount_amount'), _can_edit_prices(rules))
+    except PricingError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(_jsonable(result))
+
+
+@pricing_bp.cli.command('bench')
+@click.option('--lines', 'line_count', default=500, show_default=True, help='Lines per cart')
+@click.option('--runs', default=200, show_default=True, help='Carts priced')
+@click.option('--branch', 'branch_id', type=int, help='Branch whose prices are used')
+def bench_command(line_count, runs, branch_id):
+    """Time price_cart() on carts of LINES lines."""
+    rules = rule_set(branch_id)
+    product_ids = sorted(rules.prices)
+    if not product_ids:
+        raise click.ClickException('There are no active products to price')
+
+    lines = [{
+        'product_id': product_ids[i % len(product_ids)],
+        'quantity': (i % 7) + 1,
+        'discount_percent': 10 if i % 5 == 0 else 0,
+        'tax_percent': (0, 12.5, 15)[i % 3],
+    } for i in range(line_count)]
+    subtotal = price_cart(rules, lines)['subtotal']
+    order_discount = money(subtotal / 20)
+
+    started = time.perf_counter()
+    for _ in range(runs):
+        price_cart(rules, lines, order_discount)
+    elapsed = time.perf_counter() - started
+    print(f"Priced {runs} carts of {line_count} lines: {elapsed * 1000 / runs:.2f} ms per cart "
+          f"({runs * line_count / elapsed:,.0f} lines/s)")
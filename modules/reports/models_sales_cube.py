@@ -0,0 +1,41 @@
+from datetime import datetime
+from extensions import db
+
+
+class SalesCubeCell(db.Model):
+    """POS sales per day, branch, register, cashier and product.
+
+    Maintained by modules.reports.sales_cube from paid POS orders (by order
+    date) and validated returns (by return date), so sales reports sum these
+    rows instead of aggregating every order line. Amounts exclude tax except
+    tax_amount itself; net_amount is gross less discounts, cost_amount the
+    cost of the quantity sold less the quantity returned. Unknown branch,
+    register and cashier are stored as 0 so every cell has one row.
+    """
+    __tablename__ = 'sales_cube'
+    __table_args__ = (
+        db.UniqueConstraint('sale_date', 'product_id', 'branch_id', 'register_id', 'cashier_id',
+                            name='uq_sales_cube_cell'),
+        db.Index('ix_sales_cube_date_branch', 'sale_date', 'branch_id'),
+        db.Index('ix_sales_cube_date_category', 'sale_date', 'category_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sale_date = db.Column(db.Date, nullable=False)
+    branch_id = db.Column(db.Integer, nullable=False, default=0)
+    register_id = db.Column(db.Integer, nullable=False, default=0)
+    cashier_id = db.Column(db.Integer, nullable=False, default=0)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('product_categories.id'))
+    quantity = db.Column(db.Float, nullable=False, default=0.0)
+    gross_amount = db.Column(db.Float, nullable=False, default=0.0)
+    discount_amount = db.Column(db.Float, nullable=False, default=0.0)
+    tax_amount = db.Column(db.Float, nullable=False, default=0.0)
+    net_amount = db.Column(db.Float, nullable=False, default=0.0)
+    returned_quantity = db.Column(db.Float, nullable=False, default=0.0)
+    returned_amount = db.Column(db.Float, nullable=False, default=0.0)
+    cost_amount = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<SalesCubeCell {self.sale_date} product={self.product_id} branch={self.branch_id}>'
@@ -0,0 +1,416 @@
+"""
+POS sales cube for the sales and reports dashboards.
+
+Sales reports used to aggregate pos_orders and pos_order_lines (and their
+discounts) on every request, which for a year across branches means scanning
+every order line. The sales_cube table keeps the totals per day, branch,
+register, cashier and product (with the product's category). Paid orders are
+counted on their order date and validated returns on their return date.
+
+A cell is refreshed by recomputing it from the source rows of that one day
+and product. That keeps the cube exact whichever way an order, a line or a
+return changes. ORM changes refresh their cells through mapper events. Raw
+SQL writes (such as payment_gateway marking an order paid) call
+refresh_order()/refresh_return() themselves. `flask sales-cube rebuild`
+backfills a date range one day at a time.
+"""
+from datetime import date, datetime, time, timedelta
+
+import click
+from flask import Blueprint, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, event, inspect, text
+
+from extensions import db
+from modules.core.archival import history_table
+from modules.core.branch_scope import branch_column, current_branch_id
+
+sales_cube_bp = Blueprint('sales_cube', __name__, cli_group='sales-cube')
+
+REPORT_ROLES = ('Admin', 'Manager', 'Shop Manager', 'Sales')
+
+# Order and return states counted in the cube
+PAID_ORDER_STATES = ('paid',)
+PROCESSED_RETURN_STATES = ('validated',)
+
+# Columns the cube can be grouped and filtered by
+DIMENSIONS = ('sale_date', 'branch_id', 'register_id', 'cashier_id', 'product_id', 'category_id')
+
+MEASURES = ('quantity', 'gross_amount', 'discount_amount', 'tax_amount', 'net_amount',
+            'returned_quantity', 'returned_amount', 'cost_amount')
+
+# Longest range one report request may cover
+MAX_RANGE_DAYS = 732
+
+
+def _states(states):
+    return ', '.join(f"'{state}'" for state in states)
+
+
+def _cells_sql(by_product, branch, orders='pos_orders', order_lines='pos_order_lines'):
+    # Sales and returns of one day (optionally one product) as cube rows. A
+    # line's discount is its discount_amount, or else its discount_percent;
+    # tax is only counted on orders that recorded tax. branch is the order's
+    # branch column (see branch_scope.branch_column).
+    order_product = "AND l.product_id = :product_id" if by_product else ""
+    return_product = "AND rl.product_id = :product_id" if by_product else ""
+    return text(f"""
+        INSERT INTO sales_cube
+            (sale_date, branch_id, register_id, cashier_id, product_id, category_id,
+             quantity, gross_amount, discount_amount, tax_amount, net_amount,
+             returned_quantity, returned_amount, cost_amount, updated_at)
+        SELECT :day, f.branch_id, f.register_id, f.cashier_id, f.product_id, p.category_id,
+               SUM(f.quantity), SUM(f.gross), SUM(f.discount), SUM(f.tax), SUM(f.gross - f.discount),
+               SUM(f.returned_quantity), SUM(f.returned_amount),
+               SUM(f.quantity - f.returned_quantity) * COALESCE(p.cost_price, 0), :now
+        FROM (
+            SELECT COALESCE({branch}, 0) AS branch_id,
+                   COALESCE(s.cash_register_id, 0) AS register_id,
+                   COALESCE(o.created_by, s.user_id, 0) AS cashier_id,
+                   l.product_id,
+                   COALESCE(l.quantity, 0) AS quantity,
+                   COALESCE(l.quantity * l.unit_price, 0) AS gross,
+                   COALESCE(NULLIF(l.discount_amount, 0),
+                            l.quantity * l.unit_price * l.discount_percent / 100, 0) AS discount,
+                   CASE WHEN COALESCE(o.tax_amount, 0) > 0
+                        THEN (COALESCE(l.quantity * l.unit_price, 0)
+                              - COALESCE(NULLIF(l.discount_amount, 0),
+                                         l.quantity * l.unit_price * l.discount_percent / 100, 0))
+                             * COALESCE(l.tax_percent, 0) / 100
+                        ELSE 0 END AS tax,
+                   0 AS returned_quantity,
+                   0 AS returned_amount
+            FROM {order_lines} l
+            JOIN {orders} o ON o.id = l.order_id
+            LEFT JOIN pos_sessions s ON s.id = o.session_id
+            WHERE o.state IN ({_states(PAID_ORDER_STATES)})
+              AND o.order_date >= :start AND o.order_date < :end {order_product}
+            UNION ALL
+            SELECT COALESCE({branch}, 0), COALESCE(s.cash_register_id, 0),
+                   COALESCE(o.created_by, s.user_id, r.created_by, 0),
+                   rl.product_id, 0, 0, 0, 0,
+                   COALESCE(rl.quantity, 0),
+                   COALESCE(NULLIF(rl.subtotal, 0), rl.quantity * rl.unit_price, 0)
+            FROM pos_return_lines rl
+            JOIN pos_returns r ON r.id = rl.return_id
+            LEFT JOIN {orders} o ON o.id = r.original_order_id
+            LEFT JOIN pos_sessions s ON s.id = o.session_id
+            WHERE r.state IN ({_states(PROCESSED_RETURN_STATES)})
+              AND r.return_date >= :start AND r.return_date < :end {return_product}
+        ) f
+        JOIN products p ON p.id = f.product_id
+        GROUP BY f.branch_id, f.register_id, f.cashier_id, f.product_id, p.category_id, p.cost_price
+    """)
+
+
+_refresh_cells_sql = {}
+
+
+def _refresh_sql(connection):
+    branch = branch_column(connection, 'pos_orders', 'o')
+    if branch not in _refresh_cells_sql:
+        _refresh_cells_sql[branch] = _cells_sql(True, branch)
+    return _refresh_cells_sql[branch]
+
+
+def _day_of(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+
+def _day_params(day):
+    start = datetime.combine(day, time.min)
+    return {'day': day, 'start': start, 'end': start + timedelta(days=1), 'now': datetime.utcnow()}
+
+
+def refresh_cells(connection, keys):
+    """Recompute the cube rows of a set of (day, product_id) keys"""
+    keys = {(_day_of(day), product_id) for day, product_id in keys
+            if day is not None and product_id is not None}
+    if not keys:
+        return 0
+
+    params = [dict(_day_params(day), product_id=product_id) for day, product_id in keys]
+    connection.execute(text("DELETE FROM sales_cube WHERE sale_date = :day AND product_id = :product_id"),
+                       [{'day': p['day'], 'product_id': p['product_id']} for p in params])
+    connection.execute(_refresh_sql(connection), params)
+    return len(keys)
+
+
+def _order_keys(connection, order_id):
+    return {(row.order_date, row.product_id) for row in connection.execute(text("""
+        SELECT o.order_date, l.product_id
+        FROM pos_orders o JOIN pos_order_lines l ON l.order_id = o.id
+        WHERE o.id = :order_id
+    """).columns(order_date=db.DateTime), {'order_id': order_id})}
+
+
+def _return_keys(connection, return_id):
+    return {(row.return_date, row.product_id) for row in connection.execute(text("""
+        SELECT r.return_date, rl.product_id
+        FROM pos_returns r JOIN pos_return_lines rl ON rl.return_id = r.id
+        WHERE r.id = :return_id
+    """).columns(return_date=db.DateTime), {'return_id': return_id})}
+
+
+def refresh_order(connection, order_id):
+    """Refresh the cube after an order was changed with raw SQL"""
+    return refresh_cells(connection, _order_keys(connection, order_id))
+
+
+def refresh_return(connection, return_id):
+    """Refresh the cube after a return was changed with raw SQL"""
+    return refresh_cells(connection, _return_keys(connection, return_id))
+
+
+def rebuild_cube(start=None, end=None):
+    """Recompute the cube for [start, end], one day per statement"""
+    # Archived days are rebuilt from the archive as well
+    orders, order_lines = history_table('pos_orders'), history_table('pos_order_lines')
+    rebuild_day_sql = _cells_sql(False, branch_column(db.session.connection(), 'pos_orders', 'o'), orders, order_lines)
+
+    if start is None:
+        first = db.session.execute(text(
+            f"SELECT MIN(order_date) AS first_order FROM {orders}"
+        ).columns(first_order=db.DateTime)).scalar()
+        if first is None:
+            return 0
+        start = _day_of(first)
+    end = end or datetime.utcnow().date()
+
+    days = 0
+    try:
+        day = start
+        while day <= end:
+            connection = db.session.connection()
+            connection.execute(text("DELETE FROM sales_cube WHERE sale_date = :day"), {'day': day})
+            connection.execute(rebuild_day_sql, _day_params(day))
+            days += 1
+            # One transaction per day keeps the write lock short on SQLite
+            db.session.commit()
+            day += timedelta(days=1)
+    except Exception:
+        db.session.rollback()
+        raise
+    return days
+
+
+def sales_summary(start, end, group_by=('sale_date',), branch_ids=None, category_ids=None, product_ids=None):
+    """Cube totals between start and end (inclusive), grouped by DIMENSIONS"""
+    group_by = [column for column in group_by if column in DIMENSIONS]
+    columns = ', '.join(group_by)
+    measures = ', '.join(f'SUM({measure}) AS {measure}' for measure in MEASURES)
+
+    filters, params, expanding = ['sale_date >= :start', 'sale_date <= :end'], {'start': start, 'end': end}, []
+    for column, values in (('branch_id', branch_ids), ('category_id', category_ids), ('product_id', product_ids)):
+        if values:
+            filters.append(f'{column} IN :{column}s')
+            params[f'{column}s'] = list(values)
+            expanding.append(bindparam(f'{column}s', expanding=True))
+
+    query = text(f"""
+        SELECT {columns + ', ' if columns else ''}{measures}
+        FROM sales_cube
+        WHERE {' AND '.join(filters)}
+        {'GROUP BY ' + columns + ' ORDER BY ' + columns if columns else ''}
+    """).bindparams(*expanding)
+    if 'sale_date' in group_by:
+        query = query.columns(sale_date=db.Date)
+
+    rows = []
+    for row in db.session.execute(query, params).mappings():
+        row = dict(row)
+        for measure in MEASURES:
+            row[measure] = round(row[measure] or 0, 2)
+        row['margin_amount'] = round(row['net_amount'] - row['returned_amount'] - row['cost_amount'], 2)
+        rows.append(row)
+    return rows
+
+
+def register_sales_cube_listeners():
+    """Refresh cube cells whenever POS orders, returns or their lines change through the ORM"""
+    from modules.pos.models import POSOrder, POSOrderLine, POSReturn, POSReturnLine
+
+    if event.contains(POSOrder, 'after_update', _order_changed):
+        return
+
+    for model, remember, changed in ((POSOrder, _remember_order, _order_changed),
+                                     (POSReturn, _remember_return, _return_changed),
+                                     (POSOrderLine, _remember_order_line, _order_line_changed),
+                                     (POSReturnLine, _remember_return_line, _return_line_changed)):
+        event.listen(model, 'before_update', remember)
+        event.listen(model, 'before_delete', remember)
+        event.listen(model, 'after_insert', changed)
+        event.listen(model, 'after_update', changed)
+        event.listen(model, 'after_delete', changed)
+
+
+# Changes to other order and return columns leave the cube as it is
+_ORDER_FIELDS = ('state', 'order_date', 'session_id', 'created_by', 'branch_id', 'tax_amount')
+_RETURN_FIELDS = ('state', 'return_date', 'original_order_id', 'created_by')
+_LINE_FIELDS = ('product_id', 'quantity', 'unit_price', 'discount_amount', 'discount_percent',
+                'tax_percent', 'subtotal', 'order_id', 'return_id')
+
+
+def _affects_cube(target, fields):
+    state = inspect(target)
+    if state.deleted or state.was_deleted or not state.has_identity:
+        return True
+    return any(field in state.attrs and state.attrs[field].history.has_changes() for field in fields)
+
+
+def _is_deleted(target):
+    state = inspect(target)
+    return state.deleted or state.was_deleted
+
+
+def _stored_keys(target):
+    return inspect(target).info.pop('sales_cube_previous_keys', set())
+
+
+def _remember(target, keys):
+    # Values may already be expired when the row changes, so the cells the
+    # row counted towards are read back before the write
+    inspect(target).info['sales_cube_previous_keys'] = keys
+
+
+def _remember_order(mapper, connection, target):
+    if _affects_cube(target, _ORDER_FIELDS):
+        _remember(target, _order_keys(connection, target.id))
+
+
+def _order_changed(mapper, connection, target):
+    if not _affects_cube(target, _ORDER_FIELDS):
+        return
+    keys = _stored_keys(target)
+    if not _is_deleted(target):
+        keys |= _order_keys(connection, target.id)
+    refresh_cells(connection, keys)
+
+
+def _remember_return(mapper, connection, target):
+    if _affects_cube(target, _RETURN_FIELDS):
+        _remember(target, _return_keys(connection, target.id))
+
+
+def _return_changed(mapper, connection, target):
+    if not _affects_cube(target, _RETURN_FIELDS):
+        return
+    keys = _stored_keys(target)
+    if not _is_deleted(target):
+        keys |= _return_keys(connection, target.id)
+    refresh_cells(connection, keys)
+
+
+def _line_day(connection, sql, parent_id):
+    # None while the parent is not counted (a draft cart, an unprocessed
+    # return); the parent's own state change refreshes its cells once it is
+    row = connection.execute(text(sql).columns(day=db.DateTime), {'id': parent_id}).first()
+    return row.day if row else None
+
+
+_ORDER_DAY_SQL = f"SELECT order_date AS day FROM pos_orders WHERE id = :id AND state IN ({_states(PAID_ORDER_STATES)})"
+_RETURN_DAY_SQL = (f"SELECT return_date AS day FROM pos_returns "
+                   f"WHERE id = :id AND state IN ({_states(PROCESSED_RETURN_STATES)})")
+
+
+def _refresh_counted(connection, keys):
+    # Line edits on an uncounted parent (ringing up a cart) skip the cube entirely
+    keys = {key for key in keys if key[0] is not None}
+    if keys:
+        refresh_cells(connection, keys)
+
+
+def _stored_line(connection, table, parent_column, line_id):
+    return connection.execute(text(f"SELECT {parent_column} AS parent_id, product_id FROM {table} WHERE id = :id"),
+                              {'id': line_id}).first()
+
+
+def _remember_order_line(mapper, connection, target):
+    if not _affects_cube(target, _LINE_FIELDS):
+        return
+    line = _stored_line(connection, 'pos_order_lines', 'order_id', target.id)
+    _remember(target, {(_line_day(connection, _ORDER_DAY_SQL, line.parent_id), line.product_id)} if line else set())
+
+
+def _order_line_changed(mapper, connection, target):
+    if not _affects_cube(target, _LINE_FIELDS):
+        return
+    keys = _stored_keys(target)
+    if not _is_deleted(target):
+        keys.add((_line_day(connection, _ORDER_DAY_SQL, target.order_id), target.product_id))
+    _refresh_counted(connection, keys)
+
+
+def _remember_return_line(mapper, connection, target):
+    if not _affects_cube(target, _LINE_FIELDS):
+        return
+    line = _stored_line(connection, 'pos_return_lines', 'return_id', target.id)
+    _remember(target, {(_line_day(connection, _RETURN_DAY_SQL, line.parent_id), line.product_id)} if line else set())
+
+
+def _return_line_changed(mapper, connection, target):
+    if not _affects_cube(target, _LINE_FIELDS):
+        return
+    keys = _stored_keys(target)
+    if not _is_deleted(target):
+        keys.add((_line_day(connection, _RETURN_DAY_SQL, target.return_id), target.product_id))
+    _refresh_counted(connection, keys)
+
+
+def _can_view():
+    return any(current_user.has_role(role) for role in REPORT_ROLES)
+
+
+@sales_cube_bp.route('/sales/cube')
+@login_required
+def sales_cube_route():
+    """Sales totals from the cube.
+
+    ?start=YYYY-MM-DD&end=YYYY-MM-DD&group_by=branch_id,category_id and
+    optional branch_id/category_id/product_id filters (repeatable). Branch
+    users only see their own branch.
+    """
+    if not _can_view():
+        return jsonify({'error': 'You do not have permission to view sales reports'}), 403
+
+    today = datetime.utcnow().date()
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else today.replace(day=1)
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else today
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+    if end < start or (end - start).days > MAX_RANGE_DAYS:
+        return jsonify({'error': f'The range must be between 1 and {MAX_RANGE_DAYS} days'}), 400
+
+    group_by = [column for column in (request.args.get('group_by') or 'sale_date').split(',') if column]
+    unknown = [column for column in group_by if column not in DIMENSIONS]
+    if unknown:
+        return jsonify({'error': f"Cannot group by {', '.join(unknown)}"}), 400
+
+    branch_ids = request.args.getlist('branch_id', type=int)
+    branch_id = current_branch_id()
+    if branch_id is not None:
+        branch_ids = [branch_id]
+
+    rows = sales_summary(start, end, group_by, branch_ids,
+                         request.args.getlist('category_id', type=int),
+                         request.args.getlist('product_id', type=int))
+    for row in rows:
+        if 'sale_date' in row:
+            row['sale_date'] = row['sale_date'].isoformat()
+    return jsonify({'start': start.isoformat(), 'end': end.isoformat(), 'group_by': group_by, 'rows': rows})
+
+
+@sales_cube_bp.cli.command('rebuild')
+@click.option('--start', help='First day to rebuild (YYYY-MM-DD), defaults to the first order')
+@click.option('--end', help='Last day to rebuild (YYYY-MM-DD), defaults to today')
+def rebuild_command(start, end):
+    """Rebuild the POS sales cube from orders and returns."""
+    start = date.fromisoformat(start) if start else None
+    end = date.fromisoformat(end) if end else None
+    days = rebuild_cube(start, end)
+    print(f"Sales cube rebuilt: {days} days")
@@ -0,0 +1,243 @@
+"""
+Receivables aging for the sales module.
+
+Each invoice has a row in invoice_balances holding its total, what has been
+paid and the residual still owed. The row is refreshed with one
+INSERT ... SELECT whenever the invoice or one of its payments changes, so
+the customer statement and the receivables dashboard read balances and
+aging buckets from a single grouped query instead of iterating invoices and
+payments in Python.
+"""
+from datetime import date, datetime, time, timedelta
+
+from flask import Blueprint, jsonify, request
+from flask_login import current_user, login_required
+from sqlalchemy import bindparam, event, inspect, text
+
+from extensions import db
+
+receivables_bp = Blueprint('receivables', __name__, cli_group='receivables')
+
+RECEIVABLES_ROLES = ('Admin', 'Manager', 'Sales')
+
+# Invoices in these states are not receivables
+EXCLUDED_INVOICE_STATES = ('draft', 'cancelled')
+
+# Payments in these states have not reduced the balance
+EXCLUDED_PAYMENT_STATES = ('draft', 'cancelled')
+
+# Residuals below this are treated as settled
+SETTLED_THRESHOLD = 0.005
+
+_REFRESH_BALANCES_SQL = text("""
+    INSERT INTO invoice_balances
+        (invoice_id, customer_id, state, invoice_date, due_date,
+         total_amount, paid_amount, residual_amount, updated_at)
+    SELECT i.id, i.customer_id, i.state, i.invoice_date, COALESCE(i.due_date, i.invoice_date),
+           COALESCE(i.total_amount, 0), COALESCE(p.paid, 0),
+           COALESCE(i.total_amount, 0) - COALESCE(p.paid, 0), :now
+    FROM invoices i
+    LEFT JOIN (
+        SELECT invoice_id, SUM(amount) AS paid
+        FROM payments
+        WHERE invoice_id IN :invoice_ids AND COALESCE(state, 'posted') NOT IN :payment_states
+        GROUP BY invoice_id
+    ) p ON p.invoice_id = i.id
+    WHERE i.id IN :invoice_ids
+    ON CONFLICT (invoice_id) DO UPDATE SET
+        customer_id = excluded.customer_id,
+        state = excluded.state,
+        invoice_date = excluded.invoice_date,
+        due_date = excluded.due_date,
+        total_amount = excluded.total_amount,
+        paid_amount = excluded.paid_amount,
+        residual_amount = excluded.residual_amount,
+        updated_at = excluded.updated_at
+""").bindparams(bindparam('invoice_ids', expanding=True), bindparam('payment_states', expanding=True))
+
+
+def refresh_balances(connection, invoice_ids):
+    """Recompute the balance rows of the given invoices"""
+    invoice_ids = [invoice_id for invoice_id in set(invoice_ids) if invoice_id is not None]
+    if not invoice_ids:
+        return
+    connection.execute(_REFRESH_BALANCES_SQL, {
+        'invoice_ids': invoice_ids,
+        'payment_states': list(EXCLUDED_PAYMENT_STATES),
+        'now': datetime.utcnow(),
+    })
+
+
+def rebuild_balances(batch_size=1000):
+    """Recompute every invoice balance, batch_size invoices at a time"""
+    invoice_ids = [row.id for row in db.session.execute(text("SELECT id FROM invoices ORDER BY id"))]
+    try:
+        db.session.execute(text("DELETE FROM invoice_balances"))
+        for start in range(0, len(invoice_ids), batch_size):
+            refresh_balances(db.session.connection(), invoice_ids[start:start + batch_size])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(invoice_ids)
+
+
+def _bucket_params(as_of):
+    """Due-date cut-offs for the 0-30, 31-60, 61-90 and 90+ day buckets"""
+    day = datetime.combine(as_of, time.min)
+    return {
+        'cutoff_30': day - timedelta(days=30),
+        'cutoff_60': day - timedelta(days=60),
+        'cutoff_90': day - timedelta(days=90),
+    }
+
+
+def aging_report(as_of=None, customer_ids=None):
+    """Outstanding balance per customer split into aging buckets by days past due"""
+    as_of = as_of or datetime.utcnow().date()
+    customer_filter = "AND b.customer_id IN :customer_ids" if customer_ids else ""
+    query = text(f"""
+        SELECT b.customer_id, c.name AS customer_name,
+               COUNT(*) AS open_invoices,
+               SUM(b.residual_amount) AS total_due,
+               SUM(CASE WHEN b.due_date >= :cutoff_30 OR b.due_date IS NULL
+                        THEN b.residual_amount ELSE 0 END) AS days_0_30,
+               SUM(CASE WHEN b.due_date < :cutoff_30 AND b.due_date >= :cutoff_60
+                        THEN b.residual_amount ELSE 0 END) AS days_31_60,
+               SUM(CASE WHEN b.due_date < :cutoff_60 AND b.due_date >= :cutoff_90
+                        THEN b.residual_amount ELSE 0 END) AS days_61_90,
+               SUM(CASE WHEN b.due_date < :cutoff_90
+                        THEN b.residual_amount ELSE 0 END) AS days_over_90
+        FROM invoice_balances b
+        JOIN customers c ON c.id = b.customer_id
+        WHERE COALESCE(b.state, 'open') NOT IN :invoice_states
+          AND b.residual_amount > :settled {customer_filter}
+        GROUP BY b.customer_id, c.name
+        ORDER BY SUM(b.residual_amount) DESC
+    """).bindparams(bindparam('invoice_states', expanding=True))
+
+    params = dict(_bucket_params(as_of), invoice_states=list(EXCLUDED_INVOICE_STATES),
+                  settled=SETTLED_THRESHOLD)
+    if customer_ids:
+        query = query.bindparams(bindparam('customer_ids', expanding=True))
+        params['customer_ids'] = list(customer_ids)
+
+    customers = [dict(row) for row in db.session.execute(query, params).mappings()]
+    buckets = ('total_due', 'days_0_30', 'days_31_60', 'days_61_90', 'days_over_90')
+    totals = {bucket: round(sum(row[bucket] or 0 for row in customers), 2) for bucket in buckets}
+    return {'as_of': as_of.isoformat(), 'totals': totals, 'customers': customers}
+
+
+def customer_statement(customer_id, as_of=None):
+    """Open invoices of one customer, oldest due first, with their aging"""
+    as_of = as_of or datetime.utcnow().date()
+    rows = db.session.execute(text("""
+        SELECT b.invoice_id, i.name, b.invoice_date, b.due_date,
+               b.total_amount, b.paid_amount, b.residual_amount
+        FROM invoice_balances b
+        JOIN invoices i ON i.id = b.invoice_id
+        WHERE b.customer_id = :customer_id
+          AND COALESCE(b.state, 'open') NOT IN :invoice_states
+          AND b.residual_amount > :settled
+        ORDER BY b.due_date, b.invoice_id
+    """).bindparams(bindparam('invoice_states', expanding=True))
+        .columns(invoice_date=db.DateTime, due_date=db.DateTime),
+        {'customer_id': customer_id, 'invoice_states': list(EXCLUDED_INVOICE_STATES),
+         'settled': SETTLED_THRESHOLD})
+
+    today = datetime.combine(as_of, time.min)
+    invoices = []
+    for row in rows.mappings():
+        row = dict(row)
+        row['days_overdue'] = max(0, (today - row['due_date']).days) if row['due_date'] else 0
+        invoices.append(row)
+
+    aging = aging_report(as_of, [customer_id])['customers']
+    return {
+        'customer_id': customer_id,
+        'as_of': as_of.isoformat(),
+        'aging': aging[0] if aging else None,
+        'invoices': invoices,
+    }
+
+
+def register_aging_listeners():
+    """Refresh invoice balances whenever invoices or payments change through the ORM"""
+    from modules.sales.models import Invoice, Payment
+
+    if event.contains(Payment, 'after_insert', _payment_changed):
+        return
+
+    event.listen(Invoice, 'after_insert', _invoice_changed)
+    event.listen(Invoice, 'after_update', _invoice_changed)
+    event.listen(Invoice, 'before_delete', _invoice_deleted)
+    event.listen(Payment, 'before_update', _remember_payment_invoice)
+    event.listen(Payment, 'after_insert', _payment_changed)
+    event.listen(Payment, 'after_update', _payment_changed)
+    event.listen(Payment, 'after_delete', _payment_changed)
+
+
+def _invoice_changed(mapper, connection, target):
+    refresh_balances(connection, [target.id])
+
+
+def _invoice_deleted(mapper, connection, target):
+    connection.execute(text("DELETE FROM invoice_balances WHERE invoice_id = :id"), {'id': target.id})
+
+
+def _remember_payment_invoice(mapper, connection, target):
+    # A payment moved to another invoice changes the balance of both
+    previous = connection.execute(
+        text("SELECT invoice_id FROM payments WHERE id = :id"), {'id': target.id}
+    ).scalar()
+    inspect(target).info['aging_previous_invoice'] = previous
+
+
+def _payment_changed(mapper, connection, target):
+    previous = inspect(target).info.pop('aging_previous_invoice', None)
+    refresh_balances(connection, [target.invoice_id, previous])
+
+
+def _as_of():
+    value = request.args.get('as_of')
+    return date.fromisoformat(value) if value else None
+
+
+def _can_view():
+    return any(current_user.has_role(role) for role in RECEIVABLES_ROLES)
+
+
+@receivables_bp.route('/receivables/aging')
+@login_required
+def receivables_aging():
+    """Receivables dashboard data: aging buckets per customer"""
+    if not _can_view():
+        return jsonify({'error': 'You do not have permission to view receivables'}), 403
+
+    try:
+        as_of = _as_of()
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    return jsonify(aging_report(as_of, request.args.getlist('customer_id', type=int)))
+
+
+@receivables_bp.route('/customers/<int:customer_id>/statement')
+@login_required
+def customer_statement_route(customer_id):
+    if not _can_view():
+        return jsonify({'error': 'You do not have permission to view receivables'}), 403
+
+    try:
+        as_of = _as_of()
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    return jsonify(customer_statement(customer_id, as_of))
+
+
+@receivables_bp.cli.command('rebuild-balances')
+def rebuild_balances_command():
+    """Recompute invoice residual amounts from invoices and payments."""
+    count = rebuild_balances()
+    print(f"Invoice balances rebuilt for {count} invoices")
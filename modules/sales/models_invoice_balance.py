@@ -0,0 +1,28 @@
+from datetime import datetime
+from extensions import db
+
+
+class InvoiceBalance(db.Model):
+    """Outstanding (residual) amount per invoice.
+
+    Maintained by modules.sales.aging whenever an invoice or one of its
+    payments changes, so aging and customer statements can group these rows
+    instead of walking every invoice and payment in Python.
+    """
+    __tablename__ = 'invoice_balances'
+    __table_args__ = (
+        db.Index('ix_invoice_balance_customer_state_due', 'customer_id', 'state', 'due_date'),
+    )
+
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'), primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    state = db.Column(db.String(20))
+    invoice_date = db.Column(db.DateTime)
+    due_date = db.Column(db.DateTime)
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    paid_amount = db.Column(db.Float, nullable=False, default=0.0)
+    residual_amount = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<InvoiceBalance invoice={self.invoice_id} residual={self.residual_amount}>'
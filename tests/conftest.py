@@ -0,0 +1,49 @@
+"""
+Fixtures for the module tests.
+
+The auth, inventory, pos and sales models these modules build on are not
+imported: each test creates the few upstream columns it reads with plain
+DDL, and the tables of the models under test with create_tables().
+"""
+import pytest
+from flask import Flask
+from sqlalchemy import Column, Integer, Table, text
+
+from extensions import db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask('tests')
+    app.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'test.db'}",
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    )
+    db.init_app(app)
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+def execute_script(connection, script):
+    """Run ;-separated DDL statements"""
+    for statement in script.split(';'):
+        if statement.strip():
+            connection.execute(text(statement))
+
+
+def create_tables(connection, *tables):
+    """Create model tables.
+
+    Upstream tables they reference that are not loaded are added to the
+    metadata with a bare id column, so foreign keys resolve; the test creates
+    them itself if it reads them.
+    """
+    for table in tables:
+        for key in table.foreign_keys:
+            name = key.target_fullname.split('.')[0]
+            if name not in db.metadata.tables:
+                Table(name, db.metadata, Column('id', Integer, primary_key=True))
+    db.metadata.create_all(connection, tables=list(tables))
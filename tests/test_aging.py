@@ -0,0 +1,91 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import text
+
+from conftest import create_tables, execute_script
+from extensions import db
+from modules.sales.aging import aging_report, customer_statement, refresh_balances
+from modules.sales.models_invoice_balance import InvoiceBalance
+
+AS_OF = date(2026, 3, 31)
+
+# (id, customer, state, due date, total, paid)
+INVOICES = [
+    (1, 1, 'posted', datetime(2026, 3, 1), 100.0, 0),      # 30 days past due
+    (2, 1, 'posted', datetime(2026, 2, 28), 200.0, 50.0),  # 31 days
+    (3, 1, 'posted', datetime(2026, 1, 30), 300.0, 0),     # 60 days
+    (4, 1, 'posted', datetime(2026, 1, 29), 400.0, 0),     # 61 days
+    (5, 1, 'posted', datetime(2026, 1, 1), 500.0, 0),      # 89 days
+    (6, 1, 'posted', datetime(2025, 12, 31), 600.0, 0),    # 90 days
+    (7, 1, 'posted', datetime(2025, 12, 30), 700.0, 0),    # 91 days
+    (8, 1, 'draft', datetime(2025, 1, 1), 800.0, 0),
+    (9, 1, 'posted', datetime(2025, 1, 1), 900.0, 900.0),
+    (10, 2, 'posted', datetime(2026, 4, 30), 50.0, 0),     # not due yet
+]
+
+
+@pytest.fixture
+def balances(app):
+    with db.engine.begin() as connection:
+        execute_script(connection, """
+            CREATE TABLE customers (id INTEGER PRIMARY KEY, name VARCHAR(100));
+            CREATE TABLE invoices (
+                id INTEGER PRIMARY KEY, name VARCHAR(20), customer_id INTEGER, state VARCHAR(20),
+                invoice_date DATETIME, due_date DATETIME, total_amount FLOAT);
+            CREATE TABLE payments (id INTEGER PRIMARY KEY, invoice_id INTEGER, amount FLOAT, state VARCHAR(20));
+            INSERT INTO customers (id, name) VALUES (1, 'Ama'), (2, 'Kofi')
+        """)
+        create_tables(connection, InvoiceBalance.__table__)
+        for invoice_id, customer_id, state, due_date, total, paid in INVOICES:
+            connection.execute(text("""
+                INSERT INTO invoices (id, name, customer_id, state, invoice_date, due_date, total_amount)
+                VALUES (:id, :name, :customer_id, :state, :due_date, :due_date, :total)
+            """), {'id': invoice_id, 'name': f'INV/{invoice_id}', 'customer_id': customer_id,
+                   'state': state, 'due_date': due_date, 'total': total})
+            if paid:
+                connection.execute(text(
+                    "INSERT INTO payments (invoice_id, amount, state) VALUES (:id, :amount, 'posted')"),
+                    {'id': invoice_id, 'amount': paid})
+        # A cancelled payment does not reduce the balance
+        connection.execute(text(
+            "INSERT INTO payments (invoice_id, amount, state) VALUES (1, 100, 'cancelled')"))
+        refresh_balances(connection, [invoice_id for invoice_id, *_ in INVOICES])
+
+
+def test_buckets_split_on_days_past_due(balances):
+    report = aging_report(AS_OF)
+    ama = report['customers'][0]
+
+    assert ama['customer_name'] == 'Ama'
+    assert ama['open_invoices'] == 7
+    assert ama['days_0_30'] == 100.0
+    assert ama['days_31_60'] == 150.0 + 300.0
+    assert ama['days_61_90'] == 400.0 + 500.0 + 600.0
+    assert ama['days_over_90'] == 700.0
+    assert ama['total_due'] == 2750.0
+
+
+def test_totals_cover_every_customer(balances):
+    report = aging_report(AS_OF)
+
+    assert report['as_of'] == '2026-03-31'
+    assert [row['customer_id'] for row in report['customers']] == [1, 2]
+    assert report['totals']['days_0_30'] == 150.0
+    assert report['totals']['total_due'] == 2800.0
+
+
+def test_report_for_selected_customers(balances):
+    report = aging_report(AS_OF, customer_ids=[2])
+
+    assert [row['customer_id'] for row in report['customers']] == [2]
+    assert report['totals']['total_due'] == 50.0
+
+
+def test_statement_lists_open_invoices_oldest_first(balances):
+    statement = customer_statement(1, AS_OF)
+
+    assert [row['invoice_id'] for row in statement['invoices']] == [7, 6, 5, 4, 3, 2, 1]
+    assert [row['days_overdue'] for row in statement['invoices']] == [91, 90, 89, 61, 60, 31, 30]
+    assert statement['invoices'][5]['residual_amount'] == 150.0
+    assert statement['aging']['total_due'] == 2750.0
@@ -0,0 +1,43 @@
+from modules.core.db_copy import copy_levels
+
+
+def fk(name, child, parent):
+    return (name, child, parent, f'FOREIGN KEY ({parent}_id) REFERENCES {parent}(id)')
+
+
+def test_tables_follow_the_tables_they_reference():
+    tables = ['order_lines', 'orders', 'customers', 'products', 'settings']
+    keys = [
+        fk('order_lines_order_id_fkey', 'order_lines', 'orders'),
+        fk('order_lines_product_id_fkey', 'order_lines', 'products'),
+        fk('orders_customer_id_fkey', 'orders', 'customers'),
+    ]
+
+    levels, cyclic = copy_levels(tables, keys)
+
+    assert levels == [['customers', 'products', 'settings'], ['orders'], ['order_lines']]
+    assert cyclic == []
+
+
+def test_self_references_and_other_tables_are_ignored():
+    keys = [
+        fk('categories_parent_id_fkey', 'categories', 'categories'),
+        fk('products_category_id_fkey', 'products', 'categories'),
+        fk('products_uom_id_fkey', 'products', 'units'),
+    ]
+
+    levels, cyclic = copy_levels(['categories', 'products'], keys)
+
+    assert levels == [['categories'], ['products']]
+    assert cyclic == []
+
+
+def test_cycles_are_returned_to_be_deferred():
+    manager = fk('departments_manager_id_fkey', 'departments', 'employees')
+    department = fk('employees_department_id_fkey', 'employees', 'departments')
+    keys = [manager, department, fk('leaves_employee_id_fkey', 'leaves', 'employees')]
+
+    levels, cyclic = copy_levels(['departments', 'employees', 'leaves'], keys)
+
+    assert sorted(cyclic) == sorted([manager, department])
+    assert levels == [['departments', 'employees'], ['leaves']]
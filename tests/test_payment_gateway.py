@@ -0,0 +1,108 @@
+import json
+
+import pytest
+from flask import current_app
+from sqlalchemy import text
+
+from conftest import create_tables, execute_script
+from extensions import db
+from modules.pos import payment_gateway
+from modules.pos.models_payment_intent import PaymentIntent, PaymentWebhookEvent
+from modules.pos.payment_gateway import (
+    MockProvider, PaymentError, handle_webhook, initiate_payment, resolve_intent)
+
+
+@pytest.fixture
+def refreshed(app, monkeypatch):
+    app.config.update(PAYMENT_PROVIDER='mock', PAYMENT_MOCK_SECRET='test-secret')
+    with db.engine.begin() as connection:
+        execute_script(connection, """
+            CREATE TABLE pos_orders (
+                id INTEGER PRIMARY KEY, state VARCHAR(20), total_amount FLOAT,
+                payment_method VARCHAR(20), payment_reference VARCHAR(64));
+            INSERT INTO pos_orders (id, state, total_amount) VALUES (1, 'draft', 12.5)
+        """)
+        create_tables(connection, PaymentIntent.__table__, PaymentWebhookEvent.__table__)
+    # The sales cube is not under test; record the orders it would refresh
+    orders = []
+    monkeypatch.setattr(payment_gateway, 'refresh_order', lambda connection, order_id: orders.append(order_id))
+    return orders
+
+
+def order_state():
+    return db.session.execute(text("SELECT state, payment_method FROM pos_orders WHERE id = 1")).first()
+
+
+def webhook(intent, event='charge.success', status='success', amount=None, event_id=None):
+    body = json.dumps({'event': event, 'data': {
+        'id': event_id or intent.id, 'reference': intent.reference, 'status': status,
+        'amount': intent.amount if amount is None else amount}}).encode()
+    return body, {'X-Paystack-Signature': MockProvider(current_app.config).sign(body)}
+
+
+def test_initiate_reuses_the_pending_intent(refreshed):
+    intent = initiate_payment(1, 'momo')
+
+    assert intent.amount == 1250
+    assert intent.provider == 'mock'
+    assert initiate_payment(1, 'MOMO').id == intent.id
+
+
+def test_resolve_intent_marks_the_order_paid_once(refreshed):
+    intent = initiate_payment(1, 'MOMO')
+
+    assert resolve_intent(intent, 'success', amount=1250)
+    assert not resolve_intent(intent, 'failed')
+    db.session.commit()
+
+    assert tuple(order_state()) == ('paid', 'momo')
+    assert db.session.get(PaymentIntent, intent.id).status == 'success'
+    assert refreshed == [1]
+
+
+def test_resolve_intent_fails_a_wrong_amount(refreshed):
+    intent = initiate_payment(1, 'CARD')
+
+    assert resolve_intent(intent, 'success', amount=100)
+    db.session.commit()
+
+    resolved = db.session.get(PaymentIntent, intent.id)
+    assert resolved.status == 'failed'
+    assert resolved.error == 'Paid 100 instead of 1250'
+    assert order_state().state == 'draft'
+    assert refreshed == []
+
+
+def test_webhook_redeliveries_are_duplicates(refreshed):
+    intent = initiate_payment(1, 'MOMO')
+    body, headers = webhook(intent)
+
+    assert handle_webhook('mock', body, headers) == 'processed'
+    assert handle_webhook('mock', body, headers) == 'duplicate'
+    # A different event for an intent already resolved changes nothing
+    body, headers = webhook(intent, 'charge.failed', 'failed', event_id='other')
+    assert handle_webhook('mock', body, headers) == 'ignored'
+
+    assert order_state().state == 'paid'
+    assert db.session.execute(text("SELECT COUNT(*) FROM payment_webhook_events")).scalar() == 2
+    assert refreshed == [1]
+
+
+def test_webhook_signature_is_checked(refreshed):
+    intent = initiate_payment(1, 'MOMO')
+    body, _ = webhook(intent)
+
+    with pytest.raises(PaymentError, match='signature'):
+        handle_webhook('mock', body, {'X-Paystack-Signature': 'forged'})
+    assert db.session.execute(text("SELECT COUNT(*) FROM payment_webhook_events")).scalar() == 0
+
+
+def test_late_success_recovers_an_abandoned_intent(refreshed):
+    intent = initiate_payment(1, 'MOMO')
+    resolve_intent(intent, 'abandoned')
+    db.session.commit()
+    body, headers = webhook(intent)
+
+    assert handle_webhook('mock', body, headers) == 'recovered'
+    assert order_state().state == 'paid'
+    assert db.session.get(PaymentIntent, intent.id).status == 'success'
@@ -0,0 +1,88 @@
+from decimal import Decimal
+from types import MappingProxyType
+
+import pytest
+
+from modules.pos.pricing import PricingError, RuleSet, price_cart
+
+
+def make_rules(enable_tax=True, default_tax_percent='15', prices=None):
+    prices = prices or {1: '10.00', 2: '4.99'}
+    return RuleSet(
+        branch_id=None,
+        enable_tax=enable_tax,
+        restrict_price_edit=False,
+        currency='GH₵',
+        default_tax_percent=Decimal(default_tax_percent),
+        prices=MappingProxyType({product_id: Decimal(price) for product_id, price in prices.items()}),
+        built_at=0,
+    )
+
+
+def test_lines_use_list_prices_and_default_tax():
+    result = price_cart(make_rules(), [{'product_id': 1, 'quantity': 3}])
+
+    assert result['lines'][0]['unit_price'] == Decimal('10.00')
+    assert result['lines'][0]['tax_percent'] == Decimal('15')
+    assert result['subtotal'] == Decimal('30.00')
+    assert result['tax_amount'] == Decimal('4.50')
+    assert result['total_amount'] == Decimal('34.50')
+
+
+def test_order_discount_is_split_over_tax_rates():
+    lines = [{'product_id': 1, 'quantity': 3}, {'product_id': 2, 'quantity': 2, 'tax_percent': 0}]
+    result = price_cart(make_rules(), lines, order_discount='1.00')
+
+    # 1.00 over bases of 30.00 and 9.98: 0.75 and 0.25 once the cents add up
+    assert result['taxes'] == [{'tax_percent': Decimal('15'), 'base': Decimal('29.25'), 'amount': Decimal('4.39')}]
+    assert result['discount_amount'] == Decimal('1.00')
+    assert result['total_amount'] == Decimal('39.98') - Decimal('1.00') + Decimal('4.39')
+
+
+def test_line_discounts_round_half_up():
+    result = price_cart(make_rules(enable_tax=False), [
+        {'product_id': 2, 'quantity': 1, 'discount_percent': 50}])
+
+    # 4.99 / 2 = 2.495
+    assert result['lines'][0]['discount_amount'] == Decimal('2.50')
+    assert result['total_amount'] == Decimal('2.49')
+
+
+@pytest.mark.parametrize('tax_percent', [-1, 101, 'NaN', 'inf'])
+def test_tax_percent_must_be_a_rate(tax_percent):
+    with pytest.raises(PricingError):
+        price_cart(make_rules(), [{'product_id': 1, 'tax_percent': tax_percent}])
+
+
+def test_tax_percent_is_ignored_without_tax():
+    result = price_cart(make_rules(enable_tax=False), [{'product_id': 1, 'tax_percent': 500}])
+
+    assert result['tax_amount'] == Decimal('0')
+
+
+def test_restricted_edits_are_refused():
+    rules = make_rules()
+
+    with pytest.raises(PricingError, match='price edits are restricted'):
+        price_cart(rules, [{'product_id': 1, 'unit_price': '1.00'}], allow_price_edit=False)
+    with pytest.raises(PricingError, match='tax rate edits are restricted'):
+        price_cart(rules, [{'product_id': 1, 'tax_percent': 0}], allow_price_edit=False)
+
+    # The list price and the default rate are not edits
+    price_cart(rules, [{'product_id': 1, 'unit_price': '10', 'tax_percent': '15.0'}], allow_price_edit=False)
+
+
+@pytest.mark.parametrize('line, message', [
+    ({'product_id': 3}, 'not sold here'),
+    ({'product_id': 1, 'quantity': 0}, 'above zero'),
+    ({'product_id': 1, 'quantity': '1e30'}, 'out of range'),
+    ({'product_id': 1, 'discount_amount': 11}, 'larger than the line'),
+])
+def test_invalid_lines(line, message):
+    with pytest.raises(PricingError, match=message):
+        price_cart(make_rules(), [line])
+
+
+def test_order_discount_cannot_exceed_the_cart():
+    with pytest.raises(PricingError):
+        price_cart(make_rules(), [{'product_id': 1}], order_discount='10.01')
@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy import text
+
+from conftest import create_tables, execute_script
+from extensions import db
+from modules.inventory.models_valuation import StockValuationLayer
+from modules.inventory.valuation import add_incoming, add_outgoing, current_unit_cost
+
+
+@pytest.fixture
+def connection(app):
+    with db.engine.begin() as connection:
+        execute_script(connection, """
+            CREATE TABLE products (id INTEGER PRIMARY KEY, cost_price FLOAT);
+            INSERT INTO products (id, cost_price) VALUES (1, 4.0)
+        """)
+        create_tables(connection, StockValuationLayer.__table__)
+        yield connection
+
+
+def open_layers(connection):
+    return connection.execute(text("""
+        SELECT remaining_qty, remaining_value FROM stock_valuation_layers
+        WHERE remaining_qty > 0 ORDER BY id
+    """)).all()
+
+
+def receive(connection):
+    add_incoming(connection, 1, 10, 2.0, 'purchase_receipt', 1)
+    add_incoming(connection, 1, 10, 3.0, 'purchase_receipt', 2)
+
+
+def test_fifo_takes_the_oldest_layers_first(app, connection):
+    receive(connection)
+
+    assert add_outgoing(connection, 1, 15, 'sale', 1) == pytest.approx(10 * 2.0 + 5 * 3.0)
+    assert open_layers(connection) == [(5.0, 15.0)]
+    assert current_unit_cost(connection, 1) == pytest.approx(3.0)
+
+
+def test_average_takes_the_running_average(app, connection):
+    app.config['INVENTORY_COSTING_METHOD'] = 'average'
+    receive(connection)
+
+    assert add_outgoing(connection, 1, 15, 'sale', 1) == pytest.approx(15 * 2.5)
+    assert sum(value for _, value in open_layers(connection)) == pytest.approx(5 * 2.5)
+
+
+@pytest.mark.parametrize('method', ['fifo', 'average'])
+def test_stock_beyond_the_layers_is_costed_at_the_cost_price(app, connection, method):
+    app.config['INVENTORY_COSTING_METHOD'] = method
+    receive(connection)
+
+    assert add_outgoing(connection, 1, 25, 'sale', 1) == pytest.approx(50.0 + 5 * 4.0)
+    assert open_layers(connection) == []
+
+
+def test_each_source_is_valued_once(app, connection):
+    receive(connection)
+    add_outgoing(connection, 1, 5, 'sale', 1)
+
+    assert add_incoming(connection, 1, 10, 2.0, 'purchase_receipt', 1) is None
+    assert add_outgoing(connection, 1, 5, 'sale', 1) is None
+    assert connection.execute(text("SELECT COUNT(*) FROM stock_valuation_layers")).scalar() == 3
+
+
+def test_incoming_without_a_cost_uses_the_cost_price(app, connection):
+    assert add_incoming(connection, 1, 2, None, 'opening', 1) == pytest.approx(8.0)
+    assert add_incoming(connection, 1, 0, 1.0, 'opening', 2) is None
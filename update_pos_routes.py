@@ -44,41 +44,24 @@ end_pos = match.end() + end_match.start()
 
 # Define the new code section
 new_code = """    # Filter cash registers by branch for non-admin users
+    from modules.core.structured_logging import get_logger
+    log = get_logger('pos')
     if is_admin:
         # Admin sees all cash registers
         try:
             registers = POSCashRegister.query.all()
             form.cash_register_id.choices = [(r.id, r.name) for r in registers]
         except Exception as e:
-            print(f"Error getting cash registers: {e}")
+            log.warning("Error getting cash registers: %s", e)
             form.cash_register_id.choices = []
     else:
         # Branch managers and sales workers only see their branch's cash registers
         try:
-            # Determine branch ID based on user role and attributes
-            branch_id = 1  # Default to Branch 1
+            # Determine branch ID from the user's branch
+            from modules.core.branch_scope import branch_id_for
+            branch_id = branch_id_for(current_user) or 1  # Default to Branch 1
             
-            # Check if user has branch_id attribute
-            if hasattr(current_user, 'branch_id') and current_user.branch_id:
-                branch_id = current_user.branch_id
-                print(f"Using branch_id from user attributes: {branch_id}")
-            # If not, try to extract from username
-            elif current_user.username:
-                username = current_user.username.lower()
-                if 'branch' in username:
-                    try:
-                        branch_id = int(username.replace('branch', '').strip())
-                        print(f"Extracted branch_id from username (branch pattern): {branch_id}")
-                    except ValueError:
-                        pass
-                elif 'manager' in username:
-                    try:
-                        branch_id = int(username.replace('manager', '').strip())
-                        print(f"Extracted branch_id from username (manager pattern): {branch_id}")
-                    except ValueError:
-                        pass
-            
-            print(f"User: {current_user.username}, Branch ID: {branch_id}")
+            log.debug("User: %s, Branch ID: %s", current_user.username, branch_id)
             
             # Get cash registers for this specific branch only
             registers = POSCashRegister.query.filter_by(branch_id=branch_id).all()
@@ -90,12 +73,12 @@ new_code = """    # Filter cash registers by branch for non-admin users
                 # ALWAYS pre-select the first register for non-admin users
                 # This is critical to ensure the cash register is selected
                 form.cash_register_id.data = registers[0].id
-                print(f"Pre-selected cash register ID: {registers[0].id} for branch {branch_id}")
+                log.debug("Pre-selected cash register ID: %s for branch %s", registers[0].id, branch_id)
             else:
                 flash(f'No cash registers found for Branch {branch_id}. Please contact an administrator.', 'warning')
                 form.cash_register_id.choices = []
         except Exception as e:
-            print(f"Error filtering cash registers: {e}")
+            log.warning("Error filtering cash registers: %s", e)
             form.cash_register_id.choices = []
     
 """
@@ -112,4 +95,4 @@ print("The changes include:")
 print("1. Added logic to check if user has branch_id attribute")
 print("2. Added logic to extract branch_id from username if attribute not available")
 print("3. Improved pre-selection of cash registers based on user's branch")
-print("4. Added more detailed logging for debugging")
+print("4. Added debug logging (erp.pos logger, enable with LOG_LEVELS=pos=DEBUG)")